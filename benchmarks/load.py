@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Load generator for the thumbnail backend.
+
+Workers (threads or processes) call ``get_thumbnail`` for images and presets drawn from Zipf
+distributions. Cache, thumbnail storage and source storage are in memory stand-ins with an
+optional latency (to simulate Memcached or S3). The most popular thumbnails are created before
+the run, up to the requested hit ratio; thumbnails missing at run time are created by the
+workers, concurrent requests of a same new thumbnail show how the backend behaves under a
+stampede.
+
+Reports throughput, p50/p90/p99 latencies, hit ratio, duplicate renders (thumbnails created
+more than once) and cache and storage operations per request. Django is required.
+
+Usage: python benchmarks/load.py [-w workers] [--processes] [-n requests] [--hit-ratio 0.9]
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import argparse
+import bisect
+import multiprocessing
+import os.path
+import pickle
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS = os.path.join(ROOT, 'test', 'assets')
+
+PRESETS = (
+    (('thumbnail', '200,200'),),
+    (('thumbnail', '100,100'), ('crop', '1,center')),
+    (('thumbnail', '600,600'),),
+    (('thumbnail', '300,300'), ('crop', '1,smart')),
+    (('thumbnail', '1200,1200'), ('format', 'webp')),
+)
+
+
+class Latency(object):
+    """
+    Sleeps ``delay`` seconds, give or take ``jitter`` (a ratio of delay).
+    """
+    def __init__(self, delay=0, jitter=0.2):
+        self.delay = delay
+        self.jitter = jitter
+
+    def __call__(self):
+        if self.delay:
+            time.sleep(self.delay * (1 + random.uniform(-self.jitter, self.jitter)))
+
+
+class Counters(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+
+class CacheStandIn(object):
+    """
+    Memcached like cache: values are pickled, every operation waits for latency.
+    """
+    def __init__(self, store, latency, counters):
+        self.store = store
+        self.latency = latency
+        self.counters = counters
+
+    def get(self, key, default=None):
+        self.latency()
+        self.counters.add('cache.get')
+        value = self.store.get(key)
+        return default if value is None else pickle.loads(value)
+
+    def get_many(self, keys):
+        self.latency()
+        self.counters.add('cache.get_many')
+        values = dict((k, self.store.get(k)) for k in keys)
+        return dict((k, pickle.loads(v)) for k, v in values.items() if v is not None)
+
+    def set(self, key, value, timeout=None):
+        self.latency()
+        self.counters.add('cache.set')
+        self.store[key] = pickle.dumps(value, -1)
+
+    def delete(self, key):
+        self.latency()
+        self.counters.add('cache.delete')
+        self.store.pop(key, None)
+
+
+class StorageStandIn(object):
+    """
+    S3 like storage: only sizes of saved files are kept, opened files all have the content of
+    ``source``.
+    """
+    def __init__(self, store, latency, counters, name, source=None):
+        self.store = store
+        self.latency = latency
+        self.counters = counters
+        self.name = name
+        self.source = source
+
+    def count(self, operation):
+        self.latency()
+        self.counters.add('{0}.{1}'.format(self.name, operation))
+
+    def exists(self, name):
+        self.count('exists')
+        return name in self.store
+
+    def save(self, name, content):
+        self.count('save')
+        content.seek(0)
+        self.store[name] = len(content.read())
+        return name
+
+    def open(self, name, mode='rb'):
+        from django.core.files.base import ContentFile
+        self.count('open')
+        return ContentFile(self.source)
+
+    def delete(self, name):
+        self.count('delete')
+        self.store.pop(name, None)
+
+    def modified_time(self, name):
+        raise NotImplementedError
+
+    def url(self, name):
+        return '/media/cache/{0}'.format(name)
+
+
+class Source(object):
+    # Storage file, as Django file fields
+    def __init__(self, name, storage):
+        self.name = name
+        self.path = 'sources/{0}'.format(name)
+        self.storage = storage
+
+
+def zipf_sampler(count, exponent, rnd):
+    """
+    Returns a function drawing an index in ``range(count)``, ``0`` being the most popular.
+    """
+    weights = [1 / (x + 1) ** exponent for x in range(count)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+
+    def sample():
+        return min(bisect.bisect_left(cumulative, rnd.random()), count - 1)
+    sample.probabilities = [x / total for x in weights]
+    return sample
+
+
+def setup_django(processor):
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(
+            MEDIA_ROOT='/tmp',
+            MEDIA_URL='/media/',
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            MINIATURE_PROCESSOR=processor,
+        )
+
+
+def get_backend(options, cache_store, storage_store, counters):
+    """
+    Returns a thumbnail backend class using stand-ins.
+    """
+    setup_django(options.processor)
+    from miniature.thumbnails.base import ThumbnailBackend
+
+    with open(os.path.join(ASSETS, options.source), 'rb') as fp:
+        source = fp.read()
+
+    class Backend(ThumbnailBackend):
+        cache = CacheStandIn(cache_store, Latency(options.cache_latency / 1000), counters)
+        storage = StorageStandIn(storage_store, Latency(options.storage_latency / 1000),
+            counters, 'storage')
+        sources = StorageStandIn({}, Latency(options.storage_latency / 1000), counters,
+            'sources', source)
+
+    return Backend
+
+
+def get_requests(options):
+    """
+    Returns ``(image index, preset index)`` requests and the pairs to create before the run.
+    """
+    rnd = random.Random(options.seed)
+    images = zipf_sampler(options.images, options.exponent, rnd)
+    presets = zipf_sampler(len(PRESETS), options.exponent, rnd)
+    requests = [(images(), presets()) for _ in range(options.requests)]
+
+    # Most popular pairs are warm, up to hit ratio
+    pairs = sorted(((i, j) for i in range(options.images) for j in range(len(PRESETS))),
+        key=lambda x: -images.probabilities[x[0]] * presets.probabilities[x[1]])
+    warm = []
+    mass = 0
+    for i, j in pairs:
+        if mass >= options.hit_ratio:
+            break
+        warm.append((i, j))
+        mass += images.probabilities[i] * presets.probabilities[j]
+
+    return requests, warm
+
+
+def run_worker(options, requests, cache_store, storage_store):
+    """
+    Runs requests, returns latencies, hits and operation counters.
+    """
+    counters = Counters()
+    backend = get_backend(options, cache_store, storage_store, counters)
+
+    latencies = []
+    hits = 0
+    for i, j in requests:
+        image = Source('image-{0}.jpg'.format(i), backend.sources)
+        renders = counters.values.get('storage.save', 0)
+        start = time.time()
+        backend.get_thumbnail(image, PRESETS[j])
+        latencies.append(time.time() - start)
+        if counters.values.get('storage.save', 0) == renders:
+            hits += 1
+
+    return latencies, hits, counters.values
+
+
+def run_process(args):
+    return run_worker(*args)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of get_thumbnail.')
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    parser.add_argument('--processes', action='store_true',
+        help='use processes instead of threads, stand-ins are shared through a manager')
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('--images', type=int, default=500, help='number of source images')
+    parser.add_argument('--exponent', type=float, default=1.1, help='Zipf exponent')
+    parser.add_argument('--hit-ratio', type=float, default=0.9,
+        help='popularity mass of thumbnails created before the run')
+    parser.add_argument('--cache-latency', type=float, default=0.5, help='ms per cache operation')
+    parser.add_argument('--storage-latency', type=float, default=20,
+        help='ms per storage operation')
+    parser.add_argument('--source', default='tiger.jpg', help='asset used as source image')
+    parser.add_argument('-p', '--processor', default='pillow')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(argv)
+
+    try:
+        import django  # NOQA
+    except ImportError:
+        print('Django is required.', file=sys.stderr)
+        return 1
+
+    requests, warm = get_requests(options)
+    manager = None
+    if options.processes:
+        manager = multiprocessing.Manager()
+        cache_store, storage_store = manager.dict(), manager.dict()
+    else:
+        cache_store, storage_store = {}, {}
+
+    # Warm thumbnails are created without latency
+    fill = argparse.Namespace(**dict(vars(options), cache_latency=0, storage_latency=0))
+    backend = get_backend(fill, cache_store, storage_store, Counters())
+    for i, j in warm:
+        backend.get_thumbnail(Source('image-{0}.jpg'.format(i), backend.sources), PRESETS[j])
+    initial = set(storage_store.keys())
+
+    chunks = [requests[x::options.workers] for x in range(options.workers)]
+    tasks = [(options, x, cache_store, storage_store) for x in chunks]
+
+    start = time.time()
+    if options.processes:
+        pool = multiprocessing.Pool(options.workers)
+        try:
+            results = pool.map(run_process, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [None] * len(tasks)
+
+        def target(index):
+            results[index] = run_worker(*tasks[index])
+
+        threads = [threading.Thread(target=target, args=(x,)) for x in range(len(tasks))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    duration = time.time() - start
+
+    latencies = sorted(x for r in results for x in r[0])
+    hits = sum(r[1] for r in results)
+    counters = {}
+    for r in results:
+        for k, v in r[2].items():
+            counters[k] = counters.get(k, 0) + v
+
+    created = len(set(storage_store.keys()) - initial)
+    renders = counters.get('storage.save', 0)
+    count = len(latencies)
+
+    print('Requests:          {0} by {1} {2}'.format(count, options.workers,
+        'processes' if options.processes else 'threads'))
+    print('Thumbnails:        {0} warm, {1} created'.format(len(initial), created))
+    print('Throughput:        {0:.1f} req/s'.format(count / duration))
+    print('Latency (ms):      p50 {0:.1f}, p90 {1:.1f}, p99 {2:.1f}, max {3:.1f}'.format(
+        *[percentile(latencies, x) * 1000 for x in (50, 90, 99, 100)]))
+    print('Hit ratio:         {0:.3f} (target {1})'.format(hits / count, options.hit_ratio))
+    print('Renders:           {0}, {1} duplicates'.format(renders, renders - created))
+    for name in sorted(counters):
+        print('{0:<18} {1:.2f} per request'.format(name + ':', counters[name] / count))
+
+    if manager is not None:
+        manager.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Compares palette quantizers time and PNG output size.
+
+Usage: python benchmarks/palette.py [processor] [image...]
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from miniature.processor import get_processor  # NOQA
+from miniature.processor.base import six  # NOQA
+
+ASSETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test', 'assets')
+
+
+def run(processor, path, quantizer, sample, dither):
+    fp = six.BytesIO()
+    with processor(path) as p:
+        p.set_mode('palette', quantizer, sample=sample, dither=dither)
+        p.save(fp, 'png')
+    return len(fp.getvalue())
+
+
+def main(name='pillow', *images):
+    processor = get_processor(name)
+    images = images or [os.path.join(ASSETS, x) for x in ('tiger.jpg', 'nocomments.gif')]
+
+    print('{0:<20} {1:<14} {2:>6} {3:>6} {4:>10} {5:>10}'.format(
+        'image', 'quantizer', 'sample', 'dither', 'time (ms)', 'size (B)'))
+    for path in images:
+        for quantizer in processor.QUANTIZERS:
+            for sample in (None, 256):
+                for dither in (False, True):
+                    try:
+                        size = run(processor, path, quantizer, sample, dither)
+                    except ValueError:
+                        continue
+
+                    duration = min(timeit.repeat(
+                        lambda: run(processor, path, quantizer, sample, dither),
+                        repeat=3, number=1
+                    ))
+                    print('{0:<20} {1:<14} {2:>6} {3:>6} {4:>10.1f} {5:>10}'.format(
+                        os.path.basename(path), quantizer, sample or '-', dither and 'yes' or 'no',
+                        duration * 1000, size))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Compares resampling profiles time and quality.
+
+Quality is the PSNR (in dB, higher is better) of each thumbnail against the one made with the
+``best`` profile (a single full resolution pass of the default filter). Requires NumPy.
+
+Usage: python benchmarks/resampling.py [processor] [image...]
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from math import log10
+import os.path
+import sys
+import timeit
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from miniature.processor import get_processor  # NOQA
+
+ASSETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test', 'assets')
+
+SIZES = (100, 300, 800)
+PROFILES = (None, 'fast', 'balanced', 'best')
+
+
+def run(processor, path, size, profile):
+    with processor(path, profile=profile) as p:
+        p.thumbnail(size, size)
+        p.set_image(p._load(p.img))
+        return numpy.asarray(p._get_array(p.img), dtype=numpy.float64)
+
+
+def psnr(a, b):
+    mse = ((a - b) ** 2).mean()
+    return float('inf') if mse == 0 else 10 * log10(255 ** 2 / mse)
+
+
+def main(name='pillow', *images):
+    processor = get_processor(name)
+    images = images or [os.path.join(ASSETS, x) for x in ('tiger.jpg', 'mona-lisa.jpg', 'beach.jpg')]
+
+    print('{0:<16} {1:>5} {2:<10} {3:>10} {4:>10}'.format(
+        'image', 'size', 'profile', 'time (ms)', 'psnr (dB)'))
+    for path in images:
+        for size in SIZES:
+            reference = run(processor, path, size, 'best')
+            for profile in PROFILES:
+                duration = min(timeit.repeat(lambda: run(processor, path, size, profile),
+                    repeat=5, number=1))
+                print('{0:<16} {1:>5} {2:<10} {3:>10.2f} {4:>10.1f}'.format(
+                    os.path.basename(path), size, profile or 'default', duration * 1000,
+                    psnr(run(processor, path, size, profile), reference)))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
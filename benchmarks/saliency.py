@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Compares smart crop detectors latency.
+
+Usage: python benchmarks/saliency.py [processor] [image...]
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from miniature.processor import get_processor  # NOQA
+from miniature.processor.saliency import DETECTORS, get_detector  # NOQA
+
+ASSETS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test', 'assets')
+
+
+def main(name='pillow', *images):
+    processor = get_processor(name)
+    images = images or [os.path.join(ASSETS, x) for x in ('tiger.jpg', 'mona-lisa.jpg', 'beach.jpg')]
+
+    print('{0:<16} {1:<10} {2:>12} {3:>12} {4:>14}'.format(
+        'image', 'detector', 'detect (ms)', 'total (ms)', 'poi'))
+    for path in images:
+        with processor(path) as p:
+            proxy = p.get_proxy(210)
+            pixels = p._get_array(proxy)
+
+            for detector in sorted(DETECTORS):
+                d = get_detector(detector)
+                detect = min(timeit.repeat(lambda: d.detect(pixels, 1), repeat=5, number=10)) / 10
+
+                def run():
+                    # Whole analysis, without cache
+                    p.analysis = {}
+                    return p.get_poi(detector=detector, ratio=1)
+
+                total = min(timeit.repeat(run, repeat=5, number=1))
+                print('{0:<16} {1:<10} {2:>12.2f} {3:>12.2f} {4:>14}'.format(
+                    os.path.basename(path), detector, detect * 1000, total * 1000, str(run())))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Benchmark suite of processors and thumbnail backend.
+
+Every operation, smart crop detector and save format is measured on bundled assets and on
+synthetic sources of several sizes and formats. The thumbnail backend cold (thumbnail creation)
+and warm (cache hit) paths are measured when Django is installed, with a local memory cache and a
+temporary storage.
+
+Results (time statistics, processor pixel memory peak and Python heap peak) are written as JSON.
+Given a previous result file, cases slower than the threshold are reported and exit status is 1.
+
+Usage: python benchmarks/suite.py [-p processor] [-o results.json] [-c baseline.json] [-k filter]
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import argparse
+import json
+import os.path
+import platform
+from shutil import rmtree
+import subprocess
+import sys
+from tempfile import mkdtemp
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from miniature.processor import get_processor  # NOQA
+from miniature.processor.base import six  # NOQA
+from miniature.version import __version__  # NOQA
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS = os.path.join(ROOT, 'test', 'assets')
+
+# Synthetic sources, resized from tiger.jpg
+SIZES = ((800, 450), (2400, 1350))
+FORMATS = ('jpeg', 'png', 'webp')
+
+# Arguments of every operation, an operation missing here is reported
+OPERATIONS = {
+    'orientation': [()],
+    'thumbnail': [(200, 200), (600, 600)],
+    'resize': [(400, 300)],
+    'crop': [(1, 'center'), (16 / 9, 'smart')],
+    'rotate': [(90,), (33,)],
+    'add_border': [(10, '#f00')],
+    'set_background': [('#fff',)],
+    'set_mode': [('grayscale',), ('palette',)],
+}
+DETECTORS = ('entropy', 'edges', 'window')
+SAVE_FORMATS = ('jpeg', 'png', 'webp', 'gif', 'avif')
+
+
+def make_sources(processor, dest):
+    """
+    Returns ``(name, path)`` sources: bundled assets and synthetic images.
+    """
+    result = [(x, os.path.join(ASSETS, x)) for x in ('tiger.jpg', 'nocomments.gif')]
+    formats = processor.get_save_formats()
+    for w, h in SIZES:
+        for format_ in FORMATS:
+            if format_ not in formats:
+                continue
+            name = '{0}x{1}.{2}'.format(w, h, format_)
+            path = os.path.join(dest, name)
+            with processor(os.path.join(ASSETS, 'tiger.jpg')) as p:
+                p.resize(w, h).save(path, format_)
+            result.append((name, path))
+    return result
+
+
+def measure(setup, stmt, rounds):
+    """
+    Returns time statistics of ``stmt`` run once per round after ``setup``, then memory usage of
+    an extra round. ``setup`` returns the processor passed to ``stmt``.
+    """
+    state = {}
+
+    def _setup():
+        state['p'] = setup()
+
+    def _stmt():
+        stmt(state['p'])
+
+    def _close():
+        if state.get('p') is not None:
+            state.pop('p').close()
+
+    times = []
+    for i in range(rounds + 1):
+        _setup()
+        try:
+            t = timeit.Timer(_stmt).timeit(1)
+        finally:
+            _close()
+        if i:
+            # First round is a warm up
+            times.append(t)
+
+    _setup()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    try:
+        stmt(state['p'])
+        memory_peak = getattr(state['p'], 'memory_peak', None)
+    finally:
+        _close()
+        py_memory_peak = None
+        if tracemalloc is not None:
+            py_memory_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    times.sort()
+    mean = sum(times) / len(times)
+    return {
+        'rounds': len(times),
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': mean,
+        'stddev': (sum((x - mean) ** 2 for x in times) / len(times)) ** 0.5,
+        'memory_peak': memory_peak,
+        'py_memory_peak': py_memory_peak,
+    }
+
+
+def processor_cases(processor, sources):
+    """
+    Yields ``(name, setup, stmt)`` cases. Images are decoded by setup, operations are measured
+    alone.
+    """
+    def opener(path):
+        def setup():
+            p = processor(path)
+            p.set_image(p._load(p.img))
+            return p
+        return setup
+
+    def decode(p):
+        p.set_image(p._load(p.img))
+
+    missing = [x for x in dir(processor) if getattr(getattr(processor, x), 'is_operation', False)
+        and x not in OPERATIONS]
+    if missing:
+        print('Operations without benchmark: {0}'.format(', '.join(missing)), file=sys.stderr)
+
+    save_formats = [x for x in SAVE_FORMATS if x in processor.get_save_formats()]
+
+    for source, path in sources:
+        yield 'decode[{0}]'.format(source), lambda path=path: processor(path), decode
+
+        for name, arguments in sorted(OPERATIONS.items()):
+            for args in arguments:
+                yield ('{0}{1}[{2}]'.format(name, args, source), opener(path),
+                    lambda p, name=name, args=args: getattr(p, name)(*args))
+
+        for detector in DETECTORS:
+            def poi(p, detector=detector):
+                # Whole analysis, without cache
+                p.analysis = {}
+                p.get_poi(detector=detector, ratio=1)
+            yield 'get_poi({0})[{1}]'.format(detector, source), opener(path), poi
+
+        for format_ in save_formats:
+            yield ('save({0})[{1}]'.format(format_, source), opener(path),
+                lambda p, format_=format_: p.save(six.BytesIO(), format_))
+
+
+def backend_cases(processor_name, sources, dest):
+    """
+    Yields thumbnail backend cases, none when Django is not installed.
+    """
+    try:
+        from django.conf import settings
+    except ImportError:
+        print('Django is not installed, backend is not measured.', file=sys.stderr)
+        return
+
+    if not settings.configured:
+        settings.configure(
+            MEDIA_ROOT=dest,
+            MEDIA_URL='/media/',
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'thumbnails': {
+                    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                    'LOCATION': 'miniature-benchmarks',
+                },
+            },
+            MINIATURE_PROCESSOR=processor_name,
+        )
+
+    from django.core.files.storage import FileSystemStorage
+    from miniature.thumbnails.base import ThumbnailBackend
+
+    storage = FileSystemStorage(location=os.path.dirname(sources[0][1]))
+    operations = (('thumbnail', '200,200'), ('crop', '1,smart'))
+
+    class Source(object):
+        # Storage file, as Django file fields
+        def __init__(self, path):
+            self.name = os.path.basename(path)
+            self.path = path
+            self.storage = storage
+
+    for source, path in sources:
+        if os.path.dirname(path) != storage.location:
+            continue
+        image = Source(path)
+
+        def clear(image=image):
+            ThumbnailBackend.remove_entries(image)
+
+        def run(p, image=image):
+            ThumbnailBackend.get_thumbnail(image, operations)
+
+        yield 'get_thumbnail(cold)[{0}]'.format(source), clear, run
+        ThumbnailBackend.get_thumbnail(image, operations)
+        yield 'get_thumbnail(warm)[{0}]'.format(source), lambda: None, run
+
+
+def get_metadata(processor_name):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'miniature': __version__,
+        'commit': commit,
+        'processor': processor_name,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'system': platform.platform(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints cases slower than ``threshold`` (a ratio of baseline median), returns their count.
+    """
+    previous = dict((x['name'], x) for x in baseline['results'])
+    regressions = 0
+    for result in results:
+        old = previous.get(result['name'])
+        if old is None or not old.get('median') or 'median' not in result:
+            continue
+        ratio = result['median'] / old['median']
+        if ratio > threshold:
+            regressions += 1
+            print('Regression: {0} {1:.2f}ms -> {2:.2f}ms (x{3:.2f})'.format(
+                result['name'], old['median'] * 1000, result['median'] * 1000, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the benchmark suite.')
+    parser.add_argument('-p', '--processor', default='pillow')
+    parser.add_argument('-o', '--output', help='JSON results file')
+    parser.add_argument('-c', '--compare', metavar='BASELINE', help='previous JSON results file')
+    parser.add_argument('-t', '--threshold', type=float, default=1.2,
+        help='regression ratio of median time (default: %(default)s)')
+    parser.add_argument('-r', '--rounds', type=int, default=5)
+    parser.add_argument('-k', '--filter', help='only run cases containing this string')
+    args = parser.parse_args(argv)
+
+    processor = get_processor(args.processor)
+    dest = mkdtemp()
+    try:
+        sources = make_sources(processor, dest)
+        cases = list(processor_cases(processor, sources))
+        cases.extend(backend_cases(args.processor, sources, dest))
+
+        results = []
+        print('{0:<50} {1:>10} {2:>10} {3:>12} {4:>12}'.format(
+            'case', 'min (ms)', 'med (ms)', 'pixels (kB)', 'python (kB)'))
+        for name, setup, stmt in cases:
+            if args.filter and args.filter not in name:
+                continue
+            try:
+                result = dict(name=name, **measure(setup, stmt, args.rounds))
+            except Exception as e:
+                # Failing cases are kept in results, they are not compared
+                results.append({'name': name, 'error': '{0}: {1}'.format(e.__class__.__name__, e)})
+                print('{0:<50} {1}'.format(name, results[-1]['error']))
+                continue
+            results.append(result)
+            print('{0:<50} {1:>10.2f} {2:>10.2f} {3:>12} {4:>12}'.format(
+                name, result['min'] * 1000, result['median'] * 1000,
+                '-' if result['memory_peak'] is None else result['memory_peak'] // 1024,
+                '-' if result['py_memory_peak'] is None else result['py_memory_peak'] // 1024))
+    finally:
+        rmtree(dest)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({'metadata': get_metadata(args.processor), 'results': results}, fp,
+                indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            if compare(results, json.load(fp), args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Bulk image processing with a pool of processes.
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import argparse
+from collections import namedtuple
+import multiprocessing
+import os
+import sys
+import time
+
+from miniature.processor import get_processor
+from miniature.processor.base import eval_expr
+
+IMAGE_EXTENSIONS = ('bmp', 'gif', 'jpeg', 'jpg', 'png', 'tif', 'tiff', 'webp')
+
+BatchResult = namedtuple('BatchResult', ('source', 'dest', 'error', 'duration'))
+
+
+def get_dest(source, dest_pattern, root=None, format=None):
+    """
+    Returns destination path of ``source`` from a pattern. Pattern fields are ``dirname``,
+    ``basename``, ``name`` (basename without extension), ``ext`` (``format`` if provided) and
+    ``reldir``, the source directory relative to ``root``.
+    """
+    dirname, basename = os.path.split(source)
+    name, ext = os.path.splitext(basename)
+    return os.path.normpath(dest_pattern.format(
+        dirname=dirname,
+        basename=basename,
+        name=name,
+        ext=format or ext[1:],
+        reldir=os.path.relpath(dirname or '.', root or '.'),
+    ))
+
+
+def process(task):
+    """
+    Processes a single image, errors are returned in result instead of being raised.
+    """
+    source, dest, operations, options = task
+    start = time.time()
+    try:
+        if not options.get('overwrite', True) and os.path.exists(dest):
+            return BatchResult(source, dest, None, 0)
+
+        dirname = os.path.dirname(dest)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created by another worker
+                if not os.path.isdir(dirname):
+                    raise
+
+        Processor = get_processor(options.get('processor', 'pillow'))
+        with Processor(source, **options.get('processor_options', {})) as p:
+            if options.get('orientation', True):
+                p.orientation(defer=True)
+            p.operations(*operations)
+            p.save(dest, options.get('format'), **options.get('save_options', {}))
+    except Exception as e:
+        return BatchResult(source, dest, '{0}: {1}'.format(e.__class__.__name__, e),
+            time.time() - start)
+
+    return BatchResult(source, dest, None, time.time() - start)
+
+
+def process_many(sources, operations, dest_pattern, workers=None, chunksize=8, root=None,
+processor='pillow', format=None, orientation=True, overwrite=True, processor_options=None,
+save_options=None):
+    """
+    Applies ``operations`` (a list of ``(name, value)`` tuples, as for ``Processor.operations``)
+    on every source path and saves results to ``dest_pattern`` (see ``get_dest``).
+
+    Images are processed by a pool of ``workers`` processes (one per CPU by default, no pool
+    with one worker) receiving ``chunksize`` tasks at once. ``BatchResult`` items are yielded
+    as soon as images are done, in any order; an image failing does not stop the batch, its
+    result ``error`` is set instead.
+    """
+    options = {
+        'processor': processor,
+        'format': format,
+        'orientation': orientation,
+        'overwrite': overwrite,
+        'processor_options': processor_options or {},
+        'save_options': save_options or {},
+    }
+    operations = list(operations)
+    tasks = ((x, get_dest(x, dest_pattern, root, format), operations, options) for x in sources)
+
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        for task in tasks:
+            yield process(task)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(process, tasks, chunksize):
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def find_images(paths, extensions=IMAGE_EXTENSIONS):
+    """
+    Yields image paths from a list of files and directories, walked recursively.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1][1:].lower() in extensions:
+                    yield os.path.join(dirpath, filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='miniature',
+        description='Applies operations on images, directories are processed recursively.')
+    parser.add_argument('sources', nargs='+', metavar='SOURCE')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('-O', '--operation', action='append', default=[], dest='operations',
+        metavar='NAME=VALUE', help='operation to apply, eg. "thumbnail=200,200" (repeatable)')
+    parser.add_argument('--pattern', default='{reldir}/{name}.{ext}',
+        help='output path pattern in output directory (default: "%(default)s")')
+    parser.add_argument('-f', '--format', help='output format (default: source format)')
+    parser.add_argument('-s', '--save', action='append', default=[], metavar='NAME=VALUE',
+        help='save option, eg. "quality=70" (repeatable)')
+    parser.add_argument('-p', '--processor', default='pillow')
+    parser.add_argument('-r', '--resampling', metavar='PROFILE',
+        help='resampling profile: fast, balanced or best')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+        help='number of processes (default: number of CPUs)')
+    parser.add_argument('--chunksize', type=int, default=8)
+    parser.add_argument('--no-overwrite', action='store_false', dest='overwrite',
+        help='skip images already processed')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    def split(values):
+        result = [x.split('=', 1) for x in values]
+        for x in result:
+            if len(x) != 2:
+                parser.error('Invalid value "{0}", NAME=VALUE expected.'.format(x[0]))
+        return result
+
+    operations = [tuple(x) for x in split(args.operations)]
+    save_options = {}
+    for k, v in split(args.save):
+        try:
+            v = eval_expr(v)
+        except (TypeError, KeyError, SyntaxError):
+            pass
+        save_options[str(k)] = v
+
+    # Sources are relative to their own root when several directories are given
+    count = errors = 0
+    for source in args.sources:
+        root = source if os.path.isdir(source) else os.path.dirname(source)
+        results = process_many(find_images([source]), operations,
+            os.path.join(args.output, args.pattern),
+            workers=args.workers, chunksize=args.chunksize, root=root, processor=args.processor,
+            format=args.format, overwrite=args.overwrite, save_options=save_options,
+            processor_options={'profile': args.resampling})
+
+        for result in results:
+            count += 1
+            if result.error:
+                errors += 1
+                print('{0}: {1}'.format(result.source, result.error), file=sys.stderr)
+            elif not args.quiet:
+                print('{0} -> {1}'.format(result.source, result.dest))
+
+    if not args.quiet:
+        print('{0} images processed, {1} errors.'.format(count, errors), file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
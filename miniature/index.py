@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Persistent index of thumbnails in a SQLite database.
+
+Each entry is a thumbnail of a source image: its operations id, storage path, source version,
+dimensions, creation and last access times. Entries are keyed by source then operations id,
+sources sharing a prefix (a directory) are read or removed with a range scan.
+
+The database could be local or shared by several processes (WAL journal, writers wait for
+each other up to ``timeout`` seconds). Use another ``journal_mode`` on network file systems.
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from collections import namedtuple
+import sqlite3
+import threading
+import time
+
+Entry = namedtuple('Entry', ('source', 'op_id', 'path', 'version', 'width', 'height',
+    'created', 'accessed'))
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS entries (
+        source TEXT NOT NULL,
+        op_id TEXT NOT NULL,
+        path TEXT NOT NULL,
+        version TEXT,
+        width INTEGER,
+        height INTEGER,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL,
+        PRIMARY KEY (source, op_id)
+    )
+    """,
+    'CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)',
+    'CREATE INDEX IF NOT EXISTS entries_path ON entries (path)',
+)
+
+# SQLite default limit of query parameters is 999
+CHUNK_SIZE = 500
+
+
+def prefix_range(prefix):
+    """
+    Returns the ``(start, end)`` bounds of strings starting with ``prefix``.
+    """
+    return prefix, prefix[0:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SQLiteIndex(object):
+    """
+    Thread safe index, each thread has its own connection. Access times are updated by batches
+    every ``touch_interval`` seconds.
+    """
+    def __init__(self, path, timeout=30, journal_mode='wal', touch_interval=60):
+        self.path = path
+        self.timeout = timeout
+        self.journal_mode = journal_mode
+        self.touch_interval = touch_interval
+        self.local = threading.local()
+        self.touch_lock = threading.Lock()
+        self.touched = {}
+        self.last_flush = time.time()
+
+        with self.transaction() as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+    @property
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=self.timeout,
+                isolation_level=None)
+            if self.journal_mode:
+                db.execute('PRAGMA journal_mode = {0}'.format(self.journal_mode))
+            db.execute('PRAGMA synchronous = NORMAL')
+        return db
+
+    def transaction(self):
+        return Transaction(self.db)
+
+    def close(self):
+        self.flush()
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+    def get(self, source):
+        """
+        Returns ``(path, version)`` of a source thumbnails by operations id, ``version`` being
+        the source version they were created from.
+        """
+        rows = self.db.execute('SELECT op_id, path, version FROM entries WHERE source = ?',
+            (source,))
+        return dict((op_id, (path, version)) for op_id, path, version in rows)
+
+    def get_many(self, sources):
+        """
+        Returns ``(path, version)`` of thumbnails by operations id, by source. Sources without
+        thumbnails are missing.
+        """
+        sources = list(set(sources))
+        result = {}
+        for i in range(0, len(sources), CHUNK_SIZE):
+            chunk = sources[i:i + CHUNK_SIZE]
+            rows = self.db.execute(
+                'SELECT source, op_id, path, version FROM entries WHERE source IN ({0})'.format(
+                    ','.join('?' * len(chunk))),
+                chunk)
+            for source, op_id, path, version in rows:
+                result.setdefault(source, {})[op_id] = (path, version)
+        return result
+
+    def add(self, source, op_id, path, version=None, size=None):
+        """
+        Adds or replaces an entry. Returns the path of the replaced entry when it changed, None
+        otherwise.
+        """
+        now = time.time()
+        width, height = size or (None, None)
+        with self.transaction() as db:
+            previous = db.execute('SELECT path FROM entries WHERE source = ? AND op_id = ?',
+                (source, op_id)).fetchone()
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (source, op_id, path, version, width, height, now, now))
+
+        if previous is not None and previous[0] != path:
+            return previous[0]
+        return None
+
+    def set(self, source, entries, version=None):
+        """
+        Replaces entries of a source with an ``{op_id: path}`` dictionary of thumbnails of
+        source ``version``. Entries that don't change keep their other metadata.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            current = dict(db.execute('SELECT op_id, path FROM entries WHERE source = ?',
+                (source,)))
+            db.executemany('DELETE FROM entries WHERE source = ? AND op_id = ?',
+                [(source, k) for k, v in current.items() if entries.get(k) != v])
+            db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, NULL, NULL, ?, ?)',
+                [(source, k, v, version, now, now) for k, v in entries.items()
+                if current.get(k) != v])
+            db.execute('UPDATE entries SET version = ? WHERE source = ?', (version, source))
+
+    def touch(self, source, op_id):
+        """
+        Records an access to an entry, written with the next flush.
+        """
+        now = time.time()
+        with self.touch_lock:
+            self.touched[(source, op_id)] = now
+            flush = now - self.last_flush >= self.touch_interval
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes pending access times.
+        """
+        with self.touch_lock:
+            touched, self.touched = self.touched, {}
+            self.last_flush = time.time()
+        if not touched:
+            return
+
+        with self.transaction() as db:
+            db.executemany(
+                'UPDATE entries SET accessed = ? WHERE source = ? AND op_id = ? AND accessed < ?',
+                [(t, source, op_id, t) for (source, op_id), t in touched.items()])
+
+    def scan(self, prefix='', accessed_before=None, limit=None):
+        """
+        Yields entries ordered by source, of sources starting with ``prefix`` and, with
+        ``accessed_before``, not accessed since this timestamp.
+        """
+        where, params = [], []
+        if prefix:
+            where.append('source >= ? AND source < ?')
+            params.extend(prefix_range(prefix))
+        if accessed_before is not None:
+            where.append('accessed < ?')
+            params.append(accessed_before)
+
+        query = 'SELECT * FROM entries'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY source, op_id'
+        if limit is not None:
+            query += ' LIMIT {0:d}'.format(limit)
+
+        for row in self.db.execute(query, params):
+            yield Entry(*row)
+
+    def sources(self, prefix=''):
+        """
+        Yields distinct sources starting with ``prefix`` (sources to warm).
+        """
+        query, params = 'SELECT DISTINCT source FROM entries', ()
+        if prefix:
+            query += ' WHERE source >= ? AND source < ?'
+            params = prefix_range(prefix)
+        for row in self.db.execute(query + ' ORDER BY source', params):
+            yield row[0]
+
+    def delete(self, entries):
+        """
+        Deletes entries (anything with ``source`` and ``op_id`` attributes).
+        """
+        with self.transaction() as db:
+            db.executemany('DELETE FROM entries WHERE source = ? AND op_id = ?',
+                [(x.source, x.op_id) for x in entries])
+
+    def delete_source(self, source):
+        """
+        Deletes entries of a source and returns their paths.
+        """
+        with self.transaction() as db:
+            paths = [x[0] for x in db.execute('SELECT path FROM entries WHERE source = ?',
+                (source,))]
+            db.execute('DELETE FROM entries WHERE source = ?', (source,))
+        return paths
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+
+class Transaction(object):
+    """
+    Write transaction, the database is locked from the beginning so that concurrent writers
+    wait instead of failing on upgrade.
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
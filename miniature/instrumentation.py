@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Instrumentation of processors and thumbnail backend.
+
+Phases are measured with ``measure(name)`` and reported as ``(name, duration, values)`` events
+to every listener, ``values`` being a dictionary of counts (``bytes``, ``pixels``, ``hit``...).
+Nothing is measured while there is no listener. ``metrics`` is a default listener aggregating
+events in process, it is exported by ``StatsdSink`` and ``PrometheusSink``.
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from contextlib import contextmanager
+import os
+import re
+import threading
+import time
+
+listeners = []
+
+
+def add_listener(listener):
+    """
+    Adds a ``listener(name, duration, values)`` callable receiving every event.
+    """
+    if listener not in listeners:
+        listeners.append(listener)
+
+
+def remove_listener(listener):
+    if listener in listeners:
+        listeners.remove(listener)
+
+
+def emit(name, duration, values=None):
+    for listener in list(listeners):
+        listener(name, duration, values or {})
+
+
+@contextmanager
+def measure(name, **values):
+    """
+    Measures the enclosed block duration. The yielded dictionary holds event values and could be
+    updated within the block. Event is not emitted when the block raises.
+    """
+    if not listeners:
+        yield values
+        return
+
+    start = time.time()
+    yield values
+    emit(name, time.time() - start, values)
+
+
+class Metrics(object):
+    """
+    Thread safe aggregation of events: count and durations (total and max) of every phase and
+    sums of their values.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, name, duration, values):
+        with self.lock:
+            stats = self.phases.get(name)
+            if stats is None:
+                stats = self.phases[name] = {'count': 0, 'time': 0, 'max': 0, 'values': {}}
+
+            stats['count'] += 1
+            stats['time'] += duration
+            stats['max'] = max(stats['max'], duration)
+            for k, v in values.items():
+                if isinstance(v, (bool, int, float)):
+                    stats['values'][k] = stats['values'].get(k, 0) + v
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+
+    def snapshot(self):
+        """
+        Returns a copy of aggregated stats by phase name.
+        """
+        with self.lock:
+            return dict((k, dict(v, values=dict(v['values']))) for k, v in self.phases.items())
+
+    def to_statsd(self, prefix='miniature', previous=None):
+        """
+        Returns StatsD lines of counts and durations since ``previous`` snapshot (all of them by
+        default).
+        """
+        previous = previous or {}
+        lines = []
+        for name, stats in sorted(self.snapshot().items()):
+            last = previous.get(name, {'count': 0, 'time': 0, 'values': {}})
+            count = stats['count'] - last['count']
+            if not count:
+                continue
+
+            key = '{0}.{1}'.format(prefix, name)
+            lines.append('{0}.count:{1}|c'.format(key, count))
+            lines.append('{0}.time:{1:.3f}|ms'.format(key,
+                (stats['time'] - last['time']) * 1000 / count))
+            for k, v in sorted(stats['values'].items()):
+                lines.append('{0}.{1}:{2}|c'.format(key, k, v - last['values'].get(k, 0)))
+
+        return lines
+
+    def to_prometheus(self, prefix='miniature'):
+        """
+        Returns metrics in Prometheus text format, phase name being the ``phase`` label.
+        """
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+
+        def family(metric, type_, rows):
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, metric, type_))
+            for name, value in rows:
+                lines.append('{0}_{1}{{phase="{2}"}} {3}'.format(prefix, metric, name, value))
+
+        family('duration_seconds_count', 'counter', [(k, v['count']) for k, v in snapshot])
+        family('duration_seconds_sum', 'counter', [(k, v['time']) for k, v in snapshot])
+        family('duration_seconds_max', 'gauge', [(k, v['max']) for k, v in snapshot])
+
+        names = sorted(set(x for _, v in snapshot for x in v['values']))
+        for value_name in names:
+            family('{0}_total'.format(re.sub(r'[^a-zA-Z0-9_]', '_', value_name)), 'counter',
+                [(k, int(v['values'][value_name])) for k, v in snapshot
+                if value_name in v['values']])
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class StatsdSink(object):
+    """
+    Sends metrics to a local StatsD agent over UDP, each flush sends what happened since the
+    previous one.
+    """
+    def __init__(self, metrics=metrics, host='127.0.0.1', port=8125, prefix='miniature'):
+        self.metrics = metrics
+        self.address = (host, port)
+        self.prefix = prefix
+        self.previous = {}
+
+    def flush(self):
+        import socket
+
+        snapshot = self.metrics.snapshot()
+        lines = self.metrics.to_statsd(self.prefix, self.previous)
+        self.previous = snapshot
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in lines:
+                sock.sendto(line.encode('ascii'), self.address)
+        finally:
+            sock.close()
+        return lines
+
+
+class PrometheusSink(object):
+    """
+    Writes metrics to a file read by Prometheus node exporter textfile collector. File is
+    replaced atomically.
+    """
+    def __init__(self, path, metrics=metrics, prefix='miniature'):
+        self.path = path
+        self.metrics = metrics
+        self.prefix = prefix
+
+    def flush(self):
+        import tempfile
+
+        content = self.metrics.to_prometheus(self.prefix)
+        fd, tmp_ = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(content)
+        os.rename(tmp_, self.path)
+        return content
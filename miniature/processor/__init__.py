@@ -14,7 +14,6 @@ def get_processor(name):
     module_name = '.'.join(name.split('.')[0:-1])
     class_name = name.split('.')[-1]
 
-    if module_name not in sys.modules:
-        __import__(module_name)
-
+    # Module could be in sys.modules while another thread imports it, import waits for it
+    __import__(module_name)
     return getattr(sys.modules[module_name], class_name)
@@ -5,7 +5,8 @@
 from __future__ import (print_function, division, absolute_import, unicode_literals)
 
 import ast
-from math import floor, log
+import functools
+from math import ceil, floor, log
 import operator as op
 import os.path
 import re
@@ -16,6 +17,8 @@ try:
 except ImportError:
     import six
 
+from miniature import instrumentation
+
 BytesIO = six.BytesIO
 
 
@@ -46,9 +49,47 @@ def eval_expr(expr):
     return eval_(ast.parse(expr, mode='eval').body)
 
 
+class ImageTooLargeError(ValueError):
+    pass
+
+
+def get_zones(size, zoning):
+    """
+    Splits ``size`` in ``zoning`` ``[start, end]`` ranges.
+    """
+    result = []
+    w, rest = size // zoning, size % zoning
+
+    o = 0
+    while o < size - rest:
+        t_ = [o and o + 1 or o]
+        o += w
+        t_.append(o)
+        result.append(t_)
+
+    if rest:
+        result[-1][1] += rest
+    return result
+
+
 def operation(func):
-    func.is_operation = True
-    return func
+    """
+    Marks a processor method as an operation, measured as ``operation.<name>`` phase with the
+    pixel count of its result.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not instrumentation.listeners:
+            return func(self, *args, **kwargs)
+
+        with instrumentation.measure('operation.{0}'.format(func.__name__)) as values:
+            result = func(self, *args, **kwargs)
+            w, h = self.size
+            values['pixels'] = w * h
+        return result
+
+    wrapper.is_operation = True
+    return wrapper
 
 
 class BaseProcessor(object):
@@ -57,7 +98,49 @@ class BaseProcessor(object):
 
     MODES = {}
 
-    def __init__(self, img):
+    # Palette computation methods for palette modes
+    QUANTIZERS = ()
+    DEFAULT_QUANTIZER = None
+
+    # Default save options by format. ``strip`` option (default True) removes metadata except
+    # color profile.
+    SAVE_OPTIONS = {
+        'jpeg': {'quality': 85, 'optimize': True, 'progressive': True},
+        # Optimizing is a lot slower for little size savings, callers opt in
+        'png': {'optimize': False},
+        'webp': {'quality': 80, 'method': 4},
+        'avif': {'quality': 60, 'speed': 6},
+    }
+
+    # Decoding budget, checked from image header before any decoding
+    MAX_PIXELS = None
+    MAX_BYTES = None
+    OVERSIZE_POLICY = 'reject'
+    OVERSIZE_POLICIES = ('reject', 'reduce', 'tile')
+
+    # EXIF orientations swapping width and height
+    TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+    # Smart crop point of interest detector and filter used to reduce the analyzed image
+    DETECTOR = 'entropy'
+    PROXY_FILTER = None
+
+    # Formats saved with every frame of animated images
+    ANIMATED_FORMATS = ('gif', 'webp')
+    MAX_FRAMES = None
+
+    # Resampling profiles: final filter and ``reducing_gap``, the image is first reduced with a
+    # box filter (or shrunk on load) down to ``reducing_gap`` times the target size. A null gap
+    # means no reduction, None the processor default.
+    PROFILES = {
+        'fast': {'filter': 'bilinear', 'reducing_gap': 2.0},
+        'balanced': {'filter': 'antialias', 'reducing_gap': 3.0},
+        'best': {'filter': 'antialias', 'reducing_gap': 0},
+    }
+    PROFILE = None
+
+    def __init__(self, img, max_pixels=None, max_bytes=None, oversize_policy=None,
+    animated=False, max_frames=None, analysis=None, profile=None):
         if isinstance(img, six.string_types):
             self.fp = open(img, 'rb')
         elif hasattr(img, 'read'):
@@ -65,8 +148,50 @@ class BaseProcessor(object):
         else:
             raise TypeError('Processor first argument should be a path or a file descriptor.')
 
-        self.img, self.info = self._open_image(self.fp)
-        self.info['format'] = self.info['format'].lower()
+        self.max_pixels = max_pixels or self.MAX_PIXELS
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self.oversize_policy = oversize_policy or self.OVERSIZE_POLICY
+        if self.oversize_policy not in self.OVERSIZE_POLICIES:
+            raise ValueError('Invalid oversize policy "{0}".'.format(self.oversize_policy))
+        self.profile = profile or self.PROFILE
+        if self.profile is not None and self.profile not in self.PROFILES:
+            raise ValueError('Invalid resampling profile "{0}".'.format(self.profile))
+
+        self.memory_peak = 0
+        self.tiled = False
+        # Source box of a tiled crop too large to be decoded, read by the next reduction
+        self.tiled_box = None
+        self.pending_orientation = None
+        self.source = None
+        self.frame_count = 1
+        self.frame_operations = []
+        self.proxy_pixels = None
+
+        # Source image analysis results (entropy grids), shared by processors of a same source
+        self.analysis = analysis if analysis is not None else {}
+
+        try:
+            with instrumentation.measure('open') as values:
+                img, self.info = self._open_image(self.fp)
+                self.info['format'] = self.info['format'].lower()
+                img = self._check_budget(img)
+                w, h = self._get_size(img)
+                values['pixels'] = w * h
+
+            if animated and not self.tiled:
+                # Source is kept to read next frames when saving
+                self.frame_count = min(self.info.get('frames', 1),
+                    max_frames or self.MAX_FRAMES or self.info.get('frames', 1))
+                if self.frame_count > 1:
+                    self.source = img
+            if self.tiled:
+                # Source stays undecoded until a tiled operation reads it
+                self.img = img
+            else:
+                self.set_image(img)
+        except Exception:
+            self.close()
+            raise
 
     def __enter__(self):
         return self
@@ -84,15 +209,60 @@ class BaseProcessor(object):
     @property
     def size(self):
         self.assert_open()
-        return self._get_size(self.img)
+        w, h = self.get_current_size()
+        if self.pending_orientation in self.TRANSPOSED_ORIENTATIONS:
+            return h, w
+        return w, h
 
     @property
     def mode(self):
         self.assert_open()
         return self._get_mode(self.img)
 
-    def save(self, file, format=None, **options):
+    @property
+    def memory(self):
+        """
+        Estimated size in bytes of the current image pixels.
+        """
         self.assert_open()
+        if self.tiled:
+            return 0
+        return self._get_memory_size(self.img)
+
+    def set_image(self, img):
+        """
+        Replaces the current image and releases the previous one right away instead of waiting
+        for garbage collection. ``memory_peak`` is updated with both images since they are
+        alive at the same time.
+        """
+        previous = getattr(self, 'img', None)
+        if previous is img:
+            return self
+
+        if self.tiled:
+            # Previous image is the undecoded source
+            self.tiled = False
+            self.tiled_box = None
+            self.track_memory(img)
+        else:
+            self.track_memory(*[x for x in (previous, img) if x is not None])
+        self.img = img
+        self.proxy_pixels = None
+        if previous is not None and previous is not self.source:
+            self._close(previous)
+
+        return self
+
+    def track_memory(self, *images):
+        """
+        Updates ``memory_peak`` with the sum of given images sizes.
+        """
+        self.memory_peak = max(self.memory_peak, sum(self._get_memory_size(x) for x in images))
+
+    def save(self, file, format=None, **options):
+        self.assert_decoded()
+        self.apply_pending_orientation()
+        self._decode_current()
 
         filename = None
         if isinstance(file, six.string_types):
@@ -125,17 +295,46 @@ class BaseProcessor(object):
 
             options['filename'] = '{0}.{1}'.format(base, ext)
 
-        if format_ == 'jpeg':
-            options.setdefault('quality', 85)
+        format_ = (format_ or self.format).lower()
+        if format_ == 'jpg':
+            format_ = 'jpeg'
 
-        self._raw_save(self.img, format_ or self.format, **options)
+        for k, v in self.SAVE_OPTIONS.get(format_, {}).items():
+            options.setdefault(k, v)
+        options.setdefault('strip', True)
+
+        with instrumentation.measure('save', format=format_) as values:
+            fp = options.get('file') if instrumentation.listeners else None
+            start = fp.tell() if hasattr(fp, 'tell') else None
+            if self.frame_count > 1 and format_ in self.ANIMATED_FORMATS:
+                options.setdefault('loop', self.info.get('loop', 0))
+                self._raw_save_frames(self.img, self.get_frames(), format_, **options)
+            else:
+                self._raw_save(self.img, format_, **options)
+
+            if start is not None:
+                values['bytes'] = fp.tell() - start
+            elif instrumentation.listeners and 'filename' in options:
+                values['bytes'] = os.path.getsize(options['filename'])
         return self
 
+    @classmethod
+    def get_save_formats(cls):
+        """
+        Returns the set of formats the processor can write.
+        """
+        raise NotImplementedError
+
     def close(self):
         if getattr(self, 'img', None) is not None:
-            self._close(self.img)
+            if self.img is not self.source:
+                self._close(self.img)
             del(self.img)
 
+        if getattr(self, 'source', None) is not None:
+            self._close(self.source)
+            self.source = None
+
         if getattr(self, 'fp', None) is not None:
             self.fp.close()
 
@@ -159,21 +358,35 @@ class BaseProcessor(object):
         return self
 
     @operation
-    def orientation(self):
-        self.img = self._orientation(self.img)
-        return self
+    def orientation(self, defer=False):
+        """
+        Applies EXIF orientation. When deferred (always for tiled images), orientation is applied
+        on the result of the next geometric operation (crop, resize, thumbnail), usually a lot
+        smaller than the source image.
+        """
+        self.assert_open()
+        if defer or self.tiled:
+            self.pending_orientation = self._get_orientation(self.img)
+            return self
+
+        return self.set_image(self._apply('_apply_orientation', self._get_orientation(self.img)))
 
     @operation
-    def set_mode(self, mode, **options):
-        self.assert_open()
-        self.img = self._set_mode(self.img, mode, **options)
-        return self
+    def set_mode(self, mode, quantizer=None, **options):
+        """
+        Changes image mode. For palette modes, ``quantizer`` selects the palette computation
+        (see ``QUANTIZERS``) and options could be ``colors`` (default 256), ``dither`` and
+        ``sample``, the maximum size of a downscaled copy used to compute the palette.
+        """
+        self.assert_decoded()
+        if mode in ('palette', 'palettematte'):
+            options['quantizer'] = quantizer or self.DEFAULT_QUANTIZER
+        return self.set_image(self._apply('_set_mode', mode, **options))
 
     @operation
     def set_background(self, color):
-        self.assert_open()
-        self.img = self._set_background(self.img, self.color(color))
-        return self
+        self.assert_decoded()
+        return self.set_image(self._apply('_set_background', self.color(color)))
 
     @operation
     def crop(self, *args):
@@ -206,9 +419,9 @@ class BaseProcessor(object):
             # Aliases
             args = args[0:1] + aliases[args[1]]
 
-        if len(args) == 2 and args[1] == 'smart':
+        if len(args) in (2, 3) and args[1] == 'smart':
             # Smart crop, move the center to POI
-            poi = self.get_poi()
+            poi = self.get_poi(detector=args[2] if len(args) == 3 else None, ratio=args[0])
             args = args[0:1] + [poi[0] - center[0], poi[1] - center[1]]
 
         if len(args) == 4:
@@ -255,38 +468,71 @@ class BaseProcessor(object):
         else:
             raise ValueError('Invalid crop options "{0}".'.format(args))
 
-        self.img = self._crop(self.img, x1, y1, x2, y2)
-        return self
+        box = self._get_source_box(x1, y1, x2, y2)
+        if self.tiled:
+            self.analysis = None
+            self.proxy_pixels = None
+            sw, sh = self._get_size(self.img)
+            box = (max(0, box[0]), max(0, box[1]), min(sw, box[2]), min(sh, box[3]))
+            if not self.is_within_budget(self.img, (box[2] - box[0], box[3] - box[1])):
+                # Crop is read with the next reduction
+                self.tiled_box = box
+                return self
+            return self._set_oriented_image(self._tiled_crop(self.img, *box))
+
+        return self._set_oriented_image(self._apply('_crop', *box))
 
     @operation
     def resize(self, w, h, filter=None):
         self.assert_open()
-        self.img = self._resize(self.img, w, h, self.FILTERS.get(filter) or self.DEFAULT_FILTER)
-        return self
+        if self.pending_orientation in self.TRANSPOSED_ORIENTATIONS:
+            w, h = h, w
+
+        filter, reducing_gap = self.get_resampling(filter)
+        if self.tiled:
+            if not self.is_within_budget(self.img, (w, h)):
+                raise ImageTooLargeError('Size {0}x{1} exceeds processing budget.'.format(w, h))
+            return self._set_oriented_image(self._tiled_resize(self.img, w, h, filter,
+                box=self.tiled_box))
+
+        return self._set_oriented_image(self._apply('_resize', w, h, filter,
+            reducing_gap=reducing_gap))
 
     @operation
     def thumbnail(self, w, h, upscale=False, filter=None):
         self.assert_open()
-        scale = self._get_scale_size(self.img, w, h, upscale)
+        if self.pending_orientation in self.TRANSPOSED_ORIENTATIONS:
+            w, h = h, w
+
+        scale = self._get_scale_size(self.get_current_size(), w, h, upscale)
+        filter, reducing_gap = self.get_resampling(filter)
+        if self.tiled:
+            # Without scale, the image is reduced to the budget instead of fully decoded
+            return self._set_oriented_image(self._tiled_resize(self.img,
+                filter=filter,
+                box=self.tiled_box,
+                *self.get_budget_size(scale or self.get_current_size())
+            ))
+
         if scale:
-            self.img = self._resize(self.img,
-                filter=self.FILTERS.get(filter) or self.DEFAULT_FILTER,
+            self._set_oriented_image(self._apply('_resize',
+                filter=filter,
+                reducing_gap=reducing_gap,
                 *scale
-            )
+            ))
 
         return self
 
     @operation
     def rotate(self, angle):
-        self.assert_open()
-        self.img = self._rotate(self.img, angle)
-        return self
+        self.assert_decoded()
+        self.apply_pending_orientation()
+        return self.set_image(self._apply('_rotate', angle))
 
     @operation
     def add_border(self, width, color):
-        self.assert_open()
-        self.img = self._add_border(self.img, width, self.color(color))
-        return self
+        self.assert_decoded()
+        return self.set_image(self._apply('_add_border', width, self.color(color)))
 
     #
     # Utils
@@ -295,68 +541,336 @@ class BaseProcessor(object):
         if not hasattr(self, 'img'):
             raise AttributeError('Processor is closed.')
 
-    def get_histogram(self):
+    def assert_decoded(self):
         self.assert_open()
+        if self.tiled:
+            raise ImageTooLargeError(
+                'Image is too large to be decoded, use thumbnail, resize or crop first.'
+            )
+
+    def apply_pending_orientation(self):
+        if self.pending_orientation:
+            self.assert_decoded()
+            self._set_oriented_image(self.img)
+
+        return self
+
+    def get_frames(self):
+        """
+        Yields ``(image, duration)`` for each animation frame after the first one (the current
+        image). Frames are processed with the operations applied on the first one and released
+        once the consumer asks for the next frame.
+        """
+        for frame, duration in self._get_frames(self.source, self.frame_count):
+            img = frame
+            for name, args, options in self.frame_operations:
+                tmp_ = getattr(self, name)(img, *args, **options)
+                if img is not frame and tmp_ is not img:
+                    self._close(img)
+                img = tmp_
+
+            self.track_memory(*([self.img, img] + ([frame] if frame is not img else [])))
+            yield img, duration
+
+            if img is not frame:
+                self._close(img)
+
+    def get_histogram(self):
+        self.assert_decoded()
         return self._get_histogram(self.img)
 
-    def get_poi(self, size=210, zoning=None):
+    def get_poi(self, size=210, zoning=None, detector=None, ratio=None):
         """
-        Returns the image zone coordinates with most information (point of interest)
+        Returns the image zone coordinates with most information (point of interest), found by
+        ``detector`` (see ``saliency.DETECTORS``) on a copy of the image reduced to ``size``.
+        ``ratio`` is the ratio of the crop the point of interest is for.
         """
         self.assert_open()
+        detector = detector or self.DETECTOR
+        if detector == 'entropy':
+            zone = max(self.get_entropy_grid(size, zoning), key=lambda x: x[1])[0]
+            x, y = (zone[0] + zone[2]) / 2, (zone[1] + zone[3]) / 2
+        else:
+            key = 'poi-{0}-{1}-{2}'.format(detector, size, ratio and round(ratio, 4))
+            if self.analysis is not None and key in self.analysis:
+                x, y = self.analysis[key]
+            else:
+                from . import saliency
+
+                detector = saliency.get_detector(detector)
+                x, y = self.analyze(key, size, lambda pixels: detector.detect(pixels, ratio))
 
-        def get_zones(size_, zoning_):
-            result = []
-            w, rest = size_ // zoning_, size_ % zoning_
+        w, h = self.size
+        return int(x * w), int(y * h)
 
-            o = 0
-            while o < size_ - rest:
-                t_ = [o and o + 1 or o]
-                o += w
-                t_.append(o)
-                result.append(t_)
+    def get_hash(self, method='dhash', size=8, proxy_size=210):
+        """
+        Returns a perceptual hash of ``size`` x ``size`` bits as an hexadecimal string:
+        ``dhash`` (differences of adjacent pixels) or ``phash`` (low frequencies of the DCT),
+        computed on a copy of the image reduced to ``proxy_size``. Result is stored in
+        ``analysis``.
+        """
+        from . import signatures
 
-            if rest:
-                result[-1][1] += rest
-            return result
+        key = 'hash-{0}-{1}'.format(method, size)
+        return self.analyze(key, proxy_size, lambda x: signatures.get_hash(x, method, size))
 
-        zoning = zoning or (3, 3)
+    def get_colors(self, count=5, proxy_size=210):
+        """
+        Returns ``count`` dominant colors as ``((r, g, b), share)`` tuples by decreasing share,
+        computed on a copy of the image reduced to ``proxy_size``. Result is stored in
+        ``analysis``.
+        """
+        from . import signatures
 
-        img = self._copy_image(self.img)
-        scale = self._get_scale_size(img, size, size, False)
-        if scale:
-            img = self._resize(img, filter=self.DEFAULT_FILTER, *scale)
+        key = 'colors-{0}'.format(count)
+        return self.analyze(key, proxy_size, lambda x: signatures.dominant_colors(x, count))
 
-        cols = get_zones(img.size[0], zoning[0])
-        rows = get_zones(img.size[1], zoning[1])
+    def get_feature(self, name):
+        """
+        Returns the ``dhash``, ``phash`` or ``colors`` feature with default parameters.
+        """
+        return self.get_colors() if name == 'colors' else self.get_hash(name)
 
+    def analyze(self, key, size, func):
+        """
+        Returns ``analysis[key]`` or the result of ``func`` on the proxy pixels. Analyses of a same
+        image share their proxy.
+        """
+        if self.analysis is not None and key in self.analysis:
+            return self.analysis[key]
+
+        if self.proxy_pixels is None or self.proxy_pixels[0] != size:
+            img = self.get_proxy(size)
+            self.proxy_pixels = (size, self._get_array(img))
+            self._close(img)
+
+        result = func(self.proxy_pixels[1])
+        if self.analysis is not None:
+            self.analysis[key] = result
+        return result
+
+    def get_entropy_grid(self, size=210, zoning=None):
+        """
+        Returns a list of ``((x1, y1, x2, y2), entropy)`` image zones, coordinates being relative
+        to image size. Result is stored in ``analysis`` as long as the image shows the whole
+        source, next calls (from any processor given the same ``analysis``) don't read the image.
+        """
+        zoning = tuple(zoning or (3, 3))
+        key = 'grid-{0}-{1}x{2}'.format(size, *zoning)
+        if self.analysis is not None and key in self.analysis:
+            return self.analysis[key]
+
+        zones = self.compute_entropy_grid(size, zoning)
+        if self.analysis is not None:
+            self.analysis[key] = zones
+        return zones
+
+    def compute_entropy_grid(self, size, zoning):
+        img = self.get_proxy(size)
+        try:
+            from . import saliency
+            pixels = self._get_array(img)
+        except (ImportError, NotImplementedError):
+            pixels = None
+
+        if pixels is not None:
+            self._close(img)
+            return saliency.EntropyDetector(zoning).grid(pixels)
+
+        # Proxy is read once per zone
+        pw, ph = self._get_size(img)
         zones = []
 
-        for x in cols:
-            for y in rows:
-                tmp_ = self._copy_image(img)
-                coords = (x[0], y[0], x[1], y[1])
-                tmp_ = self._crop(tmp_, *coords)
-                zones.append((coords, self._get_entropy(tmp_)))
-                tmp_.close()
+        for x in get_zones(pw, zoning[0]):
+            for y in get_zones(ph, zoning[1]):
+                tmp_ = self._crop(img, x[0], y[0], x[1], y[1])
+                zones.append((
+                    (x[0] / pw, y[0] / ph, x[1] / pw, y[1] / ph),
+                    self._get_entropy(tmp_)
+                ))
+                self._close(tmp_)
+
+        self._close(img)
+        return zones
+
+    def get_resampling(self, filter=None):
+        """
+        Returns ``(filter, reducing_gap)`` from a filter or profile name, processor profile
+        (if any) being the default.
+        """
+        name = filter or self.profile
+        if name in self.PROFILES:
+            profile = self.PROFILES[name]
+            return (self.FILTERS.get(profile['filter']) or self.DEFAULT_FILTER,
+                profile.get('reducing_gap'))
+        return self.FILTERS.get(name) or self.DEFAULT_FILTER, None
+
+    def get_proxy(self, size):
+        """
+        Returns a decoded and oriented copy of the image reduced to fit in ``size``.
+        """
+        self.assert_open()
+        self._decode_current()
+        scale = self._get_scale_size(self.get_current_size(), size, size, False)
+        filter = self.PROXY_FILTER or self.DEFAULT_FILTER
+        if self.tiled:
+            img = self._tiled_resize(self.img,
+                filter=filter,
+                box=self.tiled_box,
+                *self.get_budget_size(scale or self.get_current_size())
+            )
+        elif scale:
+            img = self._resize(self.img, filter=filter, *scale)
+            self.track_memory(self.img, img)
+        else:
+            img = self._copy_image(self.img)
+            self.track_memory(self.img, img)
+
+        if self.pending_orientation:
+            tmp_ = self._apply_orientation(img, self.pending_orientation)
+            if tmp_ is not img:
+                self._close(img)
+            img = tmp_
+
+        return self._load(img)
+
+    def get_current_size(self):
+        """
+        Returns the current image size, before pending orientation.
+        """
+        if self.tiled_box is not None:
+            x1, y1, x2, y2 = self.tiled_box
+            return x2 - x1, y2 - y1
+        return self._get_size(self.img)
+
+    def is_within_budget(self, img, size=None):
+        """
+        Returns whether ``img``, or an image of the same mode of ``size``, is within budget.
+        """
+        w, h = self._get_size(img)
+        pixels = size[0] * size[1] if size else w * h
+        if self.max_pixels and pixels > self.max_pixels:
+            return False
+        if self.max_bytes and self._get_memory_size(img) * pixels / (w * h) > self.max_bytes:
+            return False
+        return True
+
+    def get_budget_size(self, size):
+        """
+        Returns ``size`` reduced, keeping its ratio, to fit in budget.
+        """
+        w, h = size
+        if self.is_within_budget(self.img, size):
+            return size
+
+        factors = []
+        if self.max_pixels:
+            factors.append((self.max_pixels / (w * h)) ** 0.5)
+        if self.max_bytes:
+            sw, sh = self._get_size(self.img)
+            factors.append((self.max_bytes * sw * sh / self._get_memory_size(self.img) /
+                (w * h)) ** 0.5)
+        factor = min(factors)
+        return max(1, int(floor(w * factor))), max(1, int(floor(h * factor)))
 
+    def _check_budget(self, img):
+        """
+        Applies oversize policy on a freshly opened (not yet decoded) image.
+        """
+        if self.is_within_budget(img):
+            return img
+
+        if self.oversize_policy == 'tile' and self._can_tile(img):
+            self.tiled = True
+            return img
+
+        # Images that can't be read by strips are reduced by their decoder when possible
+        if self.oversize_policy in ('reduce', 'tile'):
+            w, h = self._get_size(img)
+            factors = []
+            if self.max_pixels:
+                factors.append((self.max_pixels / (w * h)) ** 0.5)
+            if self.max_bytes:
+                factors.append((self.max_bytes / self._get_memory_size(img)) ** 0.5)
+
+            img = self._reduce_on_load(img, int(ceil(1 / min(factors))))
+            if self.is_within_budget(img):
+                return img
+
+        w, h = self._get_size(img)
         self._close(img)
-        zones.sort(key=lambda x: x[1], reverse=True)
+        raise ImageTooLargeError('Image size {0}x{1} exceeds processing budget.'.format(w, h))
+
+    def _apply(self, name, *args, **options):
+        """
+        Calls image method ``name`` on current image, recording it for next animation frames.
+        """
+        if self.source is not None:
+            self.frame_operations.append((name, args, options))
+        # Analysis results don't match image content anymore, unless it is only scaled (or
+        # oriented without transformation)
+        if name != '_resize' and not (name == '_apply_orientation' and args[0] in (None, 1)):
+            self.analysis = None
+        self._decode_current(name, *args, **options)
+        return getattr(self, name)(self.img, *args, **options)
+
+    def _decode_current(self, name=None, *args, **options):
+        """
+        Decodes the current image if it is not yet, measured as ``decode`` phase, so that next
+        operation (image method ``name`` called with ``args`` and ``options``) is measured on
+        its own.
+        """
+        if self.tiled or self._is_decoded(self.img):
+            return
+
+        with instrumentation.measure('decode') as values:
+            self._decode(self.img, name, *args, **options)
+            w, h = self._get_size(self.img)
+            values['pixels'] = w * h
+
+    def _set_oriented_image(self, img):
+        """
+        Replaces current image and applies pending orientation on it.
+        """
+        orientation, self.pending_orientation = self.pending_orientation, None
+        self.set_image(img)
+        if orientation:
+            # Analyses were computed on oriented proxies, they still match the image
+            analysis = self.analysis
+            self.set_image(self._apply('_apply_orientation', orientation))
+            self.analysis = analysis
 
-        w, h = self._get_size(self.img)
-        ratio = max(w, h) / size
-        zone = tuple(int(x * ratio) for x in zones[0][0])
-        return (
-            (zone[2] - zone[0]) // 2 + zone[0],
-            (zone[3] - zone[1]) // 2 + zone[1],
-        )
+        return self
 
-    def _get_scale_size(self, img, w, h, upscale=False):
+    def _get_source_box(self, x1, y1, x2, y2):
+        """
+        Returns box coordinates in the source image from box in the oriented image.
+        """
+        o = self.pending_orientation
+        w, h = self.get_current_size()
+        ox, oy = (self.tiled_box or (0, 0))[0:2]
+
+        def source(x, y):
+            return {
+                2: (w - x, y),
+                3: (w - x, h - y),
+                4: (x, h - y),
+                5: (y, x),
+                6: (y, h - x),
+                7: (w - y, h - x),
+                8: (w - y, x),
+            }.get(o, (x, y))
+
+        (sx1, sy1), (sx2, sy2) = source(x1, y1), source(x2, y2)
+        return min(sx1, sx2) + ox, min(sy1, sy2) + oy, max(sx1, sx2) + ox, max(sy1, sy2) + oy
+
+    def _get_scale_size(self, size, w, h, upscale=False):
         factors = []
         if w not in (None, '', 0):
-            factors.append(w / img.size[0])
+            factors.append(w / size[0])
         if h not in (None, '', 0):
-            factors.append(h / img.size[1])
+            factors.append(h / size[1])
 
         if len(factors) == 0:
             return
@@ -364,7 +878,7 @@ class BaseProcessor(object):
         factor = min(factors)
 
         if upscale or factor < 1:
-            return tuple(int(floor(x * factor)) for x in img.size)
+            return tuple(int(floor(x * factor)) for x in size)
 
     def _get_color(self, color):
         """
@@ -412,9 +926,34 @@ class BaseProcessor(object):
     def _raw_save(self, img, format, **options):
         raise NotImplementedError
 
+    def _raw_save_frames(self, img, frames, format, **options):
+        """
+        Saves an animation from the first frame ``img`` and a ``(image, duration)`` iterator of
+        next frames.
+        """
+        raise NotImplementedError
+
+    def _get_frames(self, img, count):
+        """
+        Yields ``(frame, duration)`` for source frames 1 to ``count - 1``.
+        """
+        raise NotImplementedError
+
+    def _reduce_on_load(self, img, factor):
+        """
+        Asks decoder for an image reduced by at least ``factor``, if format supports it.
+        """
+        return img
+
     def _close(self, img):
         raise NotImplementedError
 
+    def _load(self, img):
+        """
+        Decodes image pixels (if needed) and returns the image.
+        """
+        return img
+
     def _copy_image(self, img):
         raise NotImplementedError
 
@@ -424,9 +963,41 @@ class BaseProcessor(object):
     def _orientation(self, img):
         raise NotImplementedError
 
+    def _get_orientation(self, img):
+        raise NotImplementedError
+
+    def _apply_orientation(self, img, orientation):
+        raise NotImplementedError
+
+    def _is_decoded(self, img):
+        # Images are decoded by operations unless the processor says otherwise
+        return True
+
+    def _decode(self, img, name=None, *args, **options):
+        """
+        Decodes ``img`` in place, before image method ``name`` is called with ``args`` and
+        ``options``.
+        """
+        raise NotImplementedError
+
+    def _can_tile(self, img):
+        return False
+
+    def _tiled_resize(self, img, w, h, filter, box=None):
+        """
+        Resizes the ``box`` region (whole image by default) of an undecoded image.
+        """
+        raise NotImplementedError
+
+    def _tiled_crop(self, img, x1, y1, x2, y2):
+        raise NotImplementedError
+
     def _get_mode(self, img):
         raise NotImplementedError
 
+    def _get_memory_size(self, img):
+        raise NotImplementedError
+
     def _set_mode(self, img, mode, **options):
         raise NotImplementedError
 
@@ -436,7 +1007,7 @@ class BaseProcessor(object):
     def _crop(self, img, x1, y1, x2, y2):
         raise NotImplementedError
 
-    def _resize(self, img, w, h, filter):
+    def _resize(self, img, w, h, filter, reducing_gap=None):
         raise NotImplementedError
 
     def _rotate(self, img, angle):
@@ -447,3 +1018,9 @@ class BaseProcessor(object):
 
     def _get_histogram(self, img):
         raise NotImplementedError
+
+    def _get_array(self, img):
+        """
+        Returns image pixels as a NumPy array of ``(height, width[, bands])`` bytes.
+        """
+        raise NotImplementedError
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Animated images writing with Pillow.
+
+Frames are received one at a time from an iterator and encoded right away, so only one frame is
+alive at once. GIF frames share the palette computed on the first frame, frames whose colors
+are too far from it get a palette of their own.
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from PIL import Image, ImageChops, ImageStat, GifImagePlugin
+
+# Mean color difference (0 to 255) above which a GIF frame does not use the shared palette
+MAX_PALETTE_ERROR = 8
+
+
+class FrameSequence(object):
+    """
+    Multi-frame image like object, producing frames from an iterator when seeked. Pillow reads
+    ``append_images`` items this way, one frame after the other.
+    """
+    def __init__(self, frames, count, durations):
+        self.frames = frames
+        self.n_frames = count
+        self.durations = durations
+        self.frame = None
+
+    def seek(self, index):
+        self.frame, duration = next(self.frames)
+        self.durations.append(duration)
+
+    def load(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.frame, name)
+
+
+def get_alpha(img):
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        return img.getchannel('A')
+
+
+def to_palette(img, palette, transparency, dither):
+    """
+    Maps an image on ``palette``, transparent pixels get the ``transparency`` index.
+    """
+    alpha = get_alpha(img)
+    rgb = img if img.mode == 'RGB' else img.convert('RGB')
+    result = rgb.quantize(palette=palette, dither=dither)
+    if rgb is not img:
+        rgb.close()
+
+    if alpha is not None:
+        mask = alpha.point(lambda x: 255 if x < 128 else 0)
+        has_transparency = mask.getbbox() is not None
+        if has_transparency:
+            result.paste(transparency, mask=mask)
+        mask.close()
+        alpha.close()
+        if has_transparency:
+            result.info['transparency'] = transparency
+
+    return result
+
+
+def get_palette(rgb, quantize):
+    """
+    Returns ``(palette image, transparency index)`` for an RGB image.
+    """
+    palette = quantize(rgb)
+    colors = palette.getpalette()[0:765]
+    palette.putpalette(colors + [0, 0, 0])
+    return palette, len(colors) // 3
+
+
+def get_palette_error(rgb, palette):
+    """
+    Returns the mean difference between a reduced copy of an RGB image and its colors on
+    ``palette``.
+    """
+    sample = rgb.copy()
+    sample.thumbnail((64, 64))
+    mapped = sample.quantize(palette=palette, dither=Image.NONE)
+    mapped_rgb = mapped.convert('RGB')
+    diff = ImageChops.difference(sample, mapped_rgb)
+    result = sum(ImageStat.Stat(diff).mean) / 3
+    for x in (sample, mapped, mapped_rgb, diff):
+        x.close()
+    return result
+
+
+def write_gif(fp, frames, quantize, loop=0, dither=True):
+    """
+    Writes a GIF animation from a ``(image, duration)`` iterator. ``quantize`` returns a palette
+    image of 255 colors at most for an RGB image, an extra palette entry is added for transparent
+    pixels. Palette of the first frame is shared by next frames, unless their colors are too far
+    from it: they get a local palette.
+    """
+    dither = Image.FLOYDSTEINBERG if dither else Image.NONE
+    shared = None
+
+    for frame_index, (img, duration) in enumerate(frames):
+        rgb = img if img.mode == 'RGB' else img.convert('RGB')
+        palette = shared
+        if palette is None or get_palette_error(rgb, palette[0]) > MAX_PALETTE_ERROR:
+            palette = get_palette(rgb, quantize)
+            if shared is None:
+                shared = palette
+        if rgb is not img:
+            rgb.close()
+
+        frame = to_palette(img, palette[0], palette[1], dither)
+        params = {'duration': duration or 0, 'include_color_table': palette is not shared}
+        if palette is not shared:
+            palette[0].close()
+        if 'transparency' in frame.info:
+            # Frames are not composed, previous one is cleared before drawing
+            params.update(transparency=palette[1], disposal=2)
+
+        if frame_index == 0:
+            header, _ = GifImagePlugin.getheader(frame, info={'loop': loop})
+            for data in header:
+                fp.write(data)
+
+        for data in GifImagePlugin.getdata(frame, **params):
+            fp.write(data)
+        frame.close()
+
+    if shared is not None:
+        shared[0].close()
+    fp.write(b';')
@@ -4,9 +4,16 @@
 # See the LICENSE for more information.
 from __future__ import (print_function, division, absolute_import, unicode_literals)
 
-from PIL import Image, ImageColor, ExifTags
+from itertools import chain
+import threading
 
-from .base import BaseProcessor
+from PIL import Image, ImageColor
+
+from . import pillow_tiles
+from .base import BaseProcessor, ImageTooLargeError
+
+# Serializes changes of Pillow global decompression bomb limit
+bomb_limit_lock = threading.Lock()
 
 
 class Processor(BaseProcessor):
@@ -18,6 +25,9 @@ class Processor(BaseProcessor):
     }
     DEFAULT_FILTER = Image.ANTIALIAS
 
+    # Box filter is a lot faster and good enough for smart crop analysis
+    PROXY_FILTER = Image.BOX
+
     MODES = {
         'bilevel': '1',
         'grayscale': 'L',
@@ -29,20 +39,148 @@ class Processor(BaseProcessor):
         'colorseparation': 'CMYK',
     }
 
+    # "adaptive" is the legacy median cut conversion, "auto" uses libimagequant when Pillow has
+    # been built with it and fast octree otherwise.
+    QUANTIZERS = ('adaptive', 'auto', 'mediancut', 'octree', 'libimagequant')
+    DEFAULT_QUANTIZER = 'auto'
+
+    QUANTIZE_METHODS = {
+        'mediancut': Image.MEDIANCUT,
+        'octree': Image.FASTOCTREE,
+        'libimagequant': Image.LIBIMAGEQUANT,
+    }
+
+    # EXIF orientation to transposition
+    ORIENTATIONS = {
+        2: Image.FLIP_LEFT_RIGHT,
+        3: Image.ROTATE_180,
+        4: Image.FLIP_TOP_BOTTOM,
+        5: Image.TRANSPOSE,
+        6: Image.ROTATE_270,
+        7: Image.TRANSVERSE,
+        8: Image.ROTATE_90,
+    }
+
+    # Modes JPEG encoder accepts, other ones are converted once when saving
+    JPEG_MODES = ('1', 'L', 'RGB', 'CMYK')
+
+    # Pillow stores multi-band pixels on 4 bytes
+    BYTES_PER_PIXEL = {
+        '1': 1,
+        'L': 1,
+        'P': 1,
+        'I;16': 2,
+        'I;16B': 2,
+        'I;16L': 2,
+    }
+
     def _open_image(self, fp):
-        img = Image.open(fp)
+        try:
+            if self.max_pixels or self.max_bytes:
+                # Processor budget replaces Pillow limit, checked once header is read
+                with bomb_limit_lock:
+                    limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+                    try:
+                        img = Image.open(fp)
+                    finally:
+                        Image.MAX_IMAGE_PIXELS = limit
+            else:
+                img = Image.open(fp)
+        except Image.DecompressionBombError as e:
+            raise ImageTooLargeError(e)
 
         info = {
-            'format': img.format
+            'format': img.format,
+            'frames': getattr(img, 'n_frames', 1),
+            'duration': img.info.get('duration', 0),
         }
+        if 'loop' in img.info:
+            info['loop'] = img.info['loop']
         return img, info
 
+    def _reduce_on_load(self, img, factor):
+        # Only JPEG supports draft mode (DCT scaling by 1/2, 1/4 or 1/8), other formats
+        # keep their size.
+        scale = 1
+        while scale < factor and scale < 8:
+            scale *= 2
+
+        w, h = img.size
+        img.draft(img.mode, (max(1, w // scale), max(1, h // scale)))
+        return img
+
     def _close(self, img):
         img.close()
 
+    def _load(self, img):
+        img.load()
+        return img
+
     def _raw_save(self, img, format, **options):
         fp = options.pop('file', None) or options.pop('filename')
-        img.save(fp=fp, format=format.upper(), **options)
+
+        # Single conversion to a mode the format supports, alpha is flattened as with libvips
+        saved = img
+        if format == 'jpeg' and img.mode not in self.JPEG_MODES:
+            if self._has_alpha(img):
+                saved = self._set_background(img, (0, 0, 0))
+            if saved.mode not in self.JPEG_MODES:
+                tmp_ = saved.convert('L' if saved.mode in ('I', 'I;16', 'F') else 'RGB')
+                if saved is not img:
+                    saved.close()
+                saved = tmp_
+
+        # Pillow does not write EXIF unless asked to
+        if img.info.get('icc_profile'):
+            options.setdefault('icc_profile', img.info['icc_profile'])
+        if not options.pop('strip') and img.info.get('exif'):
+            options.setdefault('exif', img.info['exif'])
+
+        saved.save(fp=fp, format=format.upper(), **options)
+        if saved is not img:
+            saved.close()
+
+    def _raw_save_frames(self, img, frames, format, **options):
+        # Loaded on first use, it imports GIF plugin
+        from . import pillow_frames
+
+        # Some decoders only set duration once frame is loaded
+        duration = self.source.info.get('duration', self.info['duration'])
+        if format == 'gif':
+            fp = options.pop('file', None)
+            if fp is None:
+                with open(options['filename'], 'wb') as fp:
+                    return self._raw_save_frames(img, frames, format, file=fp, **options)
+
+            # Palette of the first frame is shared by similar frames
+            def quantize(x):
+                return self._quantize(x, False, self.DEFAULT_QUANTIZER, 255, sample=256)
+
+            pillow_frames.write_gif(fp, chain([(img, duration)], frames), quantize,
+                options.get('loop', 0), options.get('dither', True))
+            return
+
+        # Animation is encoded frame by frame while reading the sequence
+        if getattr(img, 'n_frames', 1) > 1:
+            img = img.copy()
+        durations = [duration]
+        options.update(
+            save_all=True,
+            append_images=[pillow_frames.FrameSequence(frames, self.frame_count - 1, durations)],
+            duration=durations,
+        )
+        self._raw_save(img, format, **options)
+
+    def _get_frames(self, img, count):
+        for i in range(1, count):
+            img.seek(i)
+            img.load()
+            yield img, img.info.get('duration', 0)
+
+    @classmethod
+    def get_save_formats(cls):
+        Image.init()
+        return set(x.lower() for x in Image.SAVE)
 
     def _copy_image(self, img):
         return img.copy()
@@ -62,58 +200,209 @@ class Processor(BaseProcessor):
     def _get_size(self, img):
         return img.size
 
+    def _get_memory_size(self, img):
+        w, h = img.size
+        return w * h * self.BYTES_PER_PIXEL.get(img.mode, 4)
+
     def _get_mode(self, img):
         return dict((v, k) for k, v in self.MODES.items())[img.mode]
 
     def _set_mode(self, img, mode, **options):
+        quantizer = options.pop('quantizer', None)
+        if quantizer not in (None, 'adaptive'):
+            return self._quantize(img, mode == 'palettematte', quantizer, **options)
+
         options.setdefault('palette', Image.ADAPTIVE)
+        options.pop('sample', None)
+        if 'dither' in options:
+            options['dither'] = Image.FLOYDSTEINBERG if options['dither'] else Image.NONE
 
         mode = self.MODES[mode]
         return img.convert(mode, **options)
 
+    def _quantize(self, img, matte, quantizer, colors=256, dither=True, sample=None):
+        if quantizer not in self.QUANTIZERS:
+            raise ValueError('Invalid quantizer "{0}".'.format(quantizer))
+
+        from PIL import features
+
+        if quantizer == 'auto':
+            quantizer = 'octree'
+            if features.check_feature('libimagequant'):
+                quantizer = 'libimagequant'
+        elif quantizer == 'libimagequant' and not features.check_feature('libimagequant'):
+            raise ValueError('Pillow is not built with libimagequant.')
+
+        # Median cut does not support alpha channel
+        if matte and quantizer == 'mediancut':
+            quantizer = 'octree'
+
+        method = self.QUANTIZE_METHODS[quantizer]
+        source = img.convert('RGBA' if matte else 'RGB') if img.mode not in ('RGB', 'L') or matte \
+            else img
+        dither = Image.FLOYDSTEINBERG if dither else Image.NONE
+
+        if sample and not matte and max(source.size) > sample:
+            # Palette is computed on a downscaled copy, then full image is mapped on it
+            small = source.copy()
+            small.thumbnail((sample, sample), Image.BOX)
+            palette = small.quantize(colors, method)
+            result = source.quantize(colors, palette=palette, dither=dither)
+            small.close()
+            palette.close()
+        else:
+            result = source.quantize(colors, method, dither=dither)
+
+        if source is not img:
+            source.close()
+
+        # Alpha, if any, is in the palette now
+        result.info.pop('transparency', None)
+        return result
+
     def _orientation(self, img):
-        exif = self._get_exif(img)
+        return self._apply_orientation(img, self._get_orientation(img))
 
+    def _get_orientation(self, img):
+        exif = self._get_exif(img)
         if exif is None:
+            return None
+
+        return exif.get(0x0112)
+
+    def _apply_orientation(self, img, orientation):
+        # Lossless transpositions, no resampling involved
+        method = self.ORIENTATIONS.get(orientation)
+        if method is None:
             return img
 
-        orientation = exif.get(0x0112)
-
-        if orientation == 2:
-            img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 3:
-            img = img.rotate(180)
-        elif orientation == 4:
-            img = img.transpose(Image.FLIP_TOP_BOTTOM)
-        elif orientation == 5:
-            img = img.rotate(-90).transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 6:
-            img = img.rotate(-90)
-        elif orientation == 7:
-            img = img.rotate(90).transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 8:
-            img = img.rotate(90)
+        result = img.transpose(method)
+        if 'exif' in img.info:
+            # Saved image should not be rotated again by viewers
+            exif = img.getexif()
+            del exif[0x0112]
+            result.info['exif'] = exif.tobytes()
 
-        return img
+        return result
 
     def _set_background(self, img, color):
-        bg = Image.new('RGBA', self.img.size, color)
-        bg.paste(self.img, mask=self.img)
+        if not self._has_alpha(img):
+            return img
+
+        if len(color) > 3 and color[3] < 255:
+            src = img.convert('RGBA')
+            result = Image.alpha_composite(Image.new('RGBA', img.size, tuple(color)), src)
+            src.close()
+            return result
+
+        # Result has no alpha, grayscale images stay grayscale on a gray background
+        mode = 'L' if img.mode == 'LA' and color[0] == color[1] == color[2] else 'RGB'
+        src = img if img.mode in ('LA', 'RGBA') else img.convert('RGBA')
+        alpha = src.getchannel('A')
+        bands = src if mode == 'RGB' else src.getchannel('L')
+        bg = Image.new(mode, img.size, self._get_canvas_color(img, mode, color))
+        bg.paste(bands, mask=alpha)
+        for x in (alpha, bands, src):
+            if x is not img:
+                x.close()
         return bg
 
+    def _can_tile(self, img):
+        return pillow_tiles.get_strip_reader(img) is not None
+
+    def _tiled_resize(self, img, w, h, filter, box=None):
+        reader = pillow_tiles.get_strip_reader(img)
+        if box is not None:
+            reader = pillow_tiles.CropReader(reader, box)
+        return pillow_tiles.resize(reader, w, h, filter, self.track_memory)
+
+    def _tiled_crop(self, img, x1, y1, x2, y2):
+        return pillow_tiles.crop(pillow_tiles.get_strip_reader(img), x1, y1, x2, y2,
+            self.track_memory)
+
     def _crop(self, img, x1, y1, x2, y2):
         return img.crop((x1, y1, x2, y2))
 
-    def _resize(self, img, w, h, filter=None):
-        return img.resize((w, h), filter)
+    def _is_decoded(self, img):
+        # Decoder tiles are cleared once loaded
+        return not getattr(img, 'tile', None)
+
+    def _decode(self, img, name=None, *args, **options):
+        reducing_gap = options.get('reducing_gap')
+        if name == '_resize' and reducing_gap:
+            # JPEG images are scaled by the decoder
+            w, h = args[0:2]
+            img.draft(img.mode, (int(w * reducing_gap), int(h * reducing_gap)))
+        img.load()
+
+    def _resize(self, img, w, h, filter=None, reducing_gap=None):
+        return img.resize((w, h), filter, reducing_gap=reducing_gap or None)
 
     def _rotate(self, img, angle):
         return img.rotate(-angle, resample=Image.BICUBIC, expand=True)
 
     def _add_border(self, img, width, color):
-        bg = Image.new('RGBA', [sum(x) for x in zip(img.size, [width * 2] * 2)], color)
-        bg.paste(img, (width,) * 2)
+        mode = self._get_canvas_mode(img, color)
+        bg = Image.new(mode, [sum(x) for x in zip(img.size, [width * 2] * 2)],
+            self._get_canvas_color(img, mode, color))
+        if mode == 'P':
+            bg.putpalette(img.getpalette())
+            if 'transparency' in img.info:
+                bg.info['transparency'] = img.info['transparency']
+
+        src = img if img.mode == mode else img.convert(mode)
+        bg.paste(src, (width,) * 2)
+        if src is not img:
+            src.close()
         return bg
 
+    def _has_alpha(self, img):
+        return img.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in img.info
+
+    def _get_palette_index(self, img, color):
+        palette = img.getpalette() or []
+        for i in range(len(palette) // 3):
+            if tuple(palette[i * 3:i * 3 + 3]) == tuple(color[0:3]) \
+            and i != img.info.get('transparency'):
+                return i
+        return None
+
+    def _get_canvas_mode(self, img, color):
+        """
+        Returns the narrowest mode holding both image and an area of ``color``: L or LA for gray
+        colors on grayscale images, P when color is in the image palette, RGB or RGBA otherwise.
+        """
+        alpha = len(color) > 3 and color[3] < 255
+        if img.mode in ('1', 'L', 'LA') and color[0] == color[1] == color[2]:
+            return 'LA' if alpha or img.mode == 'LA' else 'L'
+        if img.mode == 'P' and not alpha and self._get_palette_index(img, color) is not None:
+            return 'P'
+        if alpha or self._has_alpha(img):
+            return 'RGBA'
+        return 'RGB'
+
+    def _get_canvas_color(self, img, mode, color):
+        alpha = color[3] if len(color) > 3 else 255
+        return {
+            'L': lambda: color[0],
+            'LA': lambda: (color[0], alpha),
+            'P': lambda: self._get_palette_index(img, color),
+            'RGB': lambda: tuple(color[0:3]),
+            'RGBA': lambda: tuple(color[0:3]) + (alpha,),
+        }[mode]()
+
     def _get_histogram(self, img):
         return img.histogram()
+
+    def _get_array(self, img):
+        import numpy
+
+        # Pixels are gray or RGB values, with alpha as the last band
+        if img.mode in ('P', 'PA'):
+            alpha = img.mode == 'PA' or 'transparency' in img.info
+            img = img.convert('RGBA' if alpha else 'RGB')
+        elif img.mode in ('La', 'RGBa'):
+            img = img.convert(img.mode.upper())
+        elif img.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+            img = img.convert('RGB' if len(img.getbands()) >= 3 else 'L')
+        return numpy.asarray(img)
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Strip based processing of large images with Pillow.
+
+Sources are read by horizontal strips of rows that are decoded, reduced and assembled one at a
+time. Only uncompressed ("raw") images (BMP, PPM, uncompressed TIFF...) and non interlaced 8 bits
+PNG files can be read this way.
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from math import ceil
+import struct
+import zlib
+
+from PIL import Image
+
+# Number of source pixels decoded at once
+STRIP_PIXELS = 2 * 1024 * 1024
+
+PNG_RAWMODES = ('L', 'LA', 'P', 'RGB', 'RGBA')
+
+
+class StripReader(object):
+    def __init__(self, img):
+        self.img = img
+        self.fp = img.fp
+        self.size = img.size
+        self.mode = img.mode
+
+    def strips(self, rows, start=0, stop=None):
+        """
+        Yields ``(y, strip)`` tuples, with strips of ``rows`` rows covering the ``start``,
+        ``stop`` range. First strip could start before ``start``.
+        """
+        raise NotImplementedError
+
+    def _finish(self, strip):
+        # Palette images can't be resampled, expand them
+        if strip.mode == 'P':
+            rawmode, palette = self.img.palette.getdata()
+            strip.putpalette(palette, rawmode)
+            if 'transparency' in self.img.info:
+                strip.info['transparency'] = self.img.info['transparency']
+                return strip.convert('RGBA')
+            return strip.convert('RGB')
+
+        return strip
+
+
+class RawStripReader(StripReader):
+    def __init__(self, img, segments):
+        super(RawStripReader, self).__init__(img)
+        self.segments = segments
+
+    def strips(self, rows, start=0, stop=None):
+        w, h = self.size
+        stop = min(stop or h, h)
+
+        for y in range(start, stop, rows):
+            n = min(rows, h - y)
+            strip = Image.new(self.mode, (w, n))
+            for x0, y0, x1, y1, offset, rawmode, stride, orientation in self.segments:
+                a, b = max(y, y0), min(y + n, y1)
+                if a >= b:
+                    continue
+
+                if orientation < 0:
+                    self.fp.seek(offset + (y1 - b) * stride)
+                else:
+                    self.fp.seek(offset + (a - y0) * stride)
+
+                part = Image.frombytes(self.mode, (x1 - x0, b - a), self.fp.read((b - a) * stride),
+                    'raw', rawmode, stride, orientation)
+                strip.paste(part, (x0, a - y))
+                part.close()
+
+            yield y, self._finish(strip)
+
+
+class PngStripReader(StripReader):
+    def __init__(self, img):
+        super(PngStripReader, self).__init__(img)
+        self.offset = img.tile[0][2]
+        self.rawmode = img.tile[0][3]
+        self.stride = self.size[0] * Image.getmodebands(self.rawmode)
+
+    def strips(self, rows, start=0, stop=None):
+        # Rows are filtered against previous ones, every row before "stop" has to be decoded.
+        w, h = self.size
+        stop = min(stop or h, h)
+        inflater = Inflater(self._read_idat())
+        previous = None
+
+        for y in range(0, stop, rows):
+            n = min(rows, h - y)
+            data = inflater.read(n * (self.stride + 1))
+
+            # Previous unfiltered row is prepended (with no filter) to decode the first one
+            if previous is not None:
+                data = b'\x00' + previous + data
+
+            strip = Image.frombytes(self.mode, (w, n + (previous is not None)),
+                zlib.compress(data, 0), 'zip', self.rawmode)
+            del data
+
+            if previous is not None:
+                tmp_ = strip.crop((0, 1, w, n + 1))
+                strip.close()
+                strip = tmp_
+
+            previous = strip.crop((0, n - 1, w, n)).tobytes('raw', self.rawmode)
+            if y + n > start:
+                yield y, self._finish(strip)
+            else:
+                strip.close()
+
+    def _read_idat(self):
+        fp = self.fp
+        fp.seek(self.offset - 8)
+        while True:
+            length, cid = struct.unpack('>I4s', fp.read(8))
+            if cid != b'IDAT':
+                return
+
+            while length:
+                chunk = fp.read(min(length, 65536))
+                if not chunk:
+                    return
+                length -= len(chunk)
+                yield chunk
+
+            fp.read(4)  # CRC
+
+
+class CropReader(object):
+    """
+    Reads the ``(x1, y1, x2, y2)`` box of another reader by strips, rows and columns outside the
+    box are dropped as soon as they are decoded.
+    """
+    def __init__(self, reader, box):
+        self.reader = reader
+        self.box = box
+        self.size = (box[2] - box[0], box[3] - box[1])
+        self.mode = reader.mode
+
+    def strips(self, rows, start=0, stop=None):
+        x1, y1, x2, y2 = self.box
+        stop = min(stop or self.size[1], self.size[1])
+
+        # Source strips are not aligned on the box, they are cut and pasted into strips of
+        # "rows" rows starting at "start"
+        y, result, filled = start, None, 0
+        source_rows = max(1, STRIP_PIXELS // self.reader.size[0])
+        for sy, strip in self.reader.strips(source_rows, y1 + start, y1 + stop):
+            a, b = max(sy, y1 + y + filled), min(sy + strip.size[1], y1 + stop)
+            while a < b:
+                if result is None:
+                    result = Image.new(strip.mode, (x2 - x1, min(rows, stop - y)))
+                n = min(b - a, result.size[1] - filled)
+                part = strip.crop((x1, a - sy, x2, a - sy + n))
+                result.paste(part, (0, filled))
+                part.close()
+                filled += n
+                a += n
+                if filled == result.size[1]:
+                    yield y, result
+                    y += filled
+                    result, filled = None, 0
+            strip.close()
+
+
+class Inflater(object):
+    """
+    Decompresses a stream of zlib chunks on demand.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.decompressor = zlib.decompressobj()
+        self.pending = b''
+
+    def read(self, size):
+        result = []
+        while size > 0:
+            if not self.pending:
+                self.pending = next(self.chunks, b'')
+                if not self.pending:
+                    raise IOError('Truncated image data.')
+
+            data = self.decompressor.decompress(self.pending, size)
+            self.pending = self.decompressor.unconsumed_tail
+            result.append(data)
+            size -= len(data)
+
+        return b''.join(result)
+
+
+def get_strip_reader(img):
+    """
+    Returns a strip reader for a freshly opened image or None if image can't be read by strips.
+    """
+    if not getattr(img, 'fp', None) or not img.tile:
+        return None
+
+    if img.format == 'PNG':
+        if len(img.tile) == 1 and img.tile[0][0] == 'zip' and img.tile[0][1] == (0, 0) + img.size \
+        and img.tile[0][3] in PNG_RAWMODES and img.tile[0][3] == img.mode \
+        and not img.info.get('interlace'):
+            return PngStripReader(img)
+        return None
+
+    segments = []
+    area = 0
+    for decoder, extents, offset, args in img.tile:
+        if decoder != 'raw':
+            return None
+
+        if not isinstance(args, tuple):
+            args = (args,)
+        rawmode, stride, orientation = (args + (0, 1))[0:3]
+        x0, y0, x1, y1 = extents
+        if not stride:
+            try:
+                stride = len(Image.new(img.mode, (x1 - x0, 1)).tobytes('raw', rawmode))
+            except (ValueError, KeyError):
+                return None
+
+        area += (x1 - x0) * (y1 - y0)
+        segments.append((x0, y0, x1, y1, offset, rawmode, stride, orientation))
+
+    # Planar images (one tile per band) are not supported
+    if area != img.size[0] * img.size[1]:
+        return None
+
+    return RawStripReader(img, segments)
+
+
+def resize(reader, w, h, filter, track=None):
+    """
+    Resizes image by strips. Each strip is box-reduced by an integer factor keeping at least
+    twice the final size, then the assembled reduced image is resized with ``filter``.
+    """
+    sw, sh = reader.size
+    factor = max(1, min(sw // (w * 2), sh // (h * 2)))
+    rows = max(1, STRIP_PIXELS // sw // factor) * factor
+
+    reduced = None
+    for y, strip in reader.strips(rows):
+        part = strip.reduce(factor) if factor > 1 else strip
+        if reduced is None:
+            reduced = Image.new(part.mode, (int(ceil(sw / factor)), int(ceil(sh / factor))))
+        reduced.paste(part, (0, y // factor))
+
+        if track:
+            track(strip, reduced, *([part] if part is not strip else []))
+        part.close()
+        strip.close()
+
+    if reduced.size == (w, h):
+        return reduced
+
+    result = reduced.resize((w, h), filter)
+    if track:
+        track(reduced, result)
+    reduced.close()
+    return result
+
+
+def crop(reader, x1, y1, x2, y2, track=None):
+    """
+    Crops image by strips, rows outside crop box are never kept in memory.
+    """
+    sw, sh = reader.size
+    x1, y1 = max(0, x1), max(0, y1)
+    x2, y2 = min(sw, x2), min(sh, y2)
+    rows = max(1, STRIP_PIXELS // sw)
+
+    result = None
+    for y, strip in reader.strips(rows, y1, y2):
+        a, b = max(y, y1), min(y + strip.size[1], y2)
+        if a < b:
+            part = strip.crop((x1, a - y, x2, b - y))
+            if result is None:
+                result = Image.new(part.mode, (x2 - x1, y2 - y1))
+            result.paste(part, (0, a - y1))
+            if track:
+                track(strip, part, result)
+            part.close()
+        strip.close()
+
+    return result
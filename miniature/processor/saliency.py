@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Point of interest detectors for smart crops.
+
+Detectors work on the pixels of a small proxy image, given as a NumPy array of
+``(height, width[, bands])`` bytes, and return the point of interest coordinates relative to
+image size.
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import sys
+
+import numpy
+
+from .base import get_zones
+
+
+def luminance(pixels):
+    """
+    Returns a float luminance array, alpha band is ignored.
+    """
+    pixels = numpy.asarray(pixels, dtype=numpy.float32)
+    if pixels.ndim == 2:
+        return pixels
+    if pixels.shape[2] < 3:
+        return pixels[:, :, 0]
+    return pixels[:, :, 0] * 0.299 + pixels[:, :, 1] * 0.587 + pixels[:, :, 2] * 0.114
+
+
+def gradient(values):
+    """
+    Returns gradient magnitude (sum of absolute horizontal and vertical differences).
+    """
+    result = numpy.zeros_like(values)
+    result[:, 1:] += numpy.abs(numpy.diff(values, axis=1))
+    result[1:, :] += numpy.abs(numpy.diff(values, axis=0))
+    return result
+
+
+def integral(values):
+    """
+    Returns the summed area table of ``values``, with a leading row and column of zeros.
+    """
+    result = numpy.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=numpy.float64)
+    numpy.cumsum(numpy.cumsum(values, axis=0), axis=1, out=result[1:, 1:])
+    return result
+
+
+def window_sums(table, w, h):
+    """
+    Returns the sums of every ``w`` x ``h`` window from a summed area table, indexed by window
+    top-left position.
+    """
+    return table[h:, w:] - table[:-h, w:] - table[h:, :-w] + table[:-h, :-w]
+
+
+def window_size(shape, ratio=None):
+    """
+    Returns the largest window of ``ratio`` fitting in an array, a third of it without ratio.
+    """
+    h, w = shape[0:2]
+    if not ratio:
+        return max(1, w // 3), max(1, h // 3)
+    if ratio > w / h:
+        return w, max(1, min(h, int(round(w / ratio))))
+    return max(1, min(w, int(round(h * ratio)))), h
+
+
+def best_window(sums, w, h, shape):
+    """
+    Returns the relative center of the window with highest sum, image center when every window
+    has the same score.
+    """
+    if sums.max() == sums.min():
+        return 0.5, 0.5
+
+    y, x = numpy.unravel_index(numpy.argmax(sums), sums.shape)
+    return (x + w / 2) / shape[1], (y + h / 2) / shape[0]
+
+
+class Detector(object):
+    def detect(self, pixels, ratio=None):
+        """
+        Returns ``(x, y)`` point of interest coordinates relative to image size, for a crop of
+        ``ratio`` if provided.
+        """
+        raise NotImplementedError
+
+
+class EntropyDetector(Detector):
+    """
+    Highest entropy zone of a grid (3x3 by default).
+    """
+    def __init__(self, zoning=None):
+        self.zoning = tuple(zoning or (3, 3))
+
+    def grid(self, pixels):
+        """
+        Returns ``((x1, y1, x2, y2), entropy)`` zones, entropy being computed on the histogram of
+        every band.
+        """
+        pixels = numpy.asarray(pixels)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, numpy.newaxis]
+        h, w, bands = pixels.shape
+        cols, rows = get_zones(w, self.zoning[0]), get_zones(h, self.zoning[1])
+
+        # Zone index of every pixel, -1 for pixels out of any zone
+        col_index = numpy.full(w, -1, dtype=numpy.int64)
+        for i, (a, b) in enumerate(cols):
+            col_index[a:b] = i
+        row_index = numpy.full(h, -1, dtype=numpy.int64)
+        for i, (a, b) in enumerate(rows):
+            row_index[a:b] = i
+        zone = col_index[numpy.newaxis, :] * len(rows) + row_index[:, numpy.newaxis]
+        zone[(row_index < 0)[:, numpy.newaxis] | (col_index < 0)[numpy.newaxis, :]] = -1
+
+        # One histogram of bands * 256 bins per zone
+        bins = bands * 256
+        values = pixels.astype(numpy.int64) + numpy.arange(bands) * 256
+        values = values + (zone * bins)[:, :, numpy.newaxis]
+        values = values[zone >= 0]
+        counts = numpy.bincount(values.ravel(), minlength=len(cols) * len(rows) * bins)
+        counts = counts.reshape(len(cols) * len(rows), bins).astype(numpy.float64)
+
+        p = counts / numpy.maximum(counts.sum(axis=1), 1)[:, numpy.newaxis]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            entropy = -numpy.where(p > 0, p * numpy.log2(p), 0).sum(axis=1)
+
+        return [
+            ((x[0] / w, y[0] / h, x[1] / w, y[1] / h), float(entropy[i * len(rows) + j]))
+            for i, x in enumerate(cols)
+            for j, y in enumerate(rows)
+        ]
+
+    def detect(self, pixels, ratio=None):
+        zone = max(self.grid(pixels), key=lambda x: x[1])[0]
+        return (zone[0] + zone[2]) / 2, (zone[1] + zone[3]) / 2
+
+
+class EdgeDetector(Detector):
+    """
+    Window of the crop size with the highest edge density, every position being scored from an
+    integral image of the gradient magnitude.
+    """
+    def detect(self, pixels, ratio=None):
+        values = gradient(luminance(pixels))
+        w, h = window_size(values.shape, ratio)
+        return best_window(window_sums(integral(values), w, h), w, h, values.shape)
+
+
+class WindowDetector(Detector):
+    """
+    Coarse to fine search of the crop window with the highest saliency (edges and contrast to
+    mean luminance). Window is searched on every position of a ``scales[0]`` times reduced map,
+    then refined around the best one at each next scale.
+    """
+    def __init__(self, scales=(4, 2, 1)):
+        self.scales = scales
+
+    def detect(self, pixels, ratio=None):
+        lum = luminance(pixels)
+        values = gradient(lum) + numpy.abs(lum - lum.mean())
+        w, h = window_size(values.shape, ratio)
+
+        best = None
+        scales = [x for x in self.scales if x <= min(values.shape)] or [1]
+        for scale in scales:
+            sh, sw = values.shape[0] // scale, values.shape[1] // scale
+            reduced = values[0:sh * scale, 0:sw * scale].reshape(sh, scale, sw, scale)
+            reduced = reduced.sum(axis=(1, 3))
+            ww = max(1, min(sw, int(round(w / scale))))
+            wh = max(1, min(sh, int(round(h / scale))))
+            sums = window_sums(integral(reduced), ww, wh)
+
+            x0 = y0 = 0
+            if best is not None:
+                # Previous best window, give or take a cell of previous scale
+                radius = previous // scale + 1
+                x0 = max(0, best[0] // scale - radius)
+                y0 = max(0, best[1] // scale - radius)
+                sums = sums[y0:best[1] // scale + radius + 1, x0:best[0] // scale + radius + 1]
+
+            if sums.max() == sums.min() and best is None:
+                return 0.5, 0.5
+
+            y, x = numpy.unravel_index(numpy.argmax(sums), sums.shape)
+            best = ((x + x0) * scale, (y + y0) * scale)
+            previous = scale
+
+        return (best[0] + w / 2) / values.shape[1], (best[1] + h / 2) / values.shape[0]
+
+
+DETECTORS = {
+    'entropy': EntropyDetector,
+    'edges': EdgeDetector,
+    'window': WindowDetector,
+}
+
+
+def get_detector(name):
+    """
+    Returns a detector instance from its name or a full python path to a detector class.
+    """
+    if '.' not in name:
+        if name not in DETECTORS:
+            raise ValueError('Detector "{0}" does not exist.'.format(name))
+        return DETECTORS[name]()
+
+    module_name = '.'.join(name.split('.')[0:-1])
+    if module_name not in sys.modules:
+        __import__(module_name)
+
+    return getattr(sys.modules[module_name], name.split('.')[-1])()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+Perceptual hashes and dominant colors.
+
+Like point of interest detectors, they work on the pixels of a small proxy image given as a
+NumPy array of ``(height, width[, bands])`` bytes.
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import numpy
+
+from .saliency import integral, luminance
+
+HASHES = ('dhash', 'phash')
+
+
+def area_resize(values, w, h):
+    """
+    Returns a ``w`` x ``h`` array of ``values`` block averages.
+    """
+    table = integral(values)
+    ys = numpy.round(numpy.arange(h + 1) * values.shape[0] / h).astype(numpy.int64)
+    xs = numpy.round(numpy.arange(w + 1) * values.shape[1] / w).astype(numpy.int64)
+    ys[1:] = numpy.maximum(ys[1:], ys[:-1] + 1)
+    xs[1:] = numpy.maximum(xs[1:], xs[:-1] + 1)
+    ys, xs = numpy.minimum(ys, values.shape[0]), numpy.minimum(xs, values.shape[1])
+
+    y1, y2 = ys[:-1, numpy.newaxis], ys[1:, numpy.newaxis]
+    x1, x2 = xs[numpy.newaxis, :-1], xs[numpy.newaxis, 1:]
+    sums = table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+    return sums / numpy.maximum((y2 - y1) * (x2 - x1), 1)
+
+
+def to_hex(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return '{0:0{1}x}'.format(value, (bits.size + 3) // 4)
+
+
+def dhash(pixels, size=8):
+    """
+    Difference hash: whether each pixel is brighter than its left neighbour, on a
+    ``size + 1`` x ``size`` reduction.
+    """
+    values = area_resize(luminance(pixels), size + 1, size)
+    return to_hex(values[:, 1:] > values[:, :-1])
+
+
+def dct_matrix(n):
+    k = numpy.arange(n)[:, numpy.newaxis]
+    return numpy.cos(numpy.pi * (2 * numpy.arange(n) + 1) * k / (2 * n))
+
+
+def phash(pixels, size=8):
+    """
+    DCT hash: whether each of the ``size`` x ``size`` lowest frequencies of a ``4 * size``
+    square reduction is above their median (DC term excluded).
+    """
+    n = size * 4
+    matrix = dct_matrix(n)
+    dct = matrix.dot(area_resize(luminance(pixels), n, n)).dot(matrix.T)[0:size, 0:size]
+    return to_hex(dct > numpy.median(dct.ravel()[1:]))
+
+
+def get_hash(pixels, method='dhash', size=8):
+    if method not in HASHES:
+        raise ValueError('Hash "{0}" does not exist.'.format(method))
+    return globals()[method](pixels, size)
+
+
+def hash_distance(a, b):
+    """
+    Returns the number of different bits of two hashes, near duplicates have a small distance.
+    """
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def dominant_colors(pixels, count=5, iterations=10, samples=4096):
+    """
+    Returns ``count`` dominant ``((r, g, b), share)`` colors by decreasing share, found by
+    k-means on a sample of opaque pixels.
+    """
+    pixels = numpy.asarray(pixels)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, numpy.newaxis]
+    bands = pixels.shape[2]
+    if bands in (2, 4):
+        pixels = pixels[pixels[:, :, -1] >= 128][:, 0:bands - 1]
+    else:
+        pixels = pixels.reshape(-1, bands)
+    if pixels.shape[1] == 1:
+        pixels = numpy.repeat(pixels, 3, axis=1)
+    pixels = pixels[:, 0:3].astype(numpy.float64)
+
+    if not len(pixels):
+        return []
+    if len(pixels) > samples:
+        pixels = pixels[::len(pixels) // samples]
+
+    # Initial centers spread over pixels sorted by luminance
+    order = numpy.argsort(pixels.dot([0.299, 0.587, 0.114]))
+    count = min(count, len(pixels))
+    centers = pixels[order[((numpy.arange(count) + 0.5) * len(pixels) / count).astype(int)]]
+
+    for i in range(iterations):
+        distances = ((pixels[:, numpy.newaxis, :] - centers[numpy.newaxis, :, :]) ** 2).sum(axis=2)
+        labels = distances.argmin(axis=1)
+        previous = centers.copy()
+        for j in range(count):
+            members = pixels[labels == j]
+            if len(members):
+                centers[j] = members.mean(axis=0)
+        if numpy.allclose(previous, centers):
+            break
+
+    shares = numpy.bincount(labels, minlength=count) / len(pixels)
+    return [
+        (tuple(int(round(x)) for x in centers[j]), float(shares[j]))
+        for j in numpy.argsort(-shares) if shares[j] > 0
+    ]
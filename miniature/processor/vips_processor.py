@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from array import array
+from math import ceil, log
+import os
+
+import pyvips
+
+from .base import BaseProcessor, six
+
+
+class Processor(BaseProcessor):
+    """
+    libvips processor.
+
+    Images are opened with sequential access: operations only build a pipeline that is evaluated
+    (and kept in memory) when saving. Resizing a freshly opened image uses libvips thumbnail,
+    shrinking JPEG, WebP or HEIF images while decoding them.
+    """
+    FILTERS = {
+        'antialias': 'lanczos3',
+        'nearest': 'nearest',
+        'bilinear': 'linear',
+        'bicubic': 'cubic',
+    }
+    DEFAULT_FILTER = 'lanczos3'
+
+    # Mode: (interpretation, bands)
+    MODES = {
+        'bilevel': ('b-w', 1),
+        'grayscale': ('b-w', 1),
+        'grayscalematte': ('b-w', 2),
+        'palette': ('srgb', 3),
+        'palettematte': ('srgb', 4),
+        'truecolor': ('srgb', 3),
+        'truecolormatte': ('srgb', 4),
+        'colorseparation': ('cmyk', 4),
+    }
+
+    # Modes libvips can't represent, applied when saving
+    SAVE_MODES = ('bilevel', 'palette', 'palettematte')
+
+    # Palette is computed by libvips' own quantizer when saving
+    QUANTIZERS = ('auto',)
+    DEFAULT_QUANTIZER = 'auto'
+
+    BYTES_PER_BAND = {
+        'uchar': 1,
+        'char': 1,
+        'ushort': 2,
+        'short': 2,
+        'uint': 4,
+        'int': 4,
+        'float': 4,
+        'complex': 8,
+        'double': 8,
+        'dpcomplex': 16,
+    }
+
+    # Pillow save options names by format, None when option has no equivalent
+    SAVE_OPTION_NAMES = {
+        'jpeg': {'quality': 'Q', 'progressive': 'interlace', 'optimize': 'optimize_coding'},
+        'png': {'compress_level': 'compression', 'progressive': 'interlace', 'optimize': None},
+        'webp': {'quality': 'Q', 'method': 'effort'},
+        'avif': {'quality': 'Q', 'speed': None},
+        'gif': {'optimize': None},
+    }
+
+    SUFFIXES = {
+        'jpg': 'jpeg',
+        'jpe': 'jpeg',
+        'jfif': 'jpeg',
+        'tif': 'tiff',
+    }
+
+    COLORS = {
+        'black': (0, 0, 0),
+        'silver': (192, 192, 192),
+        'gray': (128, 128, 128),
+        'grey': (128, 128, 128),
+        'white': (255, 255, 255),
+        'maroon': (128, 0, 0),
+        'red': (255, 0, 0),
+        'purple': (128, 0, 128),
+        'fuchsia': (255, 0, 255),
+        'green': (0, 128, 0),
+        'lime': (0, 255, 0),
+        'olive': (128, 128, 0),
+        'yellow': (255, 255, 0),
+        'navy': (0, 0, 128),
+        'blue': (0, 0, 255),
+        'teal': (0, 128, 128),
+        'aqua': (0, 255, 255),
+    }
+
+    def _open_image(self, fp):
+        # Files are read by libvips itself, other file objects are read in memory
+        self._filename = self._get_filename(fp)
+        self._buffer = fp.read() if self._filename is None else None
+        img = self._new_image()
+        self._loaded = img
+        self._memory_img = None
+
+        info = {
+            'format': img.get('vips-loader').split('load')[0],
+            'frames': img.get('n-pages') if img.get_typeof('n-pages') else 1,
+            'duration': 0,
+        }
+        if img.get_typeof('delay'):
+            info['duration'] = img.get('delay')[0]
+        if img.get_typeof('loop'):
+            info['loop'] = img.get('loop')
+        return img, info
+
+    def _get_filename(self, fp):
+        """
+        Returns the path of the file ``fp`` reads, None if it is not a file.
+        """
+        name = getattr(fp, 'name', None)
+        if not isinstance(name, six.string_types) or not pyvips.at_least_libvips(8, 9):
+            return None
+        try:
+            if fp.tell() == 0 and os.path.samestat(os.fstat(fp.fileno()), os.stat(name)):
+                return name
+        except (AttributeError, EnvironmentError, ValueError):
+            pass
+        return None
+
+    def _new_image(self, **options):
+        """
+        Opens the source with sequential access, each pipeline reading it needs its own image.
+        """
+        if self._filename is not None:
+            source = pyvips.Source.new_from_file(self._filename)
+            return pyvips.Image.new_from_source(source, '', access='sequential', **options)
+        return pyvips.Image.new_from_buffer(self._buffer, '', access='sequential', **options)
+
+    def _new_thumbnail(self, w, **options):
+        if self._filename is not None:
+            return pyvips.Image.thumbnail_source(pyvips.Source.new_from_file(self._filename), w,
+                **options)
+        return pyvips.Image.thumbnail_buffer(self._buffer, w, **options)
+
+    def _reduce_on_load(self, img, factor):
+        # Only JPEG loader shrinks by 2, 4 or 8
+        if self.info['format'] != 'jpeg':
+            return img
+
+        shrink = 1
+        while shrink < factor and shrink < 8:
+            shrink *= 2
+
+        self._loaded = self._new_image(shrink=shrink)
+        return self._loaded
+
+    def _close(self, img):
+        # libvips images are reference counted
+        pass
+
+    def _load(self, img):
+        return img.copy_memory()
+
+    def _load_current(self):
+        if self.img is not self._memory_img:
+            self.set_image(self._load(self.img))
+            self._memory_img = self.img
+
+    def save(self, file, format=None, **options):
+        # Pipeline can only be evaluated once with sequential access
+        self.assert_decoded()
+        self._load_current()
+        return super(Processor, self).save(file, format, **options)
+
+    def get_proxy(self, size):
+        # Only a freshly opened image reduced with thumbnail leaves the pipeline unread, any
+        # other proxy evaluates it and it could not be read again when saving
+        if self.img is not self._loaded or not self._get_scale_size(self._get_size(self.img),
+        size, size):
+            self._load_current()
+        return super(Processor, self).get_proxy(size)
+
+    def _raw_save(self, img, format, **options):
+        fp = options.pop('file', None)
+        filename = options.pop('filename', None)
+        if options.pop('strip'):
+            if pyvips.at_least_libvips(8, 15):
+                options['keep'] = 'icc'
+            else:
+                options['strip'] = True
+
+        names = self.SAVE_OPTION_NAMES.get(format, {})
+        if format == 'avif' and 'speed' in options:
+            # Pillow speed goes from 0 (slowest) to 10, libvips effort from 9 (slowest) to 0
+            options.setdefault('effort', max(0, 9 - options['speed']))
+        options = dict((names.get(k, k), v) for k, v in options.items() if names.get(k, k))
+
+        mode = self._get_mode(img)
+        if format in ('png', 'gif') and mode in self.SAVE_MODES:
+            if mode == 'bilevel':
+                options.setdefault('bitdepth', 1)
+            elif format == 'png':
+                options.setdefault('palette', True)
+                options.setdefault('dither', img.get('miniature-dither'))
+                bits = int(ceil(log(max(2, img.get('miniature-colors')), 2)))
+                options.setdefault('bitdepth', [x for x in (1, 2, 4, 8) if x >= bits][0])
+
+        if format == 'jpeg' and img.hasalpha():
+            img = img.flatten()
+
+        if fp is not None:
+            fp.write(img.write_to_buffer('.{0}'.format(format), **options))
+        else:
+            img.write_to_file(filename, **options)
+
+    def _raw_save_frames(self, img, frames, format, **options):
+        # Frames are stacked vertically, libvips evaluates them one after the other when saving
+        pages = [img]
+        delays = [self.info['duration']]
+        for frame, duration in frames:
+            pages.append(frame)
+            delays.append(duration or 0)
+
+        result = pyvips.Image.arrayjoin(pages, across=1).copy()
+        result.set_type(pyvips.GValue.gint_type, 'page-height', img.height)
+        result.set_type(pyvips.GValue.array_int_type, 'delay', delays)
+        result.set_type(pyvips.GValue.gint_type, 'loop', options.pop('loop', 0))
+        self._raw_save(result, format, **options)
+
+    def _get_frames(self, img, count):
+        pages = self._new_image(n=count)
+        height = pages.get('page-height')
+        delays = pages.get('delay') if pages.get_typeof('delay') else [0] * count
+        for i in range(1, count):
+            yield pages.crop(0, i * height, pages.width, height), delays[i]
+
+    @classmethod
+    def get_save_formats(cls):
+        result = set()
+        for x in pyvips.get_suffixes():
+            x = x.lstrip('.')
+            result.add(cls.SUFFIXES.get(x, x))
+        return result
+
+    def _copy_image(self, img):
+        return img.copy()
+
+    def _get_color(self, color):
+        try:
+            return super(Processor, self)._get_color(color)
+        except TypeError:
+            if color.lower() not in self.COLORS:
+                raise
+            return self.COLORS[color.lower()]
+
+    def _get_size(self, img):
+        return img.width, img.height
+
+    def _get_memory_size(self, img):
+        return img.width * img.height * img.bands * self.BYTES_PER_BAND.get(img.format, 1)
+
+    def _get_mode(self, img):
+        if img.get_typeof('miniature-mode'):
+            return img.get('miniature-mode')
+
+        if img.interpretation == 'cmyk':
+            return 'colorseparation'
+
+        return {
+            1: 'grayscale',
+            2: 'grayscalematte',
+            3: 'truecolor',
+        }.get(img.bands, 'truecolormatte')
+
+    def _set_mode(self, img, mode, **options):
+        interpretation, bands = self.MODES[mode]
+        if options.get('quantizer', 'auto') not in self.QUANTIZERS:
+            raise ValueError('Invalid quantizer "{0}".'.format(options['quantizer']))
+
+        alpha = None
+        if img.hasalpha():
+            alpha = img[img.bands - 1]
+            img = img.extract_band(0, n=img.bands - 1)
+
+        img = img.colourspace(interpretation)
+        if mode.endswith('matte'):
+            img = img.bandjoin(alpha if alpha is not None else 255)
+        elif mode == 'bilevel':
+            img = (img > 127).ifthenelse(255, 0).cast('uchar')
+
+        img = img.copy()
+        for name in ('miniature-mode', 'miniature-colors', 'miniature-dither'):
+            if img.get_typeof(name):
+                img.remove(name)
+
+        if mode in self.SAVE_MODES:
+            img.set_type(pyvips.GValue.gstr_type, 'miniature-mode', mode)
+        if mode in ('palette', 'palettematte'):
+            img.set_type(pyvips.GValue.gint_type, 'miniature-colors', options.get('colors', 256))
+            img.set_type(pyvips.GValue.gdouble_type, 'miniature-dither',
+                1.0 if options.get('dither', True) else 0.0)
+
+        return img
+
+    def _orientation(self, img):
+        return self._apply_orientation(img, self._get_orientation(img))
+
+    def _get_orientation(self, img):
+        if img.get_typeof('orientation'):
+            return img.get('orientation')
+        return None
+
+    def _apply_orientation(self, img, orientation):
+        if orientation in (3, 4, 5, 6, 7, 8):
+            # Bottom-up or column reads are not possible with sequential access
+            img = self._load(img)
+
+        if orientation == 2:
+            img = img.fliphor()
+        elif orientation == 3:
+            img = img.rot180()
+        elif orientation == 4:
+            img = img.flipver()
+        elif orientation == 5:
+            img = img.rot90().fliphor()
+        elif orientation == 6:
+            img = img.rot90()
+        elif orientation == 7:
+            img = img.rot270().fliphor()
+        elif orientation == 8:
+            img = img.rot270()
+        else:
+            return img
+
+        # Saved image should not be rotated again by viewers
+        img = img.copy()
+        img.remove('orientation')
+        return img
+
+    def _set_background(self, img, color):
+        if not img.hasalpha():
+            return img
+
+        # Grayscale images stay grayscale on a gray background
+        if img.bands < 3 and color[0] == color[1] == color[2]:
+            return img.flatten(background=[color[0]])
+        if img.bands < 3:
+            img = img.colourspace('srgb')
+        return img.flatten(background=list(color[0:3]))
+
+    def _can_tile(self, img):
+        # libvips is demand driven, images are always processed by regions
+        return True
+
+    def _tiled_resize(self, img, w, h, filter, box=None):
+        if box is None:
+            return self._resize(img, w, h, filter)
+
+        # A sequential image is read once, each reduction of a crop reads the source again
+        img = self._new_image()
+        return self._resize(self._crop(img, *box), w, h, filter)
+
+    def _tiled_crop(self, img, x1, y1, x2, y2):
+        return self._crop(img, x1, y1, x2, y2)
+
+    def _crop(self, img, x1, y1, x2, y2):
+        w, h = x2 - x1, y2 - y1
+        left, top = max(0, x1), max(0, y1)
+        right, bottom = min(img.width, x2), min(img.height, y2)
+        img = img.crop(left, top, right - left, bottom - top)
+
+        # Outside parts are black, as with Pillow
+        if (img.width, img.height) != (w, h):
+            img = img.embed(left - x1, top - y1, w, h)
+        return img
+
+    def _resize(self, img, w, h, filter=None, reducing_gap=None):
+        if img is self._loaded and (reducing_gap or
+        reducing_gap is None and filter == self.DEFAULT_FILTER):
+            # Shrink on load
+            return self._new_thumbnail(w, height=h, size='force', no_rotate=True)
+
+        options = {'vscale': h / img.height, 'kernel': filter}
+        if reducing_gap is not None and pyvips.at_least_libvips(8, 13):
+            options['gap'] = reducing_gap
+
+        if img.hasalpha():
+            format_ = img.format
+            img = img.premultiply().resize(w / img.width, **options)
+            return img.unpremultiply().cast(format_)
+
+        return img.resize(w / img.width, **options)
+
+    def _rotate(self, img, angle):
+        # Rotations don't read the image from top to bottom, not possible with sequential access
+        if img is not self._memory_img:
+            img = self._load(img)
+
+        if angle % 90 == 0:
+            return img.rot('d{0}'.format(int(angle) % 360))
+
+        return img.rotate(angle, interpolate=pyvips.Interpolate.new('bicubic'))
+
+    def _add_border(self, img, width, color):
+        color = list(color)
+        if img.bands < 3 and len(color) >= 3:
+            if color[0] == color[1] == color[2]:
+                # Gray borders keep grayscale images on one band (plus alpha)
+                color = color[0:1] + color[3:]
+            else:
+                img = img.colourspace('srgb')
+        if img.hasalpha() and len(color) in (1, 3):
+            color.append(255)
+
+        return img.embed(width, width, img.width + width * 2, img.height + width * 2,
+            extend='background', background=color[0:img.bands])
+
+    def _get_histogram(self, img):
+        # 256 bins by band as with Pillow, 16 bits values are reduced to their high byte
+        if img.format in ('ushort', 'short'):
+            img = (img >> 8).cast('uchar')
+        elif img.format != 'uchar':
+            img = img.cast('uchar')
+        data = array(str('I'))
+        data.frombytes(img.hist_find().cast('uint').write_to_memory())
+        bands = img.bands
+        return [data[x * bands + b] for b in range(bands) for x in range(256)]
+
+    def _get_array(self, img):
+        import numpy
+
+        # Pixels are gray or sRGB bytes, with alpha as the last band
+        if img.interpretation == 'cmyk':
+            img = img.colourspace('srgb')
+        elif img.interpretation not in ('b-w', 'srgb'):
+            img = img.colourspace('srgb' if img.bands >= 3 else 'b-w')
+        if img.format != 'uchar':
+            img = img.cast('uchar')
+        data = numpy.frombuffer(img.write_to_memory(), dtype=numpy.uint8)
+        return data.reshape(img.height, img.width, img.bands)
@@ -17,5 +17,20 @@ class Backend(LazyObject):
 backend = Backend()
 
 
-def get_thumbnail(image, operations=None, timeout=None):
-    return backend.get_thumbnail(image, operations, timeout)
+def get_thumbnail(image, operations=None, timeout=None, accept=None):
+    return backend.get_thumbnail(image, operations, timeout, accept)
+
+
+def get_thumbnails(requests, timeout=None):
+    return backend.get_thumbnails(requests, timeout)
+
+
+def aget_thumbnail(image, operations=None, timeout=None, accept=None):
+    # asyncio module is only imported by async code (and requires Python 3.5)
+    from miniature.thumbnails.aio import aget_thumbnail
+    return aget_thumbnail(image, operations, timeout, accept)
+
+
+def aget_thumbnails(requests, timeout=None):
+    from miniature.thumbnails.aio import aget_thumbnails
+    return aget_thumbnails(requests, timeout)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+"""
+asyncio thumbnail API (Python 3.5+).
+
+Lookups of cached thumbnails (cache or index, storage check) run on a small pool of their own so
+that they never wait for thumbnail creations, run on a bounded pool of ``MINIATURE_THREADS``
+threads. Concurrent requests of a same thumbnail wait for a single creation.
+"""
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+
+from django.utils import six
+from django.utils.six.moves.urllib.parse import urlsplit
+
+from miniature.thumbnails import backend
+from miniature.thumbnails.base import FileWrapper, ThumbnailOperations
+from miniature.thumbnails.conf import settings
+
+# Lookups are short, a few threads are enough
+LOOKUP_THREADS = 2
+
+executors = {}
+executors_lock = threading.Lock()
+
+# Thumbnails being created, by event loop and thumbnail key
+pending = {}
+
+
+def get_executor(kind):
+    with executors_lock:
+        executor = executors.get(kind)
+        if executor is None:
+            executor = executors[kind] = ThreadPoolExecutor(
+                LOOKUP_THREADS if kind == 'lookup' else settings.MINIATURE_THREADS)
+    return executor
+
+
+def run(func, *args, **kwargs):
+    """
+    Runs a blocking function on the ``'render'`` or ``'lookup'`` executor.
+    """
+    return asyncio.get_event_loop().run_in_executor(get_executor(kwargs.get('kind', 'render')),
+        functools.partial(func, *args))
+
+
+def lookup(image, op_id, timeout):
+    """
+    Returns the path of a cached thumbnail, None if it is missing.
+    """
+    path = (backend.get_entries(image) or {}).get(op_id)
+    if path is not None and backend.check_entry(image, op_id, path, timeout):
+        return path
+    return None
+
+
+async def aget_thumbnail(image, operations=None, timeout=None, accept=None):
+    if not isinstance(operations, ThumbnailOperations):
+        operations = backend.compile_operations(operations)
+    format_ = backend.get_format(operations.policy, accept)
+    op_id = operations.get_key(backend, format_)[1]
+
+    # Cached thumbnails are returned without waiting for a render thread, remote images always
+    # go through get_thumbnail
+    if isinstance(image, six.string_types) and urlsplit(image).scheme in ('http', 'https'):
+        image_key = image
+    else:
+        image_key = backend.image_id(image)
+        path = await run(lookup, image, op_id, timeout, kind='lookup')
+        if path is not None:
+            return FileWrapper(path, backend.storage)
+
+    loop = asyncio.get_event_loop()
+    key = (loop, image_key, op_id)
+    future = pending.get(key)
+    if future is None:
+        future = pending[key] = run(backend.get_thumbnail, image, operations, timeout, accept)
+        future.add_done_callback(lambda x: pending.pop(key, None))
+
+    # A cancelled request does not cancel the creation other requests wait for
+    return await asyncio.shield(future)
+
+
+async def aget_thumbnails(requests, timeout=None):
+    """
+    Returns thumbnails of a list of ``(image, operations, accept)`` requests.
+    """
+    return list(await asyncio.gather(*[
+        aget_thumbnail(image, operations, timeout, accept)
+        for image, operations, accept in requests
+    ]))
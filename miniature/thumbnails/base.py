@@ -4,45 +4,289 @@
 # See the LICENSE for more information.
 from __future__ import (print_function, division, absolute_import, unicode_literals)
 
+from contextlib import contextmanager
 import hashlib
+import heapq
+import itertools
+from multiprocessing.pool import ThreadPool
 import os.path
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from django.core.cache import get_cache, cache as default_cache, InvalidCacheBackendError
 from django.core.files.base import File, ContentFile
 from django.core.files.storage import get_storage_class, default_storage
 from django.utils.encoding import force_bytes, force_text
-from django.utils.functional import LazyObject
+from django.utils.functional import LazyObject, empty
 from django.utils import six
 from django.utils.six.moves.urllib.parse import urljoin, urlsplit
 from django.utils.six.moves.urllib.request import urlopen
 
+from miniature import instrumentation
 from miniature.processor import get_processor
+from miniature.processor.base import eval_expr, ImageTooLargeError
 from miniature.thumbnails.conf import settings
 
 
-class ThumbnailCache(LazyObject):
+class ThreadSafeLazyObject(LazyObject):
+    """
+    Lazy object set up only once when first used by several threads at the same time.
+    """
+    setup_lock = threading.Lock()
+
     def _setup(self):
+        with self.setup_lock:
+            if self._wrapped is empty:
+                self._wrapped = self._create()
+
+    def _create(self):
+        raise NotImplementedError
+
+
+class ThumbnailCache(ThreadSafeLazyObject):
+    def _create(self):
         try:
-            self._wrapped = get_cache(settings.MINIATURE_CACHE)
+            return get_cache(settings.MINIATURE_CACHE)
         except InvalidCacheBackendError:
-            self._wrapped = default_cache
+            return default_cache
 
 
-class ThumbnailStorage(LazyObject):
-    def _setup(self):
+class ThumbnailIndex(ThreadSafeLazyObject):
+    def _create(self):
+        from miniature.index import SQLiteIndex
+        return SQLiteIndex(settings.MINIATURE_INDEX)
+
+
+class ThumbnailStorage(ThreadSafeLazyObject):
+    def _create(self):
         prefix = settings.MINIATURE_THUMBNAIL_PATH
         if prefix.endswith('/'):
             prefix = prefix[0:-1]
 
         base_path = os.path.join(settings.MEDIA_ROOT, prefix)
         base_url = urljoin(settings.MEDIA_URL, '{0}/'.format(prefix))
-        self._wrapped = get_storage_class()(location=base_path, base_url=base_url)
+        return get_storage_class()(location=base_path, base_url=base_url)
+
+
+class ThumbnailPool(ThreadSafeLazyObject):
+    def _create(self):
+        return ThreadPool(settings.MINIATURE_THREADS)
+
+
+class ThumbnailOverloaded(Exception):
+    pass
+
+
+class ThumbnailFailed(Exception):
+    """
+    Raised for a thumbnail whose creation failed recently, ``kind`` being ``fetch``, ``decode`` or
+    ``operation``.
+    """
+    def __init__(self, kind, error):
+        super(ThumbnailFailed, self).__init__(
+            'Thumbnail creation failed recently ({0}): {1}'.format(kind, error))
+        self.kind = kind
+        self.error = error
+
+
+@contextmanager
+def failure_kind(kind):
+    """
+    Sets ``failure_kind`` attribute of errors raised in block, if not set yet.
+    """
+    try:
+        yield
+    except Exception as e:
+        if getattr(e, 'failure_kind', None) is None:
+            e.failure_kind = kind
+        raise
+
+
+class RenderSlot(object):
+    def __init__(self, lock_file=None):
+        self.lock_file = lock_file
+
+
+class RenderBudget(object):
+    """
+    Limits the number of thumbnails created at once by the process and, with lock files, by the
+    host (where ``fcntl`` is available). Waiting renders are admitted by priority (highest
+    first), then by arrival order. ``stats`` counts admitted, queued and shed renders.
+    """
+    def __init__(self, limit=None, host_limit=None, lock_dir=None):
+        self.limit = limit
+        self.host_limit = host_limit if fcntl is not None else None
+        self.lock_dir = lock_dir or os.path.join(tempfile.gettempdir(), 'miniature-renders')
+        self.condition = threading.Condition()
+        self.running = 0
+        self.waiting = []
+        self.counter = itertools.count()
+        self.stats = {'admitted': 0, 'queued': 0, 'shed': 0}
+
+    def acquire(self, priority=0, deadline=None):
+        """
+        Returns a slot to release once rendering is done, or None when no slot was free within
+        ``deadline`` seconds (None waits forever).
+        """
+        end = None if deadline is None else time.time() + deadline
+        with self.condition:
+            if self.limit and (self.running >= self.limit or self.waiting):
+                entry = (-priority, next(self.counter))
+                heapq.heappush(self.waiting, entry)
+                self.stats['queued'] += 1
+                while self.running >= self.limit or self.waiting[0] != entry:
+                    remaining = None if end is None else end - time.time()
+                    if remaining is not None and remaining <= 0:
+                        self.waiting.remove(entry)
+                        heapq.heapify(self.waiting)
+                        self.stats['shed'] += 1
+                        self.condition.notify_all()
+                        return None
+                    self.condition.wait(remaining)
+                heapq.heappop(self.waiting)
+                # Next waiter could be admitted too
+                self.condition.notify_all()
+            self.running += 1
+
+        lock_file = None
+        if self.host_limit:
+            lock_file = self.acquire_host(end)
+            if lock_file is None:
+                self.release(RenderSlot())
+                with self.condition:
+                    self.stats['shed'] += 1
+                return None
+
+        with self.condition:
+            self.stats['admitted'] += 1
+        return RenderSlot(lock_file)
+
+    def acquire_host(self, end=None):
+        """
+        Returns a locked slot file, one of ``host_limit`` files shared by every process.
+        """
+        if not os.path.isdir(self.lock_dir):
+            try:
+                os.makedirs(self.lock_dir)
+            except OSError:
+                # Created by another process
+                if not os.path.isdir(self.lock_dir):
+                    raise
+
+        while True:
+            for i in range(self.host_limit):
+                fp = open(os.path.join(self.lock_dir, 'slot-{0}'.format(i)), 'a')
+                try:
+                    fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fp
+                except (IOError, OSError):
+                    fp.close()
+
+            if end is not None and time.time() >= end:
+                return None
+            time.sleep(0.02)
+
+    def release(self, slot):
+        if slot.lock_file is not None:
+            fcntl.flock(slot.lock_file, fcntl.LOCK_UN)
+            slot.lock_file.close()
+
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+
+class ThumbnailRenderBudget(ThreadSafeLazyObject):
+    def _create(self):
+        return RenderBudget(settings.MINIATURE_MAX_RENDERS, settings.MINIATURE_MAX_HOST_RENDERS,
+            settings.MINIATURE_RENDER_LOCK_DIR)
+
+
+class LazyProcessor(object):
+    """
+    Processor class of ``MINIATURE_PROCESSOR`` setting, imported when first used rather than with
+    the backend module.
+    """
+    def __init__(self):
+        self.processor = None
+
+    def __get__(self, instance, owner):
+        if self.processor is None:
+            self.processor = get_processor(settings.MINIATURE_PROCESSOR)
+        return self.processor
+
+
+class ThumbnailOperations(object):
+    """
+    Normalized thumbnail operations, split from output format and save options. Cache key and its
+    id are computed once by output format, compiled operations can be used for any number of
+    thumbnails.
+    """
+    def __init__(self, operations=None):
+        self.policy = settings.MINIATURE_FORMAT
+        self.save_options = None
+        self.operations = []
+        self.keys = {}
+
+        for name, value in operations or []:
+            name = force_text(name).strip()
+            if isinstance(value, six.string_types):
+                value = ','.join(x.strip() for x in value.split(','))
+
+            if name == 'format':
+                self.policy = value
+            elif name == 'save':
+                self.save_options = value
+            else:
+                self.operations.append((name, value))
+
+    def get_key(self, backend, format_):
+        """
+        Returns ``(key, op_id)`` tuple for an output format.
+        """
+        result = self.keys.get(format_)
+        if result is None:
+            key = list(self.operations)
+            if format_ != 'source' or self.save_options:
+                key.append(('save', format_, self.save_options))
+            result = self.keys[format_] = (key, backend.op_id(key))
+        return result
 
 
 class ThumbnailBackend(object):
-    Processor = get_processor(settings.MINIATURE_PROCESSOR)
+    """
+    Thumbnail backend, safe to use from several threads. Entries of an image are updated under
+    a lock since thumbnails of a same image could be created at the same time. With
+    ``MINIATURE_INDEX``, entries are kept in a SQLite index instead of the cache.
+    """
+    Processor = LazyProcessor()
     storage = ThumbnailStorage()
     cache = ThumbnailCache()
+    index = ThumbnailIndex()
+    pool = ThumbnailPool()
+    budget = ThumbnailRenderBudget()
+    # Entries of an image are updated under one of these locks, chosen by image
+    entries_locks = [threading.Lock() for i in range(64)]
+    # Source versions of index lookups, by image id: (version, expiration time)
+    versions = {}
+    versions_lock = threading.Lock()
+    versions_size = 10000
+
+    # Formats every client accepts
+    DEFAULT_FORMATS = ('jpeg', 'png', 'gif')
+    MIME_TYPES = {
+        'jpeg': 'image/jpeg',
+        'png': 'image/png',
+        'gif': 'image/gif',
+        'webp': 'image/webp',
+        'avif': 'image/avif',
+    }
 
     @classmethod
     def image_id(cls, image):
@@ -52,86 +296,476 @@ class ThumbnailBackend(object):
     def op_id(cls, operations):
         return hashlib.md5(force_bytes(repr(operations))).hexdigest()
 
+    @classmethod
+    def get_accepted_types(cls, accept):
+        """
+        Returns mime types with a non null quality from an Accept header.
+        """
+        result = set()
+        for part in accept.split(','):
+            params = [x.strip() for x in part.split(';')]
+            quality = [x[2:] for x in params[1:] if x.startswith('q=')]
+            try:
+                if quality and float(quality[0]) <= 0:
+                    continue
+            except ValueError:
+                continue
+            result.add(params[0].lower())
+
+        return result
+
+    @classmethod
+    def get_format(cls, policy, accept=None):
+        """
+        Returns the output format from a format policy: a comma separated list of formats by
+        preference order where "source" is the source image format. Formats are skipped when the
+        processor can't write them or, given an Accept header, when the client does not
+        explicitly accept them.
+        """
+        if not policy:
+            return 'source'
+
+        formats = cls.Processor.get_save_formats()
+        accepted = None if accept is None else cls.get_accepted_types(accept)
+
+        for format_ in [x.strip().lower() for x in policy.split(',')]:
+            if format_ == 'jpg':
+                format_ = 'jpeg'
+            if format_ == 'source':
+                return format_
+            if format_ not in formats:
+                continue
+            if accepted is not None and format_ not in cls.DEFAULT_FORMATS \
+            and cls.MIME_TYPES.get(format_) not in accepted:
+                continue
+            return format_
+
+        return 'source'
+
+    @classmethod
+    def is_negotiated(cls, policy):
+        """
+        Returns whether the format chosen by a format policy depends on the Accept header.
+        """
+        return cls.get_format(policy, '') != cls.get_format(policy)
+
+    @classmethod
+    def get_save_options(cls, format_, value=None):
+        """
+        Returns save options for a format, from settings and a "save" operation value
+        (eg. "quality=70,progressive=False").
+        """
+        options = dict(settings.MINIATURE_SAVE_OPTIONS.get(format_, {}))
+        for item in (value or '').split(','):
+            if '=' not in item:
+                continue
+            k, v = [x.strip() for x in item.split('=', 1)]
+            try:
+                v = eval_expr(v)
+            except (TypeError, KeyError, SyntaxError):
+                pass
+            options[str(k)] = v
+
+        return options
+
     @classmethod
     def get_entries(cls, image):
+        if settings.MINIATURE_INDEX:
+            # Thumbnails of another source version are missing, they are replaced (and their
+            # file removed) when created again
+            version = cls.get_source_version(image)
+            entries = cls.index.get(force_text(cls.image_id(image)))
+            return dict((k, path) for k, (path, v) in entries.items() if v == version)
         return cls.cache.get(cls.image_id(image))
 
     @classmethod
     def set_entries(cls, image, entries, timeout=None):
-        cls.cache.set(cls.image_id(image), entries, timeout)
+        if settings.MINIATURE_INDEX:
+            cls.index.set(force_text(cls.image_id(image)), entries,
+                cls.get_source_version(image, refresh=True))
+        else:
+            cls.cache.set(cls.image_id(image), entries, timeout)
+
+    @classmethod
+    def add_entry(cls, image, op_id, path, timeout=None, size=None):
+        if settings.MINIATURE_INDEX:
+            # A replaced thumbnail (of a previous source version) is removed
+            previous = cls.index.add(force_text(cls.image_id(image)), op_id, path,
+                cls.get_source_version(image, refresh=True), size)
+            if previous is not None:
+                cls.storage.delete(previous)
+            return
+
+        # Entries are read again, another thread could have changed them since lookup
+        image_id = cls.image_id(image)
+        with cls.entries_locks[hash(image_id) % len(cls.entries_locks)]:
+            entries = cls.get_entries(image) or {}
+            if entries.get(op_id) != path:
+                entries[op_id] = path
+                cls.set_entries(image, entries, timeout)
+
+    @classmethod
+    def check_entry(cls, image, op_id, path, timeout=None):
+        """
+        Returns whether a cached thumbnail can be used and marks it as used. Without index,
+        thumbnail file is checked, cache entries are left as they are. The index is trusted, it
+        only records the access.
+        """
+        if settings.MINIATURE_INDEX:
+            cls.index.touch(force_text(cls.image_id(image)), op_id)
+            return True
+
+        with instrumentation.measure('storage.exists') as values:
+            exists = cls.storage.exists(path)
+            values['missing'] = not exists
+        return exists
 
     @classmethod
     def remove_entries(cls, image, remove_files=False):
-        entries = cls.get_entries(image)
-        if entries:
-            for name in entries.values():
-                cls.storage.delete(name)
+        if settings.MINIATURE_INDEX:
+            entries = cls.index.delete_source(force_text(cls.image_id(image)))
+            with cls.versions_lock:
+                cls.versions.pop(cls.image_id(image), None)
+        else:
+            entries = (cls.get_entries(image) or {}).values()
+            cls.cache.delete(cls.image_id(image))
+
+        for name in entries:
+            cls.storage.delete(name)
+
+        cls.cache.delete(cls.analysis_id(image))
+        cls.cache.delete(cls.failure_id(image))
+
+    @classmethod
+    def collect_entries(cls, max_age, prefix=''):
+        """
+        Removes indexed thumbnails (of sources starting with ``prefix``) not used for
+        ``max_age`` seconds and returns how many. Requires ``MINIATURE_INDEX``.
+        """
+        cls.index.flush()
+        before = time.time() - max_age
+        count = 0
+        while True:
+            entries = list(cls.index.scan(prefix, before, limit=500))
+            if not entries:
+                return count
+            for entry in entries:
+                cls.storage.delete(entry.path)
+            cls.index.delete(entries)
+            count += len(entries)
+
+    @classmethod
+    def failure_id(cls, image, op_id=None):
+        """
+        Returns failure cache key of a source image, or of one of its thumbnails.
+        """
+        key = cls.image_id(image) + b':failure'
+        if op_id is not None:
+            key += b':' + force_bytes(op_id)
+        return key
+
+    @classmethod
+    def get_failure(cls, image, op_id):
+        """
+        Returns the recent failure of a thumbnail or of its source image, None otherwise.
+        """
+        if not settings.MINIATURE_FAILURE_TIMEOUT:
+            return None
+
+        keys = [cls.failure_id(image), cls.failure_id(image, op_id)]
+        failures = cls.cache.get_many(keys)
+        return failures.get(keys[0]) or failures.get(keys[1])
+
+    @classmethod
+    def set_failure(cls, image, op_id, error):
+        """
+        Caches a failure for ``MINIATURE_FAILURE_TIMEOUT`` seconds. Fetch and decode failures are
+        cached for the source image, operation failures for the thumbnail only. Other errors
+        (storage or cache failures...) are not cached.
+        """
+        kind = getattr(error, 'failure_kind', None)
+        if not settings.MINIATURE_FAILURE_TIMEOUT or kind is None:
+            return
+
+        key = cls.failure_id(image, op_id if kind == 'operation' else None)
+        cls.cache.set(key, {
+            'kind': kind,
+            'error': '{0}: {1}'.format(error.__class__.__name__, error),
+        }, settings.MINIATURE_FAILURE_TIMEOUT)
+
+    @classmethod
+    def analysis_id(cls, image):
+        return cls.image_id(image) + b':analysis'
+
+    @classmethod
+    def source_version(cls, image):
+        """
+        Returns a value changing with source image content (its modification time) or None.
+        """
+        storage = getattr(image, 'storage', None)
+        try:
+            return force_text(storage.modified_time(image.name))
+        except (AttributeError, NotImplementedError, EnvironmentError):
+            return None
+
+    @classmethod
+    def get_source_version(cls, image, refresh=False):
+        """
+        Returns the source version of index entries. It is read from the storage at most once
+        every ``MINIATURE_VERSION_TIMEOUT`` seconds by process, or when ``refresh`` is true.
+        """
+        timeout = settings.MINIATURE_VERSION_TIMEOUT
+        if not timeout:
+            return cls.source_version(image)
+
+        image_id = cls.image_id(image)
+        now = time.time()
+        if not refresh:
+            with cls.versions_lock:
+                cached = cls.versions.get(image_id)
+            if cached is not None and cached[1] > now:
+                return cached[0]
+
+        version = cls.source_version(image)
+        with cls.versions_lock:
+            if len(cls.versions) >= cls.versions_size:
+                cls.versions.clear()
+            cls.versions[image_id] = (version, now + timeout)
+        return version
+
+    @classmethod
+    def get_analysis(cls, image):
+        """
+        Returns source image analysis results (used by smart crops) from cache.
+        """
+        version = cls.source_version(image)
+        analysis = cls.cache.get(cls.analysis_id(image))
+        if not analysis or analysis.get('version') != version:
+            analysis = {'version': version}
+        return analysis
+
+    @classmethod
+    def set_analysis(cls, image, analysis, timeout=None):
+        cls.cache.set(cls.analysis_id(image), analysis, timeout)
+
+    @classmethod
+    def open_image(cls, image):
+        """
+        Returns a file object to read image from. Files of a storage get their own file object,
+        a same image can then be read by several threads.
+        """
+        storage = getattr(image, 'storage', None)
+        name = getattr(image, 'name', None)
+        if storage is not None and name:
+            return storage.open(name, 'rb')
+
+        if hasattr(image, 'closed') and image.closed:
+            image.open()
+        return image
+
+    @classmethod
+    def open_processor(cls, source, analysis=None):
+        return cls.Processor(source,
+            max_pixels=settings.MINIATURE_MAX_PIXELS,
+            max_bytes=settings.MINIATURE_MAX_BYTES,
+            oversize_policy=settings.MINIATURE_OVERSIZE_POLICY,
+            animated=settings.MINIATURE_ANIMATED,
+            max_frames=settings.MINIATURE_MAX_FRAMES,
+            analysis=analysis,
+            profile=settings.MINIATURE_RESAMPLING
+        )
+
+    @classmethod
+    def get_features(cls, image, features=None, timeout=None):
+        """
+        Returns a dictionary of image ``features`` (``MINIATURE_FEATURES`` by default) by name.
+        Features are read from the image analysis, the image is only decoded for missing ones.
+        """
+        features = features or settings.MINIATURE_FEATURES
+        analysis = cls.get_analysis(image)
+        analysis_size = len(analysis)
+
+        source = cls.open_image(image)
+        try:
+            with cls.open_processor(source, analysis) as p:
+                p.orientation(defer=True)
+                result = dict((name, p.get_feature(name)) for name in features)
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+
+        if len(analysis) != analysis_size:
+            cls.set_analysis(image, analysis, timeout)
+        return result
+
+    @classmethod
+    def get_thumbnails(cls, requests, timeout=None):
+        """
+        Returns thumbnails of a list of ``(image, operations, accept)`` requests, created
+        concurrently by a pool of ``MINIATURE_THREADS`` threads. Identical requests are only
+        processed once.
+        """
+        requests = [(image, operations if isinstance(operations, ThumbnailOperations)
+            else cls.compile_operations(operations), accept)
+            for image, operations, accept in requests]
+        keys = [(
+            force_bytes(image) if isinstance(image, six.string_types) else cls.image_id(image),
+            repr((operations.operations, operations.policy, operations.save_options)),
+            accept
+        ) for image, operations, accept in requests]
+        unique = dict(zip(keys, requests))
+
+        def run(key):
+            image, operations, accept = unique[key]
+            return key, cls.get_thumbnail(image, operations, timeout, accept)
+
+        if len(unique) < 2 or settings.MINIATURE_THREADS < 2:
+            results = dict(run(x) for x in unique)
+        else:
+            results = dict(cls.pool.map(run, list(unique), 1))
+        return [results[x] for x in keys]
 
-        cls.cache.delete(cls.image_id(image))
+    @classmethod
+    def compile_operations(cls, operations):
+        """
+        Returns operations ready to be used by ``get_thumbnail``, for operations known in advance.
+        """
+        return ThumbnailOperations(operations)
 
     @classmethod
-    def get_thumbnail(cls, image, operations=None, timeout=None):
-        operations = operations or []
+    def get_thumbnail(cls, image, operations=None, timeout=None, accept=None, priority=0):
+        # Output format and save options are not image operations but are part of cache key
+        if not isinstance(operations, ThumbnailOperations):
+            operations = cls.compile_operations(operations)
+
+        format_ = cls.get_format(operations.policy, accept)
+        key, op_id = operations.get_key(cls, format_)
 
         url = None
         if isinstance(image, six.string_types):
             if urlsplit(image).scheme in ('http', 'https'):
                 url = image
-                image = six.BytesIO()
-                image.path = url
-
-        op_id = cls.op_id(operations)
-        entries = cls.get_entries(image)
-        if entries is None:
-            entries = {}
-
-        cached_path = entries.get(op_id)
-        if cached_path is not None and not cls.storage.exists(cached_path):
-            # Something in cache but no file, drop entry
-            del entries[op_id]
-            cached_path = None
-
-        if not cached_path:
-            img_id = hashlib.md5(force_bytes('{0}{1}'.format(
-                image.path,
-                repr(operations)))
-            ).hexdigest()
-
-            # Open URL if needed
-            if url:
-                rsp = None
-                try:
-                    rsp = urlopen(url)
-                    image.write(rsp.read())
-                    image.seek(0)
-                finally:
-                    if rsp:
-                        rsp.close()
-
-            # Create thumbnail
-            dest_file = ContentFile('')
-
-            if hasattr(image, 'closed') and image.closed:
-                image.open()
-
-            with cls.Processor(image) as p:
-                p.orientation()
-                p.operations(*operations).save(dest_file)
-
-                cached_path = '{0}.{1}'.format(
-                    os.path.join(img_id[0:2], img_id[2:4], img_id),
-                    p.format
-                )
-                cls.storage.save(cached_path, dest_file)
-                del dest_file
-
-            if hasattr(image, 'close'):
-                image.close()
-
-        entries[op_id] = cached_path
-        cls.set_entries(image, entries, timeout)
+                image = RemoteImage(url)
+
+        with instrumentation.measure('cache.get') as values:
+            cached_path = (cls.get_entries(image) or {}).get(op_id)
+            values['hit'] = cached_path is not None
+        # Something in cache but no file, entry is replaced
+        if cached_path is not None and cls.check_entry(image, op_id, cached_path, timeout):
+            return FileWrapper(cached_path, cls.storage)
+
+        # Recent failures are not tried again until they expire
+        with instrumentation.measure('failure.get') as values:
+            failure = cls.get_failure(image, op_id)
+            values['hit'] = failure is not None
+        if failure is not None:
+            return cls.get_fallback(image, url, settings.MINIATURE_FAILURE_POLICY,
+                ThumbnailFailed(failure['kind'], failure['error']))
+
+        # Only thumbnail creation is limited, cached thumbnails are always returned
+        with instrumentation.measure('render.admission') as values:
+            slot = cls.budget.acquire(priority, settings.MINIATURE_RENDER_WAIT)
+            values['shed'] = slot is None
+        if slot is None:
+            return cls.get_fallback(image, url, settings.MINIATURE_OVERLOAD_POLICY,
+                ThumbnailOverloaded('Thumbnail render budget is exhausted.'))
+
+        try:
+            cached_path, size = cls.create_thumbnail(image, url, operations, key, format_,
+                timeout)
+        except Exception as e:
+            cls.set_failure(image, op_id, e)
+            if getattr(e, 'failure_kind', None) is None \
+            or settings.MINIATURE_FAILURE_POLICY not in ('source', 'placeholder'):
+                raise
+            return cls.get_fallback(image, url, settings.MINIATURE_FAILURE_POLICY, e)
+        finally:
+            cls.budget.release(slot)
+
+        cls.add_entry(image, op_id, cached_path, timeout, size)
         return FileWrapper(cached_path, cls.storage)
 
+    @classmethod
+    def create_thumbnail(cls, image, url, operations, key, format_, timeout=None):
+        """
+        Creates a thumbnail and returns its path in storage and its size.
+        """
+        img_id = hashlib.md5(force_bytes('{0}{1}'.format(
+            image.path,
+            repr(key)))
+        ).hexdigest()
+
+        # Open URL if needed
+        if url:
+            rsp = None
+            try:
+                with failure_kind('fetch'), instrumentation.measure('fetch') as values:
+                    rsp = urlopen(url, timeout=settings.MINIATURE_FETCH_TIMEOUT)
+                    data = rsp.read()
+                    values['bytes'] = len(data)
+                image.write(data)
+                image.seek(0)
+            finally:
+                if rsp:
+                    rsp.close()
+
+        # Create thumbnail
+        dest_file = ContentFile(b'')
+        source = cls.open_image(image)
+
+        # Smart crops of a same source share their analysis
+        analysis = cls.get_analysis(image)
+        analysis_size = len(analysis)
+
+        with failure_kind('decode'):
+            p = cls.open_processor(source, analysis)
+
+        with p:
+            if format_ == 'source':
+                format_ = p.format
+
+            try:
+                p.orientation(defer=True)
+                for name in settings.MINIATURE_FEATURES:
+                    p.get_feature(name)
+                p.operations(*operations.operations)
+                p.save(dest_file, format_,
+                    **cls.get_save_options(format_, operations.save_options))
+            except Exception as e:
+                # Images are decoded by operations, broken data is a source failure
+                decode = isinstance(e, (EnvironmentError, SyntaxError, ImageTooLargeError))
+                e.failure_kind = 'decode' if decode else 'operation'
+                raise
+
+            cached_path = '{0}.{1}'.format(
+                os.path.join(img_id[0:2], img_id[2:4], img_id),
+                format_
+            )
+            with instrumentation.measure('storage.save', bytes=dest_file.tell()):
+                cached_path = cls.storage.save(cached_path, dest_file)
+            del dest_file
+            size = p.size
+
+        if hasattr(source, 'close'):
+            source.close()
+
+        if len(analysis) != analysis_size:
+            cls.set_analysis(image, analysis, timeout)
+
+        return cached_path, size
+
+    @classmethod
+    def get_fallback(cls, image, url, policy, error):
+        """
+        Returns what replaces a thumbnail that can't be created according to ``policy``: the
+        source image (``source``), a placeholder (``placeholder``), ``error`` is raised otherwise.
+        """
+        if policy == 'source':
+            return FallbackFile(url) if url else FileWrapper(image)
+        if policy == 'placeholder' and settings.MINIATURE_PLACEHOLDER:
+            return FallbackFile(settings.MINIATURE_PLACEHOLDER)
+        raise error
+
 
 class FileWrapper(File):
     """
@@ -159,3 +793,24 @@ class FileWrapper(File):
     @property
     def path(self):
         return self.storage.path(self.name)
+
+
+class RemoteImage(six.BytesIO):
+    """
+    Data of a remote image, downloaded when a thumbnail is created. ``path`` is its URL.
+    """
+    def __init__(self, url):
+        six.BytesIO.__init__(self)
+        self.path = url
+
+
+class FallbackFile(File):
+    """
+    Thumbnail replacement (source image URL or placeholder) returned when rendering is shed.
+    """
+    def __init__(self, url):
+        super(FallbackFile, self).__init__(None, url)
+
+    @property
+    def url(self):
+        return self.name
@@ -9,8 +9,29 @@ from django.conf import settings as _settings
 DEFAULTS = {
     'MINIATURE_BACKEND': 'miniature.thumbnails.base.ThumbnailBackend',
     'MINIATURE_CACHE': 'thumbnails',
+    'MINIATURE_INDEX': None,
+    'MINIATURE_VERSION_TIMEOUT': 60,
     'MINIATURE_THUMBNAIL_PATH': 'cache',
     'MINIATURE_PROCESSOR': 'pillow',
+    'MINIATURE_MAX_PIXELS': None,
+    'MINIATURE_MAX_BYTES': None,
+    'MINIATURE_OVERSIZE_POLICY': 'reduce',
+    'MINIATURE_ANIMATED': False,
+    'MINIATURE_MAX_FRAMES': 100,
+    'MINIATURE_RESAMPLING': None,
+    'MINIATURE_FORMAT': None,
+    'MINIATURE_THREADS': 4,
+    'MINIATURE_MAX_RENDERS': None,
+    'MINIATURE_MAX_HOST_RENDERS': None,
+    'MINIATURE_RENDER_LOCK_DIR': None,
+    'MINIATURE_RENDER_WAIT': None,
+    'MINIATURE_OVERLOAD_POLICY': 'wait',
+    'MINIATURE_PLACEHOLDER': None,
+    'MINIATURE_FAILURE_TIMEOUT': 60,
+    'MINIATURE_FAILURE_POLICY': 'raise',
+    'MINIATURE_FETCH_TIMEOUT': 10,
+    'MINIATURE_FEATURES': (),
+    'MINIATURE_SAVE_OPTIONS': {},
     'MINIATURE_PRESETS': {
         'mini': (('thumbnail', '100,100'),),
         'square-mini': (('thumbnail', '100,100'), ('crop', '1,smart')),
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+from django.utils.cache import patch_vary_headers
+
+
+class VaryAcceptMiddleware(object):
+    """
+    Adds ``Accept`` to the ``Vary`` header of responses whose thumbnails formats were chosen from
+    the request ``Accept`` header, so that HTTP caches don't serve them to other clients.
+    """
+    def process_response(self, request, response):
+        if getattr(request, 'miniature_accept', False):
+            patch_vary_headers(response, ('Accept',))
+        return response
@@ -4,14 +4,89 @@
 # See the LICENSE for more information.
 from __future__ import (print_function, division, absolute_import, unicode_literals)
 
+import re
+import uuid
+
 from django import template
-from django.template.base import kwarg_re
+from django.template.base import kwarg_re, Variable
+from django.utils.encoding import python_2_unicode_compatible
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 
 from miniature.thumbnails.conf import settings
-from miniature.thumbnails import get_thumbnail
+from miniature.thumbnails import backend, get_thumbnail, get_thumbnails
+from miniature.thumbnails.base import ThumbnailOperations
 
 register = template.Library()
 
+# Context variable holding prefetched thumbnails
+PREFETCH_VAR = '_miniature_prefetch'
+
+
+class Prefetch(object):
+    """
+    Thumbnails of a ``prefetchthumbnails`` block. Requests are collected while the block is
+    rendered, with pending thumbnails whose attributes are markers. Thumbnails are then created
+    concurrently and markers replaced by their values.
+    """
+    def __init__(self):
+        self.token = uuid.uuid4().hex
+        self.marker_re = re.compile(r'miniature-{0}-(\d+)-({1})'.format(self.token,
+            '|'.join(PendingThumbnail.ATTRIBUTES)))
+        self.requests = []
+
+    def add(self, image, operations, accept):
+        self.requests.append((image, operations, accept))
+        return PendingThumbnail(self, len(self.requests) - 1)
+
+    def get_marker(self, index, name):
+        return 'miniature-{0}-{1}-{2}'.format(self.token, index, name)
+
+    def replace(self, output, autoescape=True):
+        if not self.requests:
+            return output
+
+        results = get_thumbnails(self.requests)
+
+        def value(match):
+            result = getattr(results[int(match.group(1))], match.group(2))
+            return escape(result) if autoescape else result
+
+        return mark_safe(self.marker_re.sub(value, output))
+
+
+@python_2_unicode_compatible
+class PendingThumbnail(object):
+    """
+    Thumbnail of a ``prefetchthumbnails`` block, not created yet.
+    """
+    ATTRIBUTES = ('url', 'name', 'path')
+
+    def __init__(self, prefetch, index):
+        self.prefetch = prefetch
+        self.index = index
+
+    def __getattr__(self, name):
+        if name not in self.ATTRIBUTES:
+            raise AttributeError(name)
+        return self.prefetch.get_marker(self.index, name)
+
+    def __str__(self):
+        return self.prefetch.get_marker(self.index, 'name')
+
+
+def get_literal(value):
+    """
+    Returns ``(True, value)`` for a literal filter expression, ``(False, None)`` otherwise.
+    """
+    if value.filters:
+        return False, None
+    if isinstance(value.var, Variable):
+        if value.var.literal is None or value.var.translate:
+            return False, None
+        return True, value.var.literal
+    return True, value.var
+
 
 class ThumbnailNode(template.Node):
     def __init__(self, nodelist, tag_name, file_instance, var_name, params):
@@ -19,36 +94,99 @@ class ThumbnailNode(template.Node):
         self.tag_name = tag_name
         self.var_name = var_name
         self.file_instance = file_instance
-        self.params = params
         self.presets = settings.MINIATURE_PRESETS
 
+        # Literal parameters and presets are resolved once, when template is compiled
+        self.params = []
+        for name, value in params:
+            literal, resolved = get_literal(value)
+            if literal and name is None:
+                resolved = self.get_preset(resolved)
+            self.params.append((name, resolved if literal else value, literal))
+
+        self.operations = None
+        if all(x[2] for x in self.params):
+            self.operations = backend.compile_operations(self.get_operations(None))
+
     def __repr__(self):
         return "<ThumbnailNode>"
 
     def render(self, context):
+        image = self.file_instance.resolve(context)
         operations = self.get_operations(context)
-        img = get_thumbnail(self.file_instance.resolve(context), operations)
+        if not isinstance(operations, ThumbnailOperations):
+            operations = backend.compile_operations(operations)
+        accept = self.get_accept(context, operations)
+
+        prefetch = context.get(PREFETCH_VAR)
+        if prefetch is not None:
+            img = prefetch.add(image, operations, accept)
+        else:
+            img = get_thumbnail(image, operations, accept=accept)
+
         context.update({self.var_name: img})
         output = self.nodelist.render(context)
         context.pop()
         return output
 
+    def get_accept(self, context, operations):
+        request = context.get('request')
+        if request is None or not backend.is_negotiated(operations.policy):
+            return None
+        # Response depends on Accept header (see VaryAcceptMiddleware)
+        request.miniature_accept = True
+        return request.META.get('HTTP_ACCEPT')
+
+    def get_preset(self, name):
+        try:
+            return self.presets[name]
+        except KeyError:
+            raise template.TemplateSyntaxError('Preset "{0}" does not exist.'.format(name))
+
     def get_operations(self, context):
+        if self.operations is not None:
+            return self.operations
+
         result = []
-        for name, value in self.params:
-            value = value.resolve(context)
+        for name, value, literal in self.params:
+            if not literal:
+                value = value.resolve(context)
+                if name is None:
+                    value = self.get_preset(value)
+
             if name is None:
-                try:
-                    value = self.presets[value]
-                    result.extend(value)
-                except KeyError:
-                    raise template.TemplateSyntaxError('Preset "{0}" does not exist.'.format(value))
+                result.extend(value)
             else:
                 result.append((name, value))
 
         return result
 
 
+class PrefetchNode(template.Node):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def __repr__(self):
+        return "<PrefetchNode>"
+
+    def render(self, context):
+        # Block is rendered once, thumbnails are created at the end
+        prefetch = Prefetch()
+        context.update({PREFETCH_VAR: prefetch})
+        try:
+            output = self.nodelist.render(context)
+        finally:
+            context.pop()
+        return prefetch.replace(output, context.autoescape)
+
+
+@register.tag('prefetchthumbnails')
+def do_prefetch_thumbnails(parser, token):
+    nodelist = parser.parse(('endprefetchthumbnails',))
+    parser.delete_first_token()
+    return PrefetchNode(nodelist)
+
+
 @register.tag('thumbnail')
 def do_thumbnail(parser, token):
     bits = token.split_contents()
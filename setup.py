@@ -34,8 +34,13 @@ setup(
     ],
     extras_require={
         'pillow': ['pillow'],
+        'vips': ['pyvips'],
+        'numpy': ['numpy'],
         'six': ['six'],
     },
+    entry_points={
+        'console_scripts': ['miniature = miniature.batch:main'],
+    },
     tests_require=['pillow', 'six'],
     test_suite='test',
     packages=packages,
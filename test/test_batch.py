@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import os
+from shutil import copy, rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from miniature.batch import get_dest, main, process_many
+from miniature.processor import get_processor
+
+
+class BatchTests(TestCase):
+    assets = os.path.realpath(os.path.join(os.path.dirname(__file__), 'assets'))
+
+    def setUp(self):
+        self.dest = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dest)
+
+    def test_get_dest(self):
+        self.assertEqual(get_dest('/src/a/b.jpg', '/out/{reldir}/{name}-mini.{ext}', '/src'),
+            '/out/a/b-mini.jpg')
+        self.assertEqual(get_dest('/src/b.jpg', '/out/{reldir}/{name}.{ext}', '/src', 'png'),
+            '/out/b.png')
+
+    def test_process_many(self):
+        broken = os.path.join(self.dest, 'broken.jpg')
+        with open(broken, 'wb') as fp:
+            fp.write(b'nope')
+
+        sources = [os.path.join(self.assets, x)
+            for x in ('tiger.jpg', 'beach.jpg', 'mona-lisa.jpg')]
+        results = list(process_many(sources + [broken], (('thumbnail', '100,100'),),
+            os.path.join(self.dest, 'out', '{name}.{ext}'), workers=2, chunksize=1))
+
+        self.assertEqual(len(results), 4)
+        errors = [x for x in results if x.error]
+        self.assertEqual([x.source for x in errors], [broken])
+
+        Processor = get_processor('pillow')
+        for result in results:
+            if not result.error:
+                with Processor(result.dest) as p:
+                    self.assertTrue(max(p.size) == 100)
+
+    def test_main(self):
+        src = os.path.join(self.dest, 'src')
+        os.makedirs(os.path.join(src, 'sub'))
+        copy(os.path.join(self.assets, 'tiger.jpg'), src)
+        copy(os.path.join(self.assets, 'beach.jpg'), os.path.join(src, 'sub'))
+
+        out = os.path.join(self.dest, 'out')
+        self.assertEqual(main([src, '-o', out, '-O', 'thumbnail=50,50', '-f', 'png', '-j', '1',
+            '-q']), 0)
+        self.assertTrue(os.path.exists(os.path.join(out, 'tiger.png')))
+        self.assertTrue(os.path.exists(os.path.join(out, 'sub', 'beach.png')))
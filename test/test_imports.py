@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import json
+import os
+import subprocess
+import sys
+from unittest import TestCase, skipIf, skipUnless
+
+try:
+    import django
+except ImportError:
+    django = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative import time of library modules, in microseconds
+IMPORT_BUDGET = 80000
+
+
+# Django application modules, settings have to be configured first
+DJANGO_SETUP = (
+    'from django.conf import settings\n'
+    'settings.configure()\n'
+)
+DJANGO_MODULES = ('miniature.thumbnails.base', 'miniature.thumbnails.templatetags.miniature')
+
+
+def run(code):
+    return subprocess.check_output([sys.executable, '-X', 'importtime', '-c', code],
+        cwd=ROOT, stderr=subprocess.STDOUT).decode('utf-8')
+
+
+@skipIf(sys.version_info < (3, 7), '-X importtime requires Python 3.7')
+class ImportTests(TestCase):
+    def test_lazy_modules(self):
+        output = run(
+            'import sys, json\n'
+            'import miniature.batch, miniature.processor.base, miniature.instrumentation\n'
+            'print(json.dumps(sorted(sys.modules)))\n'
+        )
+        modules = json.loads(output.splitlines()[-1])
+        for name in ('PIL', 'pyvips', 'numpy', 'miniature.processor.saliency'):
+            self.assertNotIn(name, modules)
+
+        output = run(
+            'import sys, json\n'
+            'import miniature.processor.pillow_processor\n'
+            'print(json.dumps(sorted(sys.modules)))\n'
+        )
+        modules = json.loads(output.splitlines()[-1])
+        for name in ('numpy', 'PIL.GifImagePlugin', 'miniature.processor.pillow_frames'):
+            self.assertNotIn(name, modules)
+
+    def test_import_budget(self):
+        # Best of several runs, the first one could include bytecode compilation
+        timings = []
+        for i in range(3):
+            for line in run('import miniature.batch').splitlines():
+                if line.endswith('| miniature.batch'):
+                    timings.append(int(line.split('|')[1]))
+
+        self.assertTrue(min(timings) <= IMPORT_BUDGET, '{0}us'.format(min(timings)))
+
+    @skipUnless(django, 'Django is not installed')
+    def test_django_lazy_modules(self):
+        output = run(
+            DJANGO_SETUP +
+            'import sys, json\n'
+            'import {0}\n'
+            'print(json.dumps(sorted(sys.modules)))\n'.format(', '.join(DJANGO_MODULES))
+        )
+        # Modules imported on exit are reported after the printed list
+        modules = json.loads([x for x in output.splitlines() if x.startswith('[')][-1])
+        for name in ('PIL', 'pyvips', 'numpy', 'miniature.processor.saliency',
+                'miniature.thumbnails.aio'):
+            self.assertNotIn(name, modules)
+
+    @skipUnless(django, 'Django is not installed')
+    def test_django_import_budget(self):
+        # Only library modules count, not Django ones
+        timings = []
+        for i in range(3):
+            output = run(DJANGO_SETUP + 'import {0}'.format(', '.join(DJANGO_MODULES)))
+            timings.append(sum(int(line.split('|')[0].split(':')[1])
+                for line in output.splitlines()
+                if line.startswith('import time:') and line.split('|')[2].strip().startswith(
+                    'miniature')))
+
+        self.assertTrue(min(timings) <= IMPORT_BUDGET, '{0}us'.format(min(timings)))
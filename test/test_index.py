@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import threading
+import time
+from unittest import TestCase
+
+from miniature.index import SQLiteIndex
+
+
+class IndexTests(TestCase):
+    def setUp(self):
+        self.dest = mkdtemp()
+        self.path = os.path.join(self.dest, 'index.sqlite3')
+        self.index = SQLiteIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        rmtree(self.dest)
+
+    def test_entries(self):
+        index = self.index
+        self.assertEqual(index.get('a.jpg'), {})
+        self.assertEqual(index.add('a.jpg', 'op1', 'x/1.jpg', 'v1', (200, 100)), None)
+        index.add('a.jpg', 'op2', 'x/2.jpg', 'v1')
+        index.add('b/c.jpg', 'op1', 'y/1.jpg')
+        self.assertEqual(index.get('a.jpg'), {'op1': ('x/1.jpg', 'v1'), 'op2': ('x/2.jpg', 'v1')})
+
+        # Thumbnails of a new source version replace previous ones and give their path
+        self.assertEqual(index.add('a.jpg', 'op2', 'x/2_new.jpg', 'v2'), 'x/2.jpg')
+        self.assertEqual(index.add('a.jpg', 'op2', 'x/2_new.jpg', 'v2'), None)
+
+        self.assertEqual(index.get_many(['a.jpg', 'b/c.jpg', 'd.jpg']), {
+            'a.jpg': {'op1': ('x/1.jpg', 'v1'), 'op2': ('x/2_new.jpg', 'v2')},
+            'b/c.jpg': {'op1': ('y/1.jpg', None)},
+        })
+        entry = list(index.scan('a.'))[0]
+        self.assertEqual((entry.op_id, entry.version, entry.width, entry.height),
+            ('op1', 'v1', 200, 100))
+
+        index.set('a.jpg', {'op1': 'x/1.jpg', 'op3': 'x/3.jpg'}, 'v3')
+        self.assertEqual(index.get('a.jpg'), {'op1': ('x/1.jpg', 'v3'), 'op3': ('x/3.jpg', 'v3')})
+        self.assertEqual(list(index.scan('a.'))[0].width, 200)
+
+        self.assertEqual(sorted(index.delete_source('a.jpg')), ['x/1.jpg', 'x/3.jpg'])
+        self.assertEqual(index.count(), 1)
+
+        # Entries persist
+        index.close()
+        self.assertEqual(SQLiteIndex(self.path).get('b/c.jpg'), {'op1': ('y/1.jpg', None)})
+
+    def test_scan(self):
+        index = self.index
+        for source in ('a/1.jpg', 'a/2.jpg', 'ab.jpg', 'b/1.jpg', 'b/2.jpg'):
+            index.add(source, 'op1', source + '.thumb')
+            index.add(source, 'op2', source + '.thumb2')
+
+        self.assertEqual([x.source for x in index.scan('a/')], ['a/1.jpg'] * 2 + ['a/2.jpg'] * 2)
+        self.assertEqual(len(list(index.scan())), 10)
+        self.assertEqual(len(list(index.scan('b/', limit=3))), 3)
+        self.assertEqual(list(index.sources('a')), ['a/1.jpg', 'a/2.jpg', 'ab.jpg'])
+
+        index.delete(index.scan('b/'))
+        self.assertEqual(list(index.sources()), ['a/1.jpg', 'a/2.jpg', 'ab.jpg'])
+
+    def test_touch(self):
+        index = SQLiteIndex(self.path, touch_interval=3600)
+        index.add('a.jpg', 'op1', 'x/1.jpg')
+        index.add('a.jpg', 'op2', 'x/2.jpg')
+        cutoff = time.time() + 0.01
+        time.sleep(0.02)
+
+        # Access times are written on flush
+        index.touch('a.jpg', 'op1')
+        self.assertEqual(len(list(index.scan(accessed_before=cutoff))), 2)
+        index.flush()
+        self.assertEqual([x.op_id for x in index.scan(accessed_before=cutoff)], ['op2'])
+        index.close()
+
+    def test_threads(self):
+        errors = []
+
+        def run(n):
+            try:
+                for i in range(20):
+                    self.index.add('{0}.jpg'.format(i), 'op{0}'.format(n), 'path')
+                    self.index.get('{0}.jpg'.format(i))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(x,)) for x in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.index.count(), 80)
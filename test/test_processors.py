@@ -5,11 +5,22 @@
 from __future__ import (print_function, division, absolute_import, unicode_literals)
 
 import os
+import struct
+import subprocess
+import sys
 from shutil import rmtree
 from tempfile import mkdtemp
 from unittest import TestCase
+import warnings
+import zlib
 
-from miniature.processor.base import six
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from miniature import instrumentation
+from miniature.processor.base import six, ImageTooLargeError
 from miniature.processor import get_processor
 
 DEST_FOLDER = None
@@ -17,6 +28,27 @@ if 'DEST_FOLDER' in os.environ:
     DEST_FOLDER = os.path.realpath(os.environ['DEST_FOLDER'])
 
 
+def write_png(path, w, h):
+    """
+    Writes a large RGB PNG file without building it in memory.
+    """
+    def chunk(fp, cid, data):
+        fp.write(struct.pack(str('>I'), len(data)) + cid + data)
+        fp.write(struct.pack(str('>I'), zlib.crc32(cid + data) & 0xffffffff))
+
+    with open(path, 'wb') as fp:
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        chunk(fp, b'IHDR', struct.pack(str('>IIBBBBB'), w, h, 8, 2, 0, 0, 0))
+        compressor = zlib.compressobj(1)
+        row = b'\x01' + bytes(bytearray(x % 256 for x in range(w * 3)))
+        for y in range(h):
+            data = compressor.compress(row)
+            if data:
+                chunk(fp, b'IDAT', data)
+        chunk(fp, b'IDAT', compressor.flush())
+        chunk(fp, b'IEND', b'')
+
+
 class ProcessorTestCase(object):
     processor = None
     assets = os.path.realpath(os.path.join(os.path.dirname(__file__), 'assets'))
@@ -65,6 +97,47 @@ class ProcessorTestCase(object):
             fp.seek(0)
             self.assertTrue(len(fp.read()) > 0)
 
+    def test_save_formats(self):
+        from PIL import Image
+
+        formats = self.processor.get_save_formats()
+        self.assertTrue(set(('jpeg', 'png', 'gif')) <= formats)
+
+        for format_ in ('jpeg', 'png', 'gif', 'webp', 'avif'):
+            if format_ not in formats:
+                continue
+
+            fp = six.BytesIO()
+            with self.processor(self.get_asset('beach.jpg')) as p:
+                p.thumbnail(200, 200).save(fp, format_.upper())
+
+            fp.seek(0)
+            Image.init()
+            if format_.upper() not in Image.OPEN:
+                self.assertTrue(len(fp.read()) > 0)
+                continue
+
+            img = Image.open(fp)
+            self.assertEqual(img.format.lower(), format_)
+            self.assertEqual(img.size, (200, 150))
+
+    def test_save_metadata(self):
+        from PIL import Image
+
+        with self.processor(self.get_asset('beach.jpg')) as p:
+            p.thumbnail(200, 200)
+            stripped, kept = six.BytesIO(), six.BytesIO()
+            p.save(stripped, 'jpeg')
+            p.save(kept, 'jpeg', strip=False, quality=50, progressive=False)
+
+        stripped.seek(0)
+        kept.seek(0)
+        stripped, kept = Image.open(stripped), Image.open(kept)
+        self.assertTrue('progressive' in stripped.info)
+        self.assertFalse('progressive' in kept.info)
+        self.assertFalse(stripped.info.get('exif'))
+        self.assertTrue(kept.info.get('exif'))
+
     def test_close(self):
         p = self.processor(self.get_asset('tiger.jpg'))
         p.assert_open()
@@ -101,6 +174,181 @@ class ProcessorTestCase(object):
         with self.processor(self.get_asset('tiger.jpg')) as p:
             p.crop(1 / 5, 'center').save(self.get_dest('crop-center3'))
 
+    def test_crop_small(self):
+        # Proxy is the image itself, it is read before being saved
+        small = self.get_dest('small.png')
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            p.thumbnail(150, 150).save(small)
+
+        with self.processor(small) as p:
+            p.crop(1, 'smart').save(self.get_dest('crop-small'))
+            self.assertEqual(p.size, (84, 84))
+
+        with self.processor(self.get_asset('beach.jpg')) as p:
+            p.rotate(90)
+            p.crop(1, 'smart').save(self.get_dest('crop-rotated'))
+
+    def test_analysis(self):
+        analysis = {}
+        with self.processor(self.get_asset('tiger.jpg'), analysis=analysis) as p:
+            poi = p.get_poi()
+            p.crop(1, 'smart')
+            self.assertTrue(p.analysis is None)
+        self.assertEqual(list(analysis), ['grid-210-3x3'])
+
+        def fail(*args):
+            raise AssertionError('Image analyzed again.')
+
+        # Next processors don't analyze the image again, even on a thumbnail
+        with self.processor(self.get_asset('tiger.jpg'), analysis=analysis) as p:
+            p.compute_entropy_grid = fail
+            self.assertEqual(p.get_poi(), poi)
+            p.thumbnail(800, 800)
+            for a, b in zip(p.get_poi(), poi):
+                self.assertTrue(abs(a - b / 2) <= 1)
+            p.crop(16 / 9, 'smart').save(self.get_dest('crop-smart3'))
+
+    def test_analysis_oriented(self):
+        from PIL import Image
+
+        src = os.path.join(self.dest, 'oriented-6.jpg')
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        Image.open(self.get_asset('tiger.jpg')).save(src, exif=exif.tobytes())
+
+        # Deferred orientation is applied on proxies, analyses survive it
+        analysis = {}
+        with self.processor(src, analysis=analysis) as p:
+            p.orientation(defer=True).thumbnail(400, 400)
+            poi = p.get_poi()
+            self.assertTrue(p.analysis is analysis)
+            p.crop(1, 'smart')
+        self.assertEqual(list(analysis), ['grid-210-3x3'])
+
+        def fail(*args):
+            raise AssertionError('Image analyzed again.')
+
+        with self.processor(src, analysis=analysis) as p:
+            p.compute_entropy_grid = fail
+            p.orientation(defer=True).thumbnail(400, 400)
+            self.assertEqual(p.get_poi(), poi)
+            p.crop(1, 'smart')
+
+    def test_detectors(self):
+        try:
+            from miniature.processor.saliency import DETECTORS
+        except ImportError:
+            return self.skipTest('NumPy is not installed.')
+
+        for detector in DETECTORS:
+            with self.processor(self.get_asset('mona-lisa.jpg')) as p:
+                w, h = p.size
+                x, y = p.get_poi(detector=detector, ratio=1)
+                self.assertTrue(0 <= x <= w and 0 <= y <= h)
+
+                p.crop(1, 'smart', detector).save(self.get_dest('crop-{0}'.format(detector)))
+                self.assertEqual(p.size, (w, w))
+
+            # After other operations
+            with self.processor(self.get_asset('tiger.jpg')) as p:
+                p.thumbnail(400, 400).crop(1, 'smart', detector)
+                self.assertEqual(p.size, (225, 225))
+                p.save(self.get_dest('crop-thumbnail-{0}'.format(detector)))
+            with self.processor(self.get_asset('tiger.jpg')) as p:
+                p.crop(0, 0, 800, 400).crop(1, 'smart', detector)
+                self.assertEqual(p.size, (400, 400))
+                p.save(self.get_dest('crop-crop-{0}'.format(detector)))
+
+            # Palette images are analyzed on their colors (entropy is a palette histogram)
+            if detector == 'entropy':
+                continue
+            with self.processor(self.get_asset('nocomments.gif')) as p:
+                rgb = self.processor(self.get_asset('nocomments.gif'))
+                rgb.set_mode('truecolor')
+                self.assertEqual(p.get_poi(detector=detector, ratio=1),
+                    rgb.get_poi(detector=detector, ratio=1))
+                rgb.close()
+
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            self.assertRaises(ValueError, p.crop, 1, 'smart', 'foo')
+
+            # Vectorized entropy grid gives the same results
+            grid = p.get_entropy_grid()
+            img = p.get_proxy(210)
+            pw, ph = p._get_size(img)
+            for (x1, y1, x2, y2), entropy in grid:
+                zone = p._crop(img, int(round(x1 * pw)), int(round(y1 * ph)),
+                    int(round(x2 * pw)), int(round(y2 * ph)))
+                self.assertAlmostEqual(p._get_entropy(zone), entropy)
+
+    def test_signatures(self):
+        try:
+            from miniature.processor.signatures import hash_distance
+        except ImportError:
+            return self.skipTest('NumPy is not installed.')
+
+        analysis = {}
+        with self.processor(self.get_asset('tiger.jpg'), analysis=analysis) as p:
+            dhash, phash = p.get_hash(), p.get_hash('phash')
+            self.assertEqual(len(dhash), 16)
+            self.assertEqual(len(p.get_hash(size=16)), 64)
+            self.assertRaises(ValueError, p.get_hash, 'foo')
+
+            colors = p.get_colors(3)
+            self.assertTrue(1 <= len(colors) <= 3)
+            self.assertAlmostEqual(sum(share for color, share in colors), 1)
+            self.assertEqual(sorted(analysis), ['colors-3', 'hash-dhash-16', 'hash-dhash-8',
+                'hash-phash-8'])
+
+        # A reduced copy is a near duplicate, another image is not
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            p.thumbnail(300, 300)
+            self.assertTrue(hash_distance(p.get_hash(), dhash) <= 4)
+            self.assertTrue(hash_distance(p.get_hash('phash'), phash) <= 4)
+        with self.processor(self.get_asset('beach.jpg')) as p:
+            self.assertTrue(hash_distance(p.get_hash(), dhash) > 10)
+
+        # Next processors read the analysis
+        with self.processor(self.get_asset('tiger.jpg'), analysis=analysis) as p:
+            p.get_proxy = None
+            self.assertEqual(p.get_hash(), dhash)
+            self.assertEqual(p.get_colors(3), colors)
+
+        # After other operations
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            p.crop(0, 0, 800, 400)
+            p.get_hash()
+            p.rotate(30)
+            self.assertEqual(len(p.get_colors()), 5)
+            p.save(self.get_dest('signatures-rotated.jpg'))
+
+    def test_signatures_modes(self):
+        from PIL import Image
+        try:
+            from miniature.processor.signatures import hash_distance
+        except ImportError:
+            return self.skipTest('NumPy is not installed.')
+
+        # Palette images give colors, not palette indices
+        rgb = self.get_dest('rgb.png')
+        Image.open(self.get_asset('nocomments.gif')).convert('RGB').save(rgb)
+        with self.processor(rgb) as p:
+            expected = p.get_colors(1)[0][0]
+            dhash = p.get_hash()
+        with self.processor(self.get_asset('nocomments.gif')) as p:
+            color = p.get_colors(1)[0][0]
+            self.assertTrue(max(abs(a - b) for a, b in zip(color, expected)) <= 2, color)
+            self.assertTrue(hash_distance(p.get_hash(), dhash) <= 2)
+
+        # CMYK has no alpha
+        cmyk = self.get_dest('cmyk.jpg')
+        Image.open(self.get_asset('beach.jpg')).convert('CMYK').save(cmyk)
+        with self.processor(cmyk) as p:
+            colors = p.get_colors(3)
+            self.assertEqual(len(colors), 3)
+            self.assertEqual(len(colors[0][0]), 3)
+            self.assertAlmostEqual(sum(share for color, share in colors), 1)
+
     def test_resize(self):
         with self.processor(self.get_asset('nocomments.gif')) as p:
             p.resize(200, 200).save(self.get_dest('resize1'))
@@ -134,6 +382,120 @@ class ProcessorTestCase(object):
             p.orientation()
             self.assertEqual(p.size, size)
 
+    def test_orientation_exif(self):
+        from PIL import Image, ImageChops, ImageStat
+
+        def get_pixels(p):
+            fp = six.BytesIO()
+            p.save(fp, 'png')
+            fp.seek(0)
+            return Image.open(fp).convert('RGB')
+
+        for value in range(1, 9):
+            src = os.path.join(self.dest, 'oriented-{0}.jpg'.format(value))
+            exif = Image.Exif()
+            exif[0x0112] = value
+            Image.open(self.get_asset('tiger.jpg')).save(src, exif=exif.tobytes())
+
+            with self.processor(src) as p:
+                p.orientation()
+                size = p.size
+                reference = get_pixels(p.thumbnail(300, 300))
+
+            self.assertEqual(size, (900, 1600) if value >= 5 else (1600, 900))
+
+            # Analyses of the image as read don't match the transposed one
+            with self.processor(src, analysis={}) as p:
+                p.get_entropy_grid()
+                p.orientation()
+                self.assertEqual(p.analysis is None, value > 1)
+
+            with self.processor(src) as p:
+                p.orientation(defer=True)
+                self.assertEqual(p.size, size)
+                p.thumbnail(300, 300)
+                self.assertEqual(p.size, (168, 300) if value >= 5 else (300, 168))
+                self.assertEqual(p.pending_orientation, None)
+
+                # Transpositions commute with resampling, up to rounding
+                diff = ImageStat.Stat(ImageChops.difference(get_pixels(p), reference)).mean
+                self.assertTrue(max(diff) < 5, (value, diff))
+
+            with self.processor(src) as p:
+                p.orientation(defer=True).crop(1, 'top').save(self.get_dest('oriented-crop.jpg'))
+                self.assertEqual(p.size, (900, 900))
+
+    def test_set_mode_palette(self):
+        for quantizer in self.processor.QUANTIZERS:
+            for mode in ('palette', 'palettematte'):
+                with self.processor(self.get_asset('nocomments.gif')) as p:
+                    try:
+                        p.set_mode(mode, quantizer, sample=100, colors=64, dither=False)
+                    except ValueError:
+                        # Quantizer not available
+                        continue
+                    self.assertTrue(p.mode in ('palette', mode))
+                    self.assertEqual(p.size, (350, 197))
+                    if mode == 'palette':
+                        p.save(self.get_dest('palette-{0}.png'.format(quantizer)))
+
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            self.assertRaises(ValueError, p.set_mode, 'palette', 'foo')
+
+    def test_animated(self):
+        from PIL import Image
+
+        # Poster frame only by default
+        with self.processor(self.get_asset('nocomments.gif')) as p:
+            self.assertEqual(p.frame_count, 1)
+            p.thumbnail(100, 100).save(self.get_dest('poster.gif'))
+        with Image.open(self.get_dest('poster.gif')) as img:
+            self.assertEqual(getattr(img, 'n_frames', 1), 1)
+
+        for format_ in ('gif', 'webp'):
+            if format_ not in self.processor.get_save_formats():
+                continue
+
+            dest = self.get_dest('animated.{0}'.format(format_))
+            with self.processor(self.get_asset('nocomments.gif'), animated=True,
+                    max_frames=10) as p:
+                self.assertEqual(p.frame_count, 10)
+                p.thumbnail(200, 200).crop(1, 'center').save(dest)
+                self.assertEqual(p.size, (112, 112))
+
+                # Frames are processed one at a time
+                self.assertTrue(p.memory_peak < 350 * 197 * 4 * 3)
+
+            with Image.open(dest) as img:
+                self.assertEqual(img.n_frames, 10)
+                self.assertEqual(img.size, (112, 112))
+
+    def test_animated_colors(self):
+        from PIL import Image
+
+        # Frames keep their colors, whatever the colors of the first one
+        colors = [(200, 0, 0), (0, 200, 0), (0, 0, 200), (200, 200, 0)]
+        src = self.get_dest('colors-src.gif')
+        frames = [Image.new('RGB', (100, 100), x) for x in colors]
+        frames[0].save(src, save_all=True, append_images=frames[1:], duration=100, loop=0)
+
+        for format_ in ('gif', 'webp'):
+            if format_ not in self.processor.get_save_formats():
+                continue
+
+            dest = self.get_dest('colors.{0}'.format(format_))
+            with self.processor(src, animated=True) as p:
+                self.assertEqual(p.frame_count, 4)
+                p.thumbnail(50, 50).save(dest)
+
+            with Image.open(dest) as img:
+                self.assertEqual(img.n_frames, 4)
+                for index, color in enumerate(colors):
+                    img.seek(index)
+                    pixel = img.convert('RGB').getpixel((25, 25))
+                    self.assertTrue(all(abs(x - y) < 20 for x, y in zip(pixel, color)),
+                        (format_, index, pixel))
+
     def test_rotate(self):
         with self.processor(self.get_asset('beach.jpg')) as p:
             p.rotate(5).save(self.get_dest('rotate'))
@@ -142,6 +504,136 @@ class ProcessorTestCase(object):
         with self.processor(self.get_asset('beach.jpg')) as p:
             p.add_border(5, 'white').add_border(5, '#c00').save(self.get_dest('border'))
 
+    def test_canvas_modes(self):
+        # Borders and backgrounds don't add an alpha channel
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            p.thumbnail(200, 200).add_border(5, 'white').set_background('#c00')
+            self.assertEqual(p.mode, 'truecolor')
+            p.save(self.get_dest('canvas.jpg'))
+
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            p.thumbnail(200, 200).set_mode('grayscale').add_border(5, '#808080')
+            self.assertEqual(p.mode, 'grayscale')
+            p.add_border(5, '#c00')
+            self.assertEqual(p.mode, 'truecolor')
+
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            p.thumbnail(200, 200).set_mode('truecolormatte').add_border(5, 'white')
+            self.assertEqual(p.mode, 'truecolormatte')
+            p.set_background('white')
+            self.assertEqual(p.mode, 'truecolor')
+
+    def test_memory(self):
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            original = p.img
+            size = p.memory
+            self.assertTrue(size > 0)
+            self.assertEqual(p.memory_peak, size)
+
+            p.thumbnail(200, 200)
+            self.assertFalse(p.img is original)
+            self.assertTrue(p.memory < size)
+            self.assertTrue(p.memory_peak >= size + p.memory)
+
+            p.add_border(5, 'white').add_border(5, '#c00')
+            self.assertTrue(p.memory_peak >= size)
+
+    def test_budget(self):
+        self.assertRaises(ImageTooLargeError, self.processor,
+            self.get_asset('tiger.jpg'), max_pixels=500000)
+        self.assertRaises(ImageTooLargeError, self.processor,
+            self.get_asset('nocomments.gif'), max_pixels=5000, oversize_policy='reduce')
+        self.assertRaises(ValueError, self.processor,
+            self.get_asset('tiger.jpg'), oversize_policy='foo')
+
+        with self.processor(self.get_asset('tiger.jpg'), max_pixels=500000,
+                oversize_policy='reduce') as p:
+            self.assertEqual(p.size, (800, 450))
+            self.assertTrue(p.memory_peak <= 500000 * 4)
+
+        with self.processor(self.get_asset('tiger.jpg'), max_bytes=500000,
+                oversize_policy='reduce') as p:
+            self.assertTrue(p.memory <= 500000)
+
+    def test_tiled(self):
+        src = os.path.join(self.dest, 'tiger.png')
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            p.save(src)
+
+        for operations in ((('thumbnail', '300,300'),), (('crop', '100,50,900,500'),),
+                (('crop', '1,smart'),), (('resize', '123,77'),), (('thumbnail', '2000,2000'),),
+                (('crop', '100,50,1500,850'), ('crop', '1,smart'), ('thumbnail', '300,300'))):
+            with self.processor(src, max_pixels=500000, oversize_policy='tile') as p:
+                self.assertTrue(p.tiled)
+                self.assertRaises(ImageTooLargeError, p.rotate, 90)
+                p.operations(*operations)
+                size = p.size
+                if p.tiled:
+                    # Crops above budget are read by the next reduction
+                    p.thumbnail(400, 400)
+                    self.assertEqual(max(p.size), 400)
+                self.assertFalse(p.tiled)
+
+            with self.processor(src) as p:
+                p.operations(*operations)
+                if operations[0] == ('thumbnail', '2000,2000'):
+                    # Reduced to budget instead of decoded
+                    self.assertTrue(size[0] * size[1] <= 500000)
+                else:
+                    self.assertEqual(size, p.size)
+
+        with self.processor(src, max_pixels=500000, oversize_policy='tile') as p:
+            self.assertRaises(ImageTooLargeError, p.resize, 1000, 1000)
+
+    def test_tiled_memory(self):
+        if resource is None:
+            self.skipTest('resource module is not available')
+
+        src = os.path.join(self.dest, 'large.png')
+        write_png(src, 10000, 10000)
+
+        # Peak is measured from a baseline taken once libraries are loaded and the image opened,
+        # in a new process for each operation
+        code = '; '.join((
+            'import resource',
+            'from miniature.processor import get_processor',
+            'p = get_processor({0!r})({1!r}, max_pixels=10 ** 6, oversize_policy="tile")',
+            'rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss',
+            'p.operations(*{2!r})',
+            'assert p.size == (300, 300), p.size',
+            'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)',
+        ))
+        name = '{0}.{1}'.format(self.processor.__module__, self.processor.__name__)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+
+        for operations in ((('thumbnail', '300,300'),),
+                (('crop', '1,center'), ('thumbnail', '300,300')),
+                (('crop', '1,smart'), ('thumbnail', '300,300'))):
+            rss = int(subprocess.check_output([sys.executable, '-W', 'ignore', '-c',
+                code.format(name, src, operations)], env=env))
+            if sys.platform == 'darwin':
+                rss //= 1024
+
+            # Decoded source would use about 300MB
+            self.assertTrue(rss < 100 * 1024, (operations, rss))
+
+    def test_resampling_profiles(self):
+        for profile in (None, 'fast', 'balanced', 'best'):
+            with self.processor(self.get_asset('tiger.jpg'), profile=profile) as p:
+                p.thumbnail(200, 200)
+                self.assertEqual(p.size, (200, 112))
+                p.resize(100, 100)
+                self.assertEqual(p.size, (100, 100))
+
+        # Per call, overriding processor profile
+        with self.processor(self.get_asset('tiger.jpg'), profile='best') as p:
+            p.operations(('thumbnail', '200,200,False,fast'))
+            self.assertEqual(p.size, (200, 112))
+            p.save(self.get_dest('tiger-fast.jpg'))
+
+        self.assertRaises(ValueError, self.processor, self.get_asset('tiger.jpg'), profile='foo')
+
     def test_operations(self):
         with self.processor(self.get_asset('tiger.jpg')) as p:
             p.operations(('thumbnail', '600,600'), ('crop', '2/1,center'))
@@ -173,6 +665,133 @@ class ProcessorTestCase(object):
             p.operations(('thumbnail', '700,700,True'))
             self.assertEqual(p.size, (469, 700))
 
+    def test_instrumentation(self):
+        metrics = instrumentation.Metrics()
+        instrumentation.add_listener(metrics)
+        try:
+            with self.processor(self.get_asset('tiger.jpg')) as p:
+                p.operations(('thumbnail', '600,600'), ('crop', '2/1,center'))
+                fp = six.BytesIO()
+                p.save(fp, 'png')
+        finally:
+            instrumentation.remove_listener(metrics)
+
+        stats = metrics.snapshot()
+        self.assertEqual(set(stats) - set(['decode']),
+            set(['open', 'operation.thumbnail', 'operation.crop', 'save']))
+        self.assertEqual(stats['operation.crop']['values']['pixels'], 600 * 300)
+        self.assertEqual(stats['save']['values']['bytes'], len(fp.getvalue()))
+        self.assertTrue(all(x['count'] == 1 for x in stats.values()))
+
+        lines = metrics.to_statsd()
+        self.assertIn('miniature.save.count:1|c', lines)
+        self.assertIn('miniature_pixels_total{phase="operation.crop"} 180000',
+            metrics.to_prometheus())
+
+        # Nothing is recorded without listener
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            p.thumbnail(100, 100)
+        self.assertEqual(metrics.snapshot()['operation.thumbnail']['count'], 1)
+
 
 class PillowTests(ProcessorTestCase, TestCase):
     processor = get_processor('pillow')
+
+    def test_tiled_unsupported(self):
+        from PIL import Image
+
+        # JPEG images are reduced by the decoder instead
+        with self.processor(self.get_asset('tiger.jpg'), max_pixels=500000,
+                oversize_policy='tile') as p:
+            self.assertFalse(p.tiled)
+            self.assertEqual(p.size, (800, 450))
+
+        # Other formats without strip support are rejected
+        src = self.get_dest('large.gif')
+        Image.new('P', (1000, 1000)).save(src)
+        self.assertRaises(ImageTooLargeError, self.processor, src, max_pixels=500000,
+            oversize_policy='tile')
+
+    def test_decode_phase(self):
+        events = []
+
+        def listener(name, duration, values):
+            events.append((name, values.get('pixels')))
+
+        # Images are decoded before the first operation, scaled by the decoder if it can
+        instrumentation.add_listener(listener)
+        try:
+            for operations in ((('thumbnail', '200,200'),), (('crop', '1,smart'),), ()):
+                del events[:]
+                with self.processor(self.get_asset('tiger.jpg'), profile='fast') as p:
+                    p.operations(*operations).save(six.BytesIO(), 'png')
+                self.assertEqual([x[0] for x in events][0:2], ['open', 'decode'])
+                self.assertEqual(len([x for x in events if x[0] == 'decode']), 1)
+                self.assertEqual(events[1][1], 400 * 225 if operations == (('thumbnail',
+                    '200,200'),) else 1600 * 900)
+        finally:
+            instrumentation.remove_listener(listener)
+
+    def test_bomb_limit(self):
+        from PIL import Image
+
+        src = os.path.join(self.dest, 'tiger.png')
+        with self.processor(self.get_asset('tiger.jpg')) as p:
+            p.save(src)
+
+        # Pillow limit (lowered below half the image size) only applies without budget. Strips
+        # are still checked by Pillow, they are far below the actual limit.
+        limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, 500000
+        try:
+            self.assertRaises(ImageTooLargeError, self.processor, src)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+                for operations in ((('thumbnail', '300,300'),),
+                        (('crop', '1,smart'), ('thumbnail', '300,300'))):
+                    with self.processor(src, max_pixels=500000, oversize_policy='tile') as p:
+                        self.assertTrue(p.tiled)
+                        p.operations(*operations)
+                        self.assertEqual(max(p.size), 300)
+            self.assertEqual(Image.MAX_IMAGE_PIXELS, 500000)
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+
+
+try:
+    import pyvips  # NOQA
+except (ImportError, OSError):
+    pass
+else:
+    class VipsTests(ProcessorTestCase, TestCase):
+        processor = get_processor('vips')
+
+        def test_histogram_16bits(self):
+            import pyvips
+
+            # Same bins as the 8 bits image
+            src = self.get_dest('tiger16.png')
+            img = pyvips.Image.new_from_file(self.get_asset('tiger.jpg'))
+            (img.cast('ushort') * 257).cast('ushort').copy(interpretation='rgb16').write_to_file(
+                src)
+            with self.processor(src) as p, self.processor(self.get_asset('tiger.jpg')) as ref:
+                self.assertEqual(p.img.format, 'ushort')
+                histogram = p.get_histogram()
+                self.assertEqual(len(histogram), 3 * 256)
+                self.assertEqual(histogram, ref.get_histogram())
+
+        def test_file_source(self):
+            from shutil import copy
+
+            # Files are read by libvips, even with a name it would parse options from
+            src = self.get_dest('tiger[shrink=2].jpg')
+            copy(self.get_asset('tiger.jpg'), src)
+            with self.processor(src) as p:
+                self.assertEqual(p._filename, src)
+                self.assertEqual(p._buffer, None)
+                self.assertEqual(p.size, (1600, 900))
+                p.crop(1, 'smart').thumbnail(100, 100).save(self.get_dest('file-source.jpg'))
+
+            with open(src, 'rb') as fp:
+                with self.processor(six.BytesIO(fp.read())) as p:
+                    self.assertEqual(p._filename, None)
+                    p.thumbnail(100, 100).save(self.get_dest('buffer-source.jpg'))
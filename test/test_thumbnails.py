@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Miniature released under the FreeBSD license.
+# See the LICENSE for more information.
+from __future__ import (print_function, division, absolute_import, unicode_literals)
+
+import os
+import sys
+from shutil import copy, rmtree
+from tempfile import mkdtemp
+import threading
+import time
+from unittest import TestCase, skipUnless
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import django
+except ImportError:
+    django = None
+
+MEDIA_ROOT = mkdtemp()
+
+if django is not None:
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(
+            MEDIA_ROOT=MEDIA_ROOT,
+            MEDIA_URL='/media/',
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            INSTALLED_APPS=('miniature.thumbnails',),
+            TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                'APP_DIRS': True}],
+        )
+        if hasattr(django, 'setup'):
+            django.setup()
+
+
+def tearDownModule():
+    rmtree(MEDIA_ROOT)
+
+
+@skipUnless(django, 'Django is not installed')
+class ThumbnailTestCase(TestCase):
+    assets = os.path.realpath(os.path.join(os.path.dirname(__file__), 'assets'))
+
+    def setUp(self):
+        from django.core.files.storage import FileSystemStorage
+        from miniature.thumbnails import backend
+
+        self.dest = mkdtemp()
+        self.sources = FileSystemStorage(location=self.dest, base_url='/media/sources/')
+        copy(os.path.join(self.assets, 'tiger.jpg'), self.dest)
+        self.backend = backend
+        backend.cache.clear()
+
+    def tearDown(self):
+        rmtree(self.dest)
+
+    def get_source(self, name='tiger.jpg'):
+        from miniature.thumbnails.base import FileWrapper
+        return FileWrapper(name, self.sources)
+
+    def render(self, code, **context):
+        from django.template import Context, Template
+        return Template('{% load miniature %}' + code).render(Context(context))
+
+
+class FormatTests(ThumbnailTestCase):
+    def test_vary_accept(self):
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from miniature.thumbnails.middleware import VaryAcceptMiddleware
+
+        self.assertFalse(self.backend.is_negotiated(None))
+        self.assertFalse(self.backend.is_negotiated('png,webp'))
+        self.assertTrue(self.backend.is_negotiated('webp,source'))
+
+        # Only thumbnails whose format depends on Accept header vary responses
+        for operations, vary in (('"mini"', False), ('"mini" format="webp,jpeg"', True)):
+            request = RequestFactory().get('/', HTTP_ACCEPT='image/webp,*/*')
+            output = self.render(
+                '{% thumbnail image ' + operations + ' as mini %}{{ mini.url }}{% endthumbnail %}',
+                image=self.get_source(), request=request)
+            self.assertTrue(output.endswith('.webp' if vary else '.jpeg'), output)
+
+            response = VaryAcceptMiddleware().process_response(request, HttpResponse())
+            self.assertEqual(response.get('Vary'), 'Accept' if vary else None)
+
+
+class IndexTests(ThumbnailTestCase):
+    def test_source_version(self):
+        from django.test.utils import override_settings
+        from miniature.index import SQLiteIndex
+        from miniature.thumbnails.base import ThumbnailBackend
+
+        sources = self.sources
+        calls = []
+
+        class Storage(sources.__class__):
+            def modified_time(self, name):
+                calls.append(name)
+                return super(Storage, self).modified_time(name)
+
+        self.sources = Storage(location=sources.location, base_url=sources.base_url)
+        index = SQLiteIndex(os.path.join(self.dest, 'index.sqlite3'))
+
+        class Backend(ThumbnailBackend):
+            pass
+        Backend.index = index
+
+        operations = [('thumbnail', '100,100')]
+        try:
+            with override_settings(MINIATURE_INDEX=index.path):
+                # Version is read when thumbnail is created, not by next lookups
+                mini = Backend.get_thumbnail(self.get_source(), operations)
+                created = len(calls)
+                self.assertTrue(created > 0)
+                for i in range(3):
+                    self.assertEqual(Backend.get_thumbnail(self.get_source(), operations).name,
+                        mini.name)
+                self.assertEqual(len(calls), created)
+
+                # Without timeout, every lookup reads it
+                with override_settings(MINIATURE_VERSION_TIMEOUT=0):
+                    Backend.get_thumbnail(self.get_source(), operations)
+                self.assertEqual(len(calls), created + 1)
+
+                # Removed entries forget it
+                Backend.remove_entries(self.get_source())
+                self.assertFalse(Backend.versions)
+        finally:
+            index.close()
+
+
+@skipUnless(django, 'Django is not installed')
+class RenderBudgetTests(TestCase):
+    def wait_for(self, condition):
+        end = time.time() + 5
+        while not condition():
+            self.assertTrue(time.time() < end, 'Timed out.')
+            time.sleep(0.005)
+
+    def test_priority(self):
+        from miniature.thumbnails.base import RenderBudget
+
+        budget = RenderBudget(1)
+        slot = budget.acquire()
+        order = []
+
+        def render(priority):
+            s = budget.acquire(priority)
+            order.append(priority)
+            budget.release(s)
+
+        # Waiting renders are admitted by priority, then by arrival
+        threads = []
+        for priority in (0, 5, 1, 5):
+            threads.append(threading.Thread(target=render, args=(priority,)))
+            threads[-1].start()
+            self.wait_for(lambda: len(budget.waiting) == len(threads))
+
+        budget.release(slot)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, [5, 5, 1, 0])
+        self.assertEqual(budget.stats, {'admitted': 5, 'queued': 4, 'shed': 0})
+        self.assertEqual(budget.running, 0)
+
+    def test_deadline(self):
+        from miniature.thumbnails.base import RenderBudget
+
+        budget = RenderBudget(1)
+        slot = budget.acquire()
+        self.assertEqual(budget.acquire(deadline=0.05), None)
+        self.assertEqual(budget.waiting, [])
+        self.assertEqual(budget.stats, {'admitted': 1, 'queued': 1, 'shed': 1})
+
+        budget.release(slot)
+        budget.release(budget.acquire(deadline=0.05))
+        self.assertEqual(budget.stats['admitted'], 2)
+        self.assertEqual(budget.running, 0)
+
+    @skipUnless(fcntl, 'Host slots require fcntl')
+    def test_host_slots(self):
+        from miniature.thumbnails.base import RenderBudget
+
+        lock_dir = mkdtemp()
+        try:
+            # Budgets of other processes share the lock files
+            budget, other = RenderBudget(host_limit=1, lock_dir=lock_dir), \
+                RenderBudget(host_limit=1, lock_dir=lock_dir)
+            slot = other.acquire()
+            self.assertEqual(budget.acquire(deadline=0.05), None)
+            self.assertEqual(budget.stats, {'admitted': 0, 'queued': 0, 'shed': 1})
+            self.assertEqual(budget.running, 0)
+
+            other.release(slot)
+            budget.release(budget.acquire(deadline=0.05))
+            self.assertEqual(budget.stats['admitted'], 1)
+        finally:
+            rmtree(lock_dir)
+
+
+class OverloadTests(ThumbnailTestCase):
+    def test_policies(self):
+        from django.test.utils import override_settings
+        from miniature.thumbnails.base import (RenderBudget, ThumbnailBackend,
+            ThumbnailOverloaded)
+
+        class Backend(ThumbnailBackend):
+            budget = RenderBudget(1)
+
+        operations = [('thumbnail', '100,100')]
+        slot = Backend.budget.acquire()
+        with override_settings(MINIATURE_RENDER_WAIT=0.01, MINIATURE_PLACEHOLDER='/static/p.png'):
+            with override_settings(MINIATURE_OVERLOAD_POLICY='wait'):
+                self.assertRaises(ThumbnailOverloaded, Backend.get_thumbnail, self.get_source(),
+                    operations)
+            with override_settings(MINIATURE_OVERLOAD_POLICY='source'):
+                self.assertEqual(Backend.get_thumbnail(self.get_source(), operations).url,
+                    '/media/sources/tiger.jpg')
+            with override_settings(MINIATURE_OVERLOAD_POLICY='placeholder'):
+                self.assertEqual(Backend.get_thumbnail(self.get_source(), operations).url,
+                    '/static/p.png')
+
+            # Fallbacks are neither cached nor failures
+            self.assertEqual(Backend.get_entries(self.get_source()), None)
+            self.assertEqual(Backend.budget.stats['shed'], 3)
+            Backend.budget.release(slot)
+
+            mini = Backend.get_thumbnail(self.get_source(), operations)
+            self.assertTrue(mini.url.startswith('/media/cache/'), mini.url)
+            self.assertEqual(Backend.budget.stats['admitted'], 2)
+
+
+class CacheStub(object):
+    """
+    Cache whose clock only moves when told to.
+    """
+    def __init__(self):
+        self.now = 0
+        self.values = {}
+
+    def get(self, key, default=None):
+        value, expires = self.values.get(key, (default, None))
+        if expires is not None and expires <= self.now:
+            return default
+        return value
+
+    def get_many(self, keys):
+        result = dict((k, self.get(k)) for k in keys)
+        return dict((k, v) for k, v in result.items() if v is not None)
+
+    def set(self, key, value, timeout=None):
+        self.values[key] = (value, None if timeout is None else self.now + timeout)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+class FailureTests(ThumbnailTestCase):
+    def setUp(self):
+        from miniature.thumbnails.base import ThumbnailBackend
+
+        super(FailureTests, self).setUp()
+        with open(os.path.join(self.dest, 'broken.jpg'), 'wb') as fp:
+            fp.write(b'nope')
+
+        class Backend(ThumbnailBackend):
+            cache = CacheStub()
+        self.Backend = Backend
+
+    def test_decode(self):
+        from miniature.thumbnails.base import ThumbnailFailed
+
+        Backend, source = self.Backend, self.get_source('broken.jpg')
+        operations = [('thumbnail', '100,100')]
+        self.assertRaises(IOError, Backend.get_thumbnail, source, operations)
+
+        # Failure applies to every thumbnail of the source until it expires
+        for ops in (operations, [('thumbnail', '50,50')]):
+            with self.assertRaises(ThumbnailFailed) as cm:
+                Backend.get_thumbnail(source, ops)
+            self.assertEqual(cm.exception.kind, 'decode')
+
+        copy(os.path.join(self.assets, 'tiger.jpg'), os.path.join(self.dest, 'broken.jpg'))
+        Backend.cache.now += 59
+        self.assertRaises(ThumbnailFailed, Backend.get_thumbnail, source, operations)
+        Backend.cache.now += 1
+        self.assertTrue(os.path.exists(Backend.get_thumbnail(source, operations).path))
+
+    def test_operation(self):
+        from django.test.utils import override_settings
+        from miniature.thumbnails.base import ThumbnailFailed
+
+        Backend, source = self.Backend, self.get_source()
+        invalid = [('crop', 'foo')]
+        self.assertRaises(ValueError, Backend.get_thumbnail, source, invalid)
+        self.assertRaises(ThumbnailFailed, Backend.get_thumbnail, source, invalid)
+
+        # Only the thumbnail fails, other thumbnails of the source are created
+        Backend.get_thumbnail(source, [('thumbnail', '100,100')])
+
+        with override_settings(MINIATURE_FAILURE_POLICY='source'):
+            self.assertEqual(Backend.get_thumbnail(source, invalid).url, '/media/sources/tiger.jpg')
+
+        # Without timeout, failures are tried again
+        with override_settings(MINIATURE_FAILURE_TIMEOUT=0):
+            self.assertRaises(ValueError, Backend.get_thumbnail, source, invalid)
+
+    def test_fetch(self):
+        from miniature.thumbnails.base import ThumbnailFailed
+
+        # Nothing listens on port 1
+        url = 'http://127.0.0.1:1/tiger.jpg'
+        operations = [('thumbnail', '100,100')]
+        self.assertRaises(IOError, self.Backend.get_thumbnail, url, operations)
+        with self.assertRaises(ThumbnailFailed) as cm:
+            self.Backend.get_thumbnail(url, [('thumbnail', '50,50')])
+        self.assertEqual(cm.exception.kind, 'fetch')
+
+
+@skipUnless(sys.version_info >= (3, 5), 'asyncio API requires Python 3.5')
+class AsyncTests(ThumbnailTestCase):
+    def test_coalescing(self):
+        import asyncio
+        from miniature.thumbnails import aget_thumbnail, aget_thumbnails
+
+        operations = [('thumbnail', '120,120')]
+        cache_dir = os.path.join(MEDIA_ROOT, 'cache')
+        before = sum(len(x[2]) for x in os.walk(cache_dir))
+
+        # Concurrent requests of a same thumbnail share a single creation (storage would give
+        # another name to a second file)
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            results = loop.run_until_complete(
+                aget_thumbnails([(self.get_source(), operations, None)] * 5))
+            self.assertEqual(len(set(x.name for x in results)), 1)
+            self.assertEqual(sum(len(x[2]) for x in os.walk(cache_dir)), before + 1)
+
+            # Next requests are cache hits
+            mini = loop.run_until_complete(aget_thumbnail(self.get_source(), operations))
+            self.assertEqual(mini.name, results[0].name)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+
+class TemplateTagTests(ThumbnailTestCase):
+    def test_prefetch(self):
+        copy(os.path.join(self.assets, 'beach.jpg'), self.dest)
+        images = [self.get_source('tiger.jpg'), self.get_source('beach.jpg')]
+        tag = ('{% for image in images %}{% thumbnail image "mini" as mini %}'
+            '<img src="{{ mini.url }}" alt="{{ mini }}"/>{% endthumbnail %}{% endfor %}')
+
+        # Markers of pending thumbnails are replaced once they are created, as rendered without
+        # prefetching
+        output = self.render('{% prefetchthumbnails %}' + tag + '{% endprefetchthumbnails %}',
+            images=images)
+        self.assertNotIn('miniature-', output)
+        self.assertEqual(output, self.render(tag, images=images))
+        self.assertEqual(output.count('/media/cache/'), 2)
+
+    def test_compiled_operations(self):
+        from django.template import Context, Template
+        from miniature.thumbnails.base import ThumbnailOperations
+        from miniature.thumbnails.templatetags.miniature import ThumbnailNode
+
+        code = '{% load miniature %}{% thumbnail image PARAMS as mini %}{{ mini.url }}' \
+            '{% endthumbnail %}'
+        literal = Template(code.replace('PARAMS', '"square-mini"'))
+        variable = Template(code.replace('PARAMS', 'preset'))
+        node = literal.nodelist.get_nodes_by_type(ThumbnailNode)[0]
+        operations = node.operations
+        self.assertTrue(isinstance(operations, ThumbnailOperations))
+        self.assertEqual(operations.operations, [('thumbnail', '100,100'), ('crop', '1,smart')])
+        self.assertEqual(variable.nodelist.get_nodes_by_type(ThumbnailNode)[0].operations, None)
+
+        # Literal operations and their key are compiled once
+        context = Context({'image': self.get_source(), 'preset': 'square-mini'})
+        output = literal.render(context)
+        self.assertEqual(literal.render(context), output)
+        self.assertTrue(node.operations is operations)
+        self.assertEqual(list(operations.keys), ['source'])
+        self.assertEqual(variable.render(context), output)